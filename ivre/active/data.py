@@ -199,11 +199,13 @@ speed up queries based on open ports.
 
     """
     openports = host['openports'] = {'count': 0}
+    seen = set()
     for port in host.get('ports', []):
         if port.get('state_state') != 'open':
             continue
         cur = openports.setdefault(port['protocol'], {'count': 0, 'ports': []})
-        if port['port'] not in cur['ports']:
+        if (port['protocol'], port['port']) not in seen:
+            seen.add((port['protocol'], port['port']))
             openports['count'] += 1
             cur['count'] += 1
             cur['ports'].append(port['port'])
@@ -238,10 +240,10 @@ def merge_ja3_scripts(curscript, script, script_id):
     def is_server(script_id):
         return script_id == 'ssl-ja3-server'
 
-    def ja3_equals(a, b, script_id):
-        return (a['raw'] == b['raw'] and
-                (not is_server(script_id) or
-                 a['client']['raw'] == b['client']['raw']))
+    def ja3_key(ja3, script_id):
+        if is_server(script_id):
+            return (ja3['raw'], ja3['client']['raw'])
+        return ja3['raw']
 
     def ja3_output(ja3, script_id):
         output = ja3['md5']
@@ -249,30 +251,30 @@ def merge_ja3_scripts(curscript, script, script_id):
             output += ' - ' + ja3['client']['md5']
         return output
 
-    return _merge_scripts(curscript, script, script_id, ja3_equals, ja3_output)
+    return _merge_scripts(curscript, script, script_id, ja3_key, ja3_output)
 
 
 def merge_ua_scripts(curscript, script, script_id):
 
-    def ua_equals(a, b, script_id):
-        return a == b
+    def ua_key(ua, script_id):
+        return ua
 
     def ua_output(ua, script_id):
         return ua
 
-    return _merge_scripts(curscript, script, script_id, ua_equals, ua_output)
+    return _merge_scripts(curscript, script, script_id, ua_key, ua_output)
 
 
 def merge_ssl_cert_scripts(curscript, script, script_id):
 
-    def cert_equals(a, b, script_id):
-        return a['sha256'] == b['sha256']
+    def cert_key(cert, script_id):
+        return cert['sha256']
 
     def cert_output(cert, script_id):
         return '\n'.join(create_ssl_output(cert))
 
     return _merge_scripts(
-        curscript, script, script_id, cert_equals, cert_output,
+        curscript, script, script_id, cert_key, cert_output,
         outsep="\n------------------------------------------------------------"
         "----\n"
     )
@@ -288,9 +290,11 @@ def merge_axfr_scripts(curscript, script, script_id):
         curscript[script_id] = script[script_id]
         return script
     res = []
+    domains = set()
     for data in chain(curscript[script_id], script[script_id]):
-        if any(data['domain'] == r['domain'] for r in res):
+        if data['domain'] in domains:
             continue
+        domains.add(data['domain'])
         res.append(data)
     res = sorted(res, key=lambda r: tuple(reversed(r['domain'].split('.'))))
     line_fmt = "| %%-%ds  %%-%ds  %%s" % (
@@ -309,22 +313,20 @@ def merge_axfr_scripts(curscript, script, script_id):
     return curscript
 
 
-def _merge_scripts(curscript, script, script_id, script_equals, script_output,
+def _merge_scripts(curscript, script, script_id, script_key, script_output,
                    outsep="\n"):
     """Helper function to merge two scripts and return the result, using
-specific functions `script_equals` and `script_output`.
+specific functions `script_key` (two elements are considered equal when
+their keys are equal; keys must be hashable) and `script_output`.
 
     """
-    to_merge_list = []
     script_id_alias = ALIASES_TABLE_ELEMS.get(script_id, script_id)
-    for to_add in script.setdefault(script_id_alias, []):
-        to_merge = True
-        for cur in curscript.get(script_id_alias, []):
-            if script_equals(to_add, cur, script_id):
-                to_merge = False
-                break
-        if to_merge:
-            to_merge_list.append(to_add)
+    present = set(script_key(cur, script_id)
+                  for cur in curscript.get(script_id_alias, []))
+    to_merge_list = [
+        to_add for to_add in script.setdefault(script_id_alias, [])
+        if script_key(to_add, script_id) not in present
+    ]
     curscript.setdefault(script_id_alias, []).extend(to_merge_list)
     # Compute output from curscript[script_id_alias]
     output = []
@@ -412,8 +414,10 @@ def merge_host_docs(rec1, rec2):
     addresses = rec1.get('addresses', {})
     for atype, addrs in viewitems(rec2.get('addresses', {})):
         cur_addrs = addresses.setdefault(atype, [])
+        present_addrs = set(cur_addrs)
         for addr in addrs:
-            if addr not in cur_addrs:
+            if addr not in present_addrs:
+                present_addrs.add(addr)
                 cur_addrs.append(addr)
     if addresses:
         rec["addresses"] = addresses
@@ -435,9 +439,11 @@ def merge_host_docs(rec1, rec2):
                 curport['scripts'] = curport['scripts'][:]
             else:
                 curport['scripts'] = []
-            present_scripts = set(
-                script['id'] for script in curport['scripts']
-            )
+            # Index the scripts by id once (keep the first one, as
+            # there should be only one script per id)
+            present_scripts = {}
+            for script in curport['scripts']:
+                present_scripts.setdefault(script['id'], script)
             for script in port.get("scripts", []):
                 if script['id'] not in present_scripts:
                     curport['scripts'].append(script)
@@ -448,9 +454,8 @@ def merge_host_docs(rec1, rec2):
                                        'ssl-cacert',
                                        'ssl-cert']):
                     # Merge scripts
-                    curscript = next(x for x in curport['scripts']
-                                     if x['id'] == script['id'])
-                    merge_scripts(curscript, script, script['id'])
+                    merge_scripts(present_scripts[script['id']], script,
+                                  script['id'])
             if not curport['scripts']:
                 del curport['scripts']
             if 'service_name' in port:
@@ -39,9 +39,21 @@ DB = "mongodb:///ivre"
 DB_DATA = None  # specific: maxmind:///<ivre_share_path>/geoip
 # Begin batch sizes
 LOCAL_BATCH_SIZE = 10000      # used with --local-bulk
+LOCAL_BATCH_BYTES = 256 * 1024 * 1024  # used with --local-bulk
 MONGODB_BATCH_SIZE = 100
+MONGODB_BATCH_BYTES = 16 * 1024 * 1024  # max. size of a host insert batch
+MONGODB_FLOW_BATCH_SIZE = 100000  # flows aggregated before upserts
+FLOW_BATCH_SIZE = 100000  # flow records per bulk commit
+FLOW_CLEANUP_BATCH_SIZE = 1000  # host pairs per incremental flow cleanup
+FLOW_ROLLUP_BATCH_SIZE = 1000  # flows or documents per rollup query
 POSTGRES_BATCH_SIZE = 10000
+DATA_BATCH_SIZE = 1000  # addresses per IP data (GeoIP, AS) lookup
+VIEW_BATCH_SIZE = 1000  # hosts per view merge batch
 # End batch sizes
+# Max. size (estimated memory use, in bytes, of the payloads and the
+# parsed results) of each cache used to avoid parsing the same banners
+# and SSH keys again when inserting passive records
+PASSIVE_CACHE_SIZE = 16 * 1024 * 1024
 # specific: if no value is specified for *_PATH variables, they are
 # going to be constructed by guessing the installation PREFIX (see the
 # end of this file).
@@ -55,6 +67,9 @@ AGENT_MASTER_PATH = "/var/lib/ivre/master"
 # /opt/nmap/share/nmap, then /usr/share/nmap; same for wireshark.
 NMAP_SHARE_PATH = None
 WIRESHARK_SHARE_PATH = None
+# specific: if no value is specified, $XDG_CACHE_HOME/ivre (or
+# ~/.cache/ivre) is used; set to False to disable on-disk caches.
+CACHE_PATH = None
 # Begin commands
 TESSERACT_CMD = "tesseract"
 GZ_CMD = "zcat"
@@ -301,3 +316,11 @@ if NMAP_SHARE_PATH is None:
 
 if WIRESHARK_SHARE_PATH is None:
     WIRESHARK_SHARE_PATH = guess_share('wireshark')
+
+
+if CACHE_PATH is None:
+    CACHE_PATH = os.path.join(
+        os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                    '.cache'),
+        'ivre',
+    )
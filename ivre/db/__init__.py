@@ -24,10 +24,13 @@ backends.
 
 from argparse import ArgumentParser
 from collections import OrderedDict
+import copy
 from datetime import datetime, timedelta
 from functools import reduce
 from importlib import import_module
+from itertools import islice
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import pickle
 import pipes
@@ -44,7 +47,6 @@ try:
 except ImportError:
     from urlparse import urlparse
 import uuid
-import xml.sax
 
 
 from builtins import range
@@ -85,6 +87,9 @@ class DB(object):
 
     """
     globaldb = None
+    # False for the backends that cannot be written to by several
+    # processes at the same time (e.g., file-based backends)
+    concurrent_writes = True
     ipaddr_fields = []
     datetime_fields = []
     list_fields = []
@@ -1754,7 +1759,14 @@ class DBNmap(DBActive):
                     raise ValueError("Unknown file type %s" % fname)
             else:
                 raise ValueError("Unknown file type %s" % fname)
-        return store_scan_function(fname, filehash=scanid, **kargs)
+        try:
+            return store_scan_function(fname, filehash=scanid, **kargs)
+        except Exception:
+            # Hosts may have been buffered by the backend (see
+            # .start_store_hosts()): store them before reporting the
+            # error.
+            self.stop_store_hosts()
+            raise
 
     def store_scan_xml(self, fname, callback=None, **kargs):
         """This method parses an XML scan result, displays a JSON
@@ -1770,7 +1782,6 @@ class DBNmap(DBActive):
         if no action has to be taken.
 
         """
-        parser = xml.sax.make_parser()
         self.start_store_hosts()
         try:
             content_handler = self.content_handler(fname, **kargs)
@@ -1778,11 +1789,12 @@ class DBNmap(DBActive):
             utils.LOGGER.warning('Exception (file %r)', fname, exc_info=True)
         else:
             content_handler.callback = callback
-            parser.setContentHandler(content_handler)
-            parser.setEntityResolver(xmlnmap.NoExtResolver())
-            parser.setFeature(xml.sax.handler.feature_external_ges, 0)
-            parser.setFeature(xml.sax.handler.feature_external_pes, 0)
-            parser.parse(utils.open_file(fname))
+            try:
+                with utils.open_file(fname) as fdesc:
+                    xmlnmap.parse_xml(content_handler, fdesc)
+            finally:
+                # Store the hosts the handler may have buffered
+                content_handler._flushhosts()
             if self.output_function is not None:
                 self.output_function(content_handler._db, out=self.output)
             self.stop_store_hosts()
@@ -2233,6 +2245,24 @@ class DBView(DBActive):
     def merge_host_docs(rec1, rec2):
         return merge_host_docs(rec1, rec2)
 
+    def get_watermark(self, name):
+        """Returns the watermark `name` (a datetime.datetime instance)
+        stored with the view, or None if it does not exist.
+
+        Watermarks are used by `ivre db2view --incremental` to remember
+        which records (e.g., "nmap" and "passive") have already been
+        merged in the view.
+
+        """
+        raise NotImplementedError
+
+    def set_watermark(self, name, value):
+        """Stores the watermark `name` (a datetime.datetime instance)
+        with the view. See .get_watermark().
+
+        """
+        raise NotImplementedError
+
     def merge_host(self, host):
         """Attempt to merge `host` with an existing record.
 
@@ -2253,6 +2283,42 @@ class DBView(DBActive):
         self.remove(rec)
         return True
 
+    def store_or_merge_hosts(self, hosts):
+        """Stores the hosts from the iterable `hosts`, merging them with
+        the existing records for the same addresses (see
+        .store_or_merge_host()).
+
+        The hosts are handled by batches of (at most)
+        config.VIEW_BATCH_SIZE records (hosts with the same address
+        within a batch are merged first) so that the backends can fetch
+        the existing records and write the results with one operation
+        per batch. Returns the number of hosts read from `hosts`.
+
+        """
+        hosts = iter(hosts)
+        count = 0
+        while True:
+            batch = OrderedDict()
+            for host in islice(hosts, config.VIEW_BATCH_SIZE):
+                count += 1
+                key = utils.ip2bin(host['addr'])
+                if key in batch:
+                    batch[key] = self.merge_host_docs(batch[key], host)
+                else:
+                    batch[key] = host
+            if not batch:
+                return count
+            self._store_or_merge_hosts(list(viewvalues(batch)))
+
+    def _store_or_merge_hosts(self, hosts):
+        """Stores or merges a batch of hosts (a list with at most one
+        host per address). Backends should override this method to
+        fetch and write the records with bulk operations.
+
+        """
+        for host in hosts:
+            self.store_or_merge_host(host)
+
     @classmethod
     def _searchja3(cls, value_or_hash, script_id, neg):
         if not value_or_hash:
@@ -2283,12 +2349,13 @@ class DBView(DBActive):
 
 
 class _RecInfo(object):
-    __slots__ = ["count", "firstseen", "infos", "lastseen"]
+    __slots__ = ["count", "firstseen", "infos", "lastseen", "size"]
 
-    def __init__(self, infos):
+    def __init__(self, infos, size=0):
         self.count = 0
         self.firstseen = self.lastseen = None
         self.infos = infos
+        self.size = size
 
     @property
     def data(self):
@@ -2298,7 +2365,7 @@ class _RecInfo(object):
         return data
 
     def update_from_spec(self, spec):
-        self.count += spec.get('count')
+        self.count += spec.get('count', 1)
         firstseen = spec.get('firstseen')
         if firstseen is not None:
             if self.firstseen is None:
@@ -2310,7 +2377,7 @@ class _RecInfo(object):
             if self.lastseen is None:
                 self.lastseen = lastseen
             else:
-                self.lastseen = min(self.lastseen, lastseen)
+                self.lastseen = max(self.lastseen, lastseen)
 
     def update(self, timestamp):
         self.count += 1
@@ -2457,32 +2524,76 @@ class DBPassive(DB):
     def insert_or_update_local_bulk(self, specs, getinfos=None,
                                     separated_timestamps=True):
         """Like `.insert_or_update()`, but `specs` parameter has to be an
-        iterable of (timestamp, spec) values. This generic
-        implementation does not use the bulk capacity of the
-        underlying DB implementation but uses a local cache and calls
-        its `.insert_or_update()` method.
+        iterable of (timestamp, spec) values. This implementation
+        aggregates identical records in a local cache, and uses
+        `.insert_or_update_bulk()` to write them to the database.
+
+        The cache holds at most config.LOCAL_BATCH_SIZE records and
+        config.LOCAL_BATCH_BYTES bytes (estimated size of the
+        records). When it is full, the least recently seen records are
+        written until it is half-full.
 
         """
-        def _bulk_execute(records):
-            utils.LOGGER.debug("DB:local bulk upsert: %d", len(records))
-            for spec, metadata in viewitems(records):
-                self.insert_or_update(metadata.firstseen,
-                                      dict(spec, **metadata.data),
-                                      getinfos=getinfos,
-                                      lastseen=metadata.lastseen)
-        records = {}
-        utils.LOGGER.debug("DB: creating a local bulk upsert (%d records)",
-                           config.LOCAL_BATCH_SIZE)
+        records = OrderedDict()
+        # [total size of the records]; a list so that the nested
+        # functions can update it
+        size = [0]
+
+        def _bulk_execute(count):
+            """Writes (and removes from the cache) the `count` least
+            recently seen records.
+
+            """
+            utils.LOGGER.debug("DB:local bulk upsert: %d", count)
+
+            def _gen():
+                for _ in range(count):
+                    spec, metadata = records.popitem(last=False)
+                    size[0] -= metadata.size
+                    yield dict(spec, firstseen=metadata.firstseen,
+                               lastseen=metadata.lastseen, **metadata.data)
+            self.insert_or_update_bulk(_gen(), getinfos=getinfos,
+                                       separated_timestamps=False)
+
+        def _get_record(spec, infos):
+            """Returns the cache entry for `spec` (created if needed) and
+            marks it as the most recently seen.
+
+            """
+            try:
+                metadata = records.pop(spec)
+            except KeyError:
+                metadata = _RecInfo(infos,
+                                    size=len(repr(spec)) + len(repr(infos)))
+                size[0] += metadata.size
+            records[spec] = metadata
+            return metadata
+
+        def _check_size():
+            if (
+                    len(records) < config.LOCAL_BATCH_SIZE and
+                    size[0] < config.LOCAL_BATCH_BYTES
+            ):
+                return
+            count = flushed = 0
+            for metadata in viewvalues(records):
+                if count >= len(records) // 2 and flushed >= size[0] // 2:
+                    break
+                count += 1
+                flushed += metadata.size
+            _bulk_execute(count)
+
+        utils.LOGGER.debug("DB: creating a local bulk upsert (%d records, "
+                           "%d bytes)", config.LOCAL_BATCH_SIZE,
+                           config.LOCAL_BATCH_BYTES)
         if separated_timestamps:
             for timestamp, spec in specs:
                 if spec is None:
                     continue
                 infos = spec.pop('infos', None)
                 spec = tuple((key, spec[key]) for key in sorted(spec))
-                records.setdefault(spec, _RecInfo(infos)).update(timestamp)
-                if len(records) >= config.LOCAL_BATCH_SIZE:
-                    _bulk_execute(records)
-                    records = {}
+                _get_record(spec, infos).update(timestamp)
+                _check_size()
         else:
             for spec in specs:
                 if spec is None:
@@ -2492,12 +2603,10 @@ class DBPassive(DB):
                     (key, spec[key]) for key in sorted(spec)
                     if key not in ['count', 'firstseen', 'lastseen']
                 )
-                records.setdefault(basespec,
-                                   _RecInfo(infos)).update_from_spec(spec)
-                if len(records) >= config.LOCAL_BATCH_SIZE:
-                    _bulk_execute(records)
-                    records = {}
-        _bulk_execute(records)
+                _get_record(basespec, infos).update_from_spec(spec)
+                _check_size()
+        if records:
+            _bulk_execute(len(records))
 
     def _features_port_get(self, features, flt, yieldall, use_service,
                            use_product, use_version):
@@ -2647,6 +2756,46 @@ class DBData(DB):
             return infos
         return None
 
+    def infos_byip_many(self, addrs, addr_type=True):
+        """Like .infos_byip(), for an iterable of addresses. Returns a
+        list of results, in the same order as `addrs`.
+
+        When `addr_type` is False, the "address_type" value is not
+        included in the results.
+
+        Repeated addresses are only looked up once, and the lookups
+        happen in the addresses order, so that backends can share work
+        between neighbor addresses (see ._infos_byip_sorted()).
+
+        """
+        addrs = list(addrs)
+        uniq_addrs = sorted(set(addrs), key=utils.force_ip2int)
+        results = dict(zip(uniq_addrs,
+                           self._infos_byip_sorted(uniq_addrs)))
+        if not addr_type:
+            for infos in viewvalues(results):
+                if infos:
+                    infos.pop('address_type', None)
+        output = []
+        seen = set()
+        for addr in addrs:
+            infos = results[addr] or None
+            if addr in seen:
+                infos = copy.deepcopy(infos)
+            else:
+                seen.add(addr)
+            output.append(infos)
+        return output
+
+    def _infos_byip_sorted(self, addrs):
+        """Yields the .infos_byip() results for the unique, sorted
+        addresses `addrs`. Backends may override this method to share
+        work between consecutive addresses.
+
+        """
+        for addr in addrs:
+            yield self.infos_byip(addr)
+
     def as_byip(self, addr):
         raise NotImplementedError
 
@@ -3120,6 +3269,46 @@ class DBFlow(DB):
             return datetime.fromtimestamp(ts)
         return ts
 
+    def bulk_insert(self, func, records, size=None):
+        """
+        Calls func(bulk, rec) for each record from `records`, using
+        bulks of (at most) `size` records (config.FLOW_BATCH_SIZE by
+        default). Each bulk is committed by a background thread while
+        the next one is filled; at most one commit is pending.
+        Returns the number of records.
+        """
+        if size is None:
+            size = config.FLOW_BATCH_SIZE
+        pool = ThreadPool(1)
+        pending = None
+        total = 0
+        try:
+            records = iter(records)
+            while True:
+                bulk = self.start_bulk_insert()
+                count = 0
+                for rec in islice(records, size):
+                    func(bulk, rec)
+                    count += 1
+                if pending is not None:
+                    # re-raises the exceptions from the commit thread
+                    pending.get()
+                    pending = None
+                if not count:
+                    break
+                total += count
+                utils.LOGGER.debug("Committing a bulk of %d records (total "
+                                   "%d)", count, total)
+                pending = pool.apply_async(self.bulk_commit, (bulk,))
+                if count < size:
+                    break
+            if pending is not None:
+                pending.get()
+        finally:
+            pool.close()
+            pool.join()
+        return total
+
     @classmethod
     def from_filters(cls, filters, limit=None, skip=0, orderby="", mode=None,
                      timeline=False, after=None, before=None, precision=None):
@@ -3190,6 +3379,12 @@ class DBFlow(DB):
         """
         raise NotImplementedError("Only available with MongoDB backend.")
 
+    def rebuild_rollups(self):
+        """
+        Computes again the rollup collections from the flows.
+        """
+        raise NotImplementedError("Only available with MongoDB backend.")
+
     def count(self, flt):
         """
         Returns a dict {'client': nb_clients, 'servers': nb_servers',
@@ -3586,6 +3781,20 @@ class MetaDB(object):
         self._view = self.get_class("view")
         return self._view
 
+    def reset(self):
+        """Drops the purpose-specific database objects, so that new
+        ones (with their own connections) get created when they are
+        needed. This is useful in a child process (e.g., a
+        multiprocessing.Pool worker), which must not use the
+        connections of its parent.
+
+        """
+        for purpose in self.db_types:
+            try:
+                delattr(self, "_%s" % purpose)
+            except AttributeError:
+                pass
+
     def get_class(self, purpose):
         url = self.urls.get(purpose, self.url)
         if url is not None:
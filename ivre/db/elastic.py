@@ -157,7 +157,10 @@ class ElasticDB(DB):
 
     @classmethod
     def searchhosts(cls, hosts, neg=False):
-        pass
+        res = Q('terms', addr=list(hosts))
+        if neg:
+            return ~res
+        return res
 
     @staticmethod
     def _get_pattern(regexp):
@@ -1149,3 +1152,32 @@ class ElasticDBView(ElasticDBActive, DBView):
     def store_or_merge_host(self, host):
         if not self.merge_host(host):
             self.store_host(host)
+
+    def _store_or_merge_hosts(self, hosts):
+        """Fetches the existing records for `hosts` with one query,
+        merges them locally and writes the results with one bulk
+        operation. Merged records replace the existing documents (same
+        _id).
+
+        """
+        existing = {}
+        for rec in self.get(self.searchhosts([host['addr']
+                                              for host in hosts])):
+            existing.setdefault(utils.ip2bin(rec['addr']), rec)
+        actions = []
+        for host in hosts:
+            action = {'_index': self.indexes[0]}
+            rec = existing.get(utils.ip2bin(host['addr']))
+            if rec is not None:
+                host = self.merge_host_docs(rec, host)
+                action['_id'] = rec['_id']
+            # _id is a metadata field and cannot be part of the
+            # document body (the records from .get() have one)
+            host.pop('_id', None)
+            if 'coordinates' in host.get('infos', {}):
+                host['infos']['coordinates'] = host['infos'][
+                    'coordinates'
+                ][::-1]
+            action['_source'] = host
+            actions.append(action)
+        helpers.bulk(self.db_client, actions)
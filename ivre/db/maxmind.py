@@ -23,14 +23,15 @@ files.
 
 
 import codecs
-from functools import partial, reduce
+from functools import partial
+import mmap
 from multiprocessing import Pool
 import os
 import sys
 import struct
 
 
-from builtins import object, range
+from builtins import int, object, range, zip
 from future.utils import viewitems
 
 
@@ -38,53 +39,6 @@ from ivre import config, utils
 from ivre.db import DBData
 
 
-class MaxMindFileIter(object):
-
-    """Iterator for MaxMindFile"""
-
-    def __init__(self, base):
-        self.base = base
-        self.current = []
-        self.nextval = 0
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.nextval is None:
-            raise StopIteration()
-        node_no = 0
-        for i in range(96 if self.base.ip_version == 4 else 0, 128):
-            try:
-                flag = self.current[i]
-            except IndexError:
-                flag = self.nextval
-                self.current.append(self.nextval)
-                self.nextval = 0
-            next_node_no = self.base.read_record(node_no, flag)
-            if next_node_no == 0:
-                raise Exception('Invalid file format')
-            if next_node_no >= self.base.node_count:
-                pos = (next_node_no - self.base.node_count -
-                       self.base.DATA_SECTION_SEPARATOR_SIZE)
-                curvalinf = int(''.join(str(p) for p in self.current) +
-                                '0' * (128 - len(self.current)), 2)
-                curvalsup = int(''.join(str(p) for p in self.current) +
-                                '1' * (128 - len(self.current)), 2)
-                try:
-                    while self.current.pop():
-                        pass
-                except IndexError:
-                    self.nextval = None
-                else:
-                    self.current.append(1)
-                return (curvalinf, curvalsup,
-                        self.base.decode(pos, self.base.data_section_start)[1])
-            node_no = next_node_no
-        # We should never reach this point if the file is properly formatted.
-        raise StopIteration()
-
-
 class EmptyMaxMindFile(object):
 
     """Stub to replace MaxMind databases parsers. Used when a file is
@@ -98,6 +52,10 @@ missing to emit a warning message and return empty results.
     def lookup(self, _):
         return {}
 
+    def lookup_many(self, ips):
+        for _ in ips:
+            yield {}
+
 
 class MaxMindFile(object):
 
@@ -106,48 +64,80 @@ class MaxMindFile(object):
     Code copied and adapted from
     https://github.com/yhirose/maxminddb/blob/master/lib/maxminddb.rb
 
+    The file is memory-mapped (when possible), so that its pages are
+    shared by every process using the same database file.
+
     """
 
     METADATA_BEGIN_MARKER = b'\xab\xcd\xefMaxMind.com'
     DATA_SECTION_SEPARATOR_SIZE = 16
     SIZE_BASE_VALUES = [0, 29, 285, 65821]
     POINTER_BASE_VALUES = [0, 0, 2048, 526336]
+    # Number of decoded data records kept by .lookup()
+    CACHE_SIZE = 65536
 
     def __init__(self, path):
         self.path = path
         self._data = None
-        pos = (self.data.rindex(self.METADATA_BEGIN_MARKER) +
-               len(self.METADATA_BEGIN_MARKER))
+        self._cache = None
+        self._ipv4_start = None
+        pos = self.data.rfind(self.METADATA_BEGIN_MARKER)
+        if pos == -1:
+            raise ValueError('Invalid file format: cannot find metadata')
+        pos += len(self.METADATA_BEGIN_MARKER)
         metadata = self.metadata = self.decode(pos, 0)[1]
         self.ip_version = metadata['ip_version']
         self.node_count = metadata['node_count']
-        self.node_byte_size = metadata['record_size'] * 2 // 8
+        self.record_size = metadata['record_size']
+        if self.record_size not in [24, 28, 32]:
+            raise ValueError('Invalid file format: unsupported record size '
+                             '%d' % self.record_size)
+        self.node_byte_size = self.record_size * 2 // 8
         self.search_tree_size = self.node_count * self.node_byte_size
         self.data_section_start = (self.search_tree_size +
                                    self.DATA_SECTION_SEPARATOR_SIZE)
 
+    def __getstate__(self):
+        """The memory map and the cache are not pickled (e.g., to be
+        sent to a multiprocessing.Pool worker); they will be created
+        again when needed.
+
+        """
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_cache'] = None
+        return state
+
     @property
     def data(self):
         if self._data is None:
             with open(self.path, 'rb') as fdesc:
-                self._data = fdesc.read()
+                try:
+                    self._data = mmap.mmap(fdesc.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                except (ValueError, mmap.error):
+                    # e.g., empty file or mmap() not supported
+                    self._data = fdesc.read()
         return self._data
 
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = utils.LRUCache(
+                self.CACHE_SIZE,
+                name="%s cache" % os.path.basename(self.path),
+            )
+        return self._cache
+
     def read_byte(self, pos):
-        return ord(self.data[pos:pos + 1])
+        return struct.unpack_from('B', self.data, pos)[0]
 
     def read_value(self, pos, size):
-        return reduce(
-            lambda x, y: (x << 8) + y,
-            struct.unpack(
-                '%dB' % size,
-                self.data[pos:pos + size],
-            ),
-            0,
-        )
+        return int.from_bytes(self.data[pos:pos + size], 'big')
 
     def decode(self, pos, base_pos):
-        ctrl = ord(self.data[pos + base_pos:pos + base_pos + 1])
+        data = self.data
+        ctrl = struct.unpack_from('B', data, pos + base_pos)[0]
         pos += 1
         type_ = ctrl >> 5
         if type_ == 1:
@@ -160,7 +150,7 @@ class MaxMindFile(object):
             return pos + size, self.decode(pointer, base_pos)[1]
         if type_ == 0:
             # extended type
-            type_ = 7 + self.read_byte(pos + base_pos)
+            type_ = 7 + struct.unpack_from('B', data, pos + base_pos)[0]
             pos += 1
         size = ctrl & 0x1f
         if size >= 29:
@@ -170,21 +160,19 @@ class MaxMindFile(object):
             size = val + self.SIZE_BASE_VALUES[byte_size]
         if type_ == 2:
             # utf8
-            val = self.data[
-                pos + base_pos:pos + base_pos + size
-            ].decode('utf-8')
+            val = data[pos + base_pos:pos + base_pos + size].decode('utf-8')
             pos += size
-        elif type_ in [3, 15]:
+        elif type_ == 3:
             # double
+            val = struct.unpack_from('>d', data, pos + base_pos)[0]
+            pos += size
+        elif type_ == 15:
             # float
-            val = struct.unpack(
-                {3: '>d', 15: '>f'}[type_],
-                self.data[pos + base_pos:pos + base_pos + size],
-            )[0]
+            val = struct.unpack_from('>f', data, pos + base_pos)[0]
             pos += size
         elif type_ == 4:
             # bytes
-            val = self.data[pos + base_pos:pos + base_pos + size]
+            val = data[pos + base_pos:pos + base_pos + size]
             pos += size
         elif type_ in [5, 6, 9, 10]:
             # unsigned 16-bit int
@@ -202,11 +190,9 @@ class MaxMindFile(object):
                 val[k] = v
         elif type_ == 8:
             # signed 32-bit int
-            v1 = struct.unpack(
-                '>i', self.data[pos + base_pos:pos + base_pos + size]
-            )[0]
-            bits = size * 8
-            val = (v1 & ~(1 << bits)) - (v1 & (1 << bits))
+            val = self.read_value(pos + base_pos, size)
+            if size == 4 and val & 0x80000000:
+                val -= 0x100000000
             pos += size
         elif type_ == 11:
             # array
@@ -228,40 +214,175 @@ class MaxMindFile(object):
             raise Exception('TODO type == %d (unknown)' % type_)
         return pos, val
 
-    def read_record(self, node_no, flag):
-        rec_byte_size = self.node_byte_size // 2
+    def read_node(self, node_no):
+        """Returns the (left, right) records of node `node_no`."""
         pos = self.node_byte_size * node_no
-        middle = (self.read_byte(pos + rec_byte_size)
-                  if self.node_byte_size % 2 else 0)
-        if flag == 0:  # left
-            val = self.read_value(pos, rec_byte_size)
-            val += ((middle & 0xf0) << 20) if middle else 0
-        else:  # right
-            val = self.read_value(pos + self.node_byte_size - rec_byte_size,
-                                  rec_byte_size)
-            val += ((middle & 0xf) << 24) if middle else 0
-        return val
+        if self.record_size == 24:
+            left1, left2, right1, right2 = struct.unpack_from(
+                '>BHBH', self.data, pos
+            )
+            return (left1 << 16) | left2, (right1 << 16) | right2
+        if self.record_size == 28:
+            left, middle, right = struct.unpack_from('>3sB3s', self.data,
+                                                     pos)
+            return (((middle & 0xf0) << 20) | int.from_bytes(left, 'big'),
+                    ((middle & 0x0f) << 24) | int.from_bytes(right, 'big'))
+        return struct.unpack_from('>II', self.data, pos)
+
+    def read_record(self, node_no, flag):
+        return self.read_node(node_no)[flag]
 
     def __repr__(self):
         return '<%s from %s>' % (self.__class__.__name__, self.path)
 
+    def _walk(self, node_no, addr, depth):
+        """Walks the tree from `node_no`, following the `depth` lowest
+        bits of `addr`. Returns the (record, remaining depth) tuple,
+        where the record is either a data pointer (greater than or
+        equal to .node_count) or a node number (when remaining depth is
+        0).
+
+        """
+        node_count = self.node_count
+        read_node = self.read_node
+        while depth:
+            depth -= 1
+            node_no = read_node(node_no)[(addr >> depth) & 1]
+            if node_no >= node_count:
+                return node_no, depth
+            if node_no == 0:
+                raise Exception('Invalid file format')
+        return node_no, depth
+
+    @property
+    def ipv4_start(self):
+        """The record reached from the root of an IPv6 tree when
+        following the 96 (zero) bits of an IPv4 address in ::/96.
+
+        """
+        if self._ipv4_start is None:
+            if self.ip_version == 4:
+                self._ipv4_start = 0
+            else:
+                self._ipv4_start = self._walk(0, 0, 96)[0]
+        return self._ipv4_start
+
+    def decode_record(self, record):
+        """Returns the data pointed by `record`, decoded (without using
+        the cache).
+
+        """
+        if record == self.node_count:
+            # No data
+            return {}
+        return self.decode(
+            record - self.node_count - self.DATA_SECTION_SEPARATOR_SIZE,
+            self.data_section_start,
+        )[1]
+
+    def get_data(self, record):
+        """Returns the (decoded) data pointed by `record`. The values
+        are cached and should not be modified.
+
+        """
+        result = self.cache.get(record)
+        if result is None:
+            result = self.cache[record] = self.decode_record(record)
+        return result
+
     def lookup(self, ip):
-        node_no = 0
+        """Returns the data for `ip`. The values are cached and should
+        not be modified.
+
+        """
         addr = utils.force_ip2int(ip)
-        for i in range(96 if self.ip_version == 4 else 0, 128):
-            flag = (addr >> (127 - i)) & 1
-            next_node_no = self.read_record(node_no, flag)
-            if next_node_no == 0:
+        if self.ip_version == 4 or addr <= 0xffffffff:
+            node_no, depth = self.ipv4_start, 32
+        else:
+            node_no, depth = 0, 128
+        if node_no < self.node_count:
+            node_no, depth = self._walk(node_no, addr, depth)
+        if node_no < self.node_count:
+            raise Exception('Invalid file format')
+        return self.get_data(node_no)
+
+    def lookup_many(self, ips):
+        """Yields the data for each address in `ips`, like .lookup()
+        would. The walk in the search tree is shared between
+        consecutive addresses with a common prefix, so this is
+        (much) faster than .lookup() when `ips` is sorted.
+
+        """
+        node_count = self.node_count
+        read_node = self.read_node
+        prev_addr = prev_bits = None
+        path = []
+        for ip in ips:
+            addr = utils.force_ip2int(ip)
+            if self.ip_version == 4 or addr <= 0xffffffff:
+                bits = 32
+            else:
+                bits = 128
+            if bits == prev_bits:
+                # Number of leading bits shared with the previous
+                # address
+                common = max(bits - (addr ^ prev_addr).bit_length(), 0)
+                if common >= len(path) - 1:
+                    # Same record as the previous address
+                    prev_addr = addr
+                    yield self.get_data(path[-1])
+                    continue
+                del path[common + 1:]
+            else:
+                path = [self.ipv4_start if bits == 32 else 0]
+            prev_addr, prev_bits = addr, bits
+            node_no = path[-1]
+            depth = bits - len(path) + 1
+            while depth and node_no < node_count:
+                depth -= 1
+                node_no = read_node(node_no)[(addr >> depth) & 1]
+                if node_no == 0:
+                    raise Exception('Invalid file format')
+                path.append(node_no)
+            if node_no < node_count:
                 raise Exception('Invalid file format')
-            if next_node_no >= self.node_count:
-                pos = (next_node_no - self.node_count -
-                       self.DATA_SECTION_SEPARATOR_SIZE)
-                return self.decode(pos, self.data_section_start)[1]
-            node_no = next_node_no
-        raise Exception('Invalid file format')
+            yield self.get_data(node_no)
+
+    def iter_records(self, ipv4_only=False):
+        """Yields a (start, stop, record) tuple for each leaf of the
+        search tree, in the addresses order. `start` and `stop` are
+        the first and last addresses (as integers) of the range, and
+        `record` is a data pointer (see .get_data()).
+
+        When `ipv4_only` is True, only the IPv4 part of the tree is
+        walked.
+
+        """
+        node_count = self.node_count
+        read_node = self.read_node
+        if ipv4_only or self.ip_version == 4:
+            stack = [(self.ipv4_start, 0, 32)]
+        else:
+            stack = [(0, 0, 128)]
+        # Depth-first traversal: the right child is pushed first so
+        # that the left one (lower addresses) is popped first.
+        while stack:
+            node_no, start, depth = stack.pop()
+            if node_no >= node_count:
+                yield start, start + (1 << depth) - 1, node_no
+                continue
+            if not depth:
+                raise Exception('Invalid file format')
+            depth -= 1
+            left, right = read_node(node_no)
+            if not (left and right):
+                raise Exception('Invalid file format')
+            stack.append((right, start | (1 << depth), depth))
+            stack.append((left, start, depth))
 
     def __iter__(self):
-        return MaxMindFileIter(self)
+        for start, stop, record in self.iter_records():
+            yield start, stop, self.get_data(record)
 
     @staticmethod
     def _get_fields(rec, fields):
@@ -286,24 +407,38 @@ class MaxMindFile(object):
                     break
             yield val
 
-    def _get_ranges(self, fields):
-        gen = iter(self)
+    def _get_ranges(self, fields, ipv4_only=False):
+        # Many ranges point to the same record: the fields values are
+        # cached by record
+        cache = {}
+
+        def get_fields(record):
+            try:
+                return cache[record]
+            except KeyError:
+                value = cache[record] = tuple(
+                    self._get_fields(self.decode_record(record), fields)
+                )
+                return value
+
+        gen = self.iter_records(ipv4_only=ipv4_only)
         try:
-            start, stop, rec = next(gen)
+            start, stop, record = next(gen)
         except StopIteration:
             return
-        rec = tuple(self._get_fields(rec, fields))
-        for n_start, n_stop, n_rec in gen:
-            n_rec = tuple(self._get_fields(n_rec, fields))
-            if n_start <= stop + 1 and n_rec == rec:
-                stop = n_stop
-            else:
-                yield (start, stop) + rec
-                start, stop, rec = n_start, n_stop, n_rec
+        rec = get_fields(record)
+        for n_start, n_stop, n_record in gen:
+            if n_record != record:
+                record = n_record
+                n_rec = get_fields(record)
+                if n_rec != rec:
+                    yield (start, stop) + rec
+                    start, rec = n_start, n_rec
+            stop = n_stop
         yield (start, stop) + rec
 
-    def get_ranges(self, fields, cond=None):
-        for rec in self._get_ranges(fields):
+    def get_ranges(self, fields, cond=None, ipv4_only=False):
+        for rec in self._get_ranges(fields, ipv4_only=ipv4_only):
             if cond is None or cond(rec):
                 yield rec
 
@@ -358,13 +493,18 @@ class MaxMindDBData(DBData):
                 setattr(self, "_db_%s" % name, subdb)
 
     def as_byip(self, addr):
+        return self._as_infos(self.db_asn.lookup(addr))
+
+    def _as_infos(self, raw):
         return dict(
             (self.AS_KEYS.get(key, key), value)
-            for key, value in viewitems(self.db_asn.lookup(addr))
+            for key, value in viewitems(raw)
         )
 
     def location_byip(self, addr):
-        raw = self.db_city.lookup(addr)
+        return self._location_infos(self.db_city.lookup(addr))
+
+    def _location_infos(self, raw):
         result = {}
         sub = raw.get('subdivisions')
         if sub:
@@ -414,8 +554,10 @@ class MaxMindDBData(DBData):
         return None
 
     def country_byip(self, addr):
+        return self._country_infos(self.db_country.lookup(addr))
+
+    def _country_infos(self, raw):
         result = {}
-        raw = self.db_country.lookup(addr)
         sub = raw.get('country')
         if sub:
             value = sub.get('iso_code')
@@ -426,40 +568,59 @@ class MaxMindDBData(DBData):
                 result['country_name'] = value
         return result
 
+    def _infos_byip_sorted(self, addrs):
+        for addr, as_raw, country_raw, city_raw in zip(
+                addrs,
+                self.db_asn.lookup_many(addrs),
+                self.db_country.lookup_many(addrs),
+                self.db_city.lookup_many(addrs),
+        ):
+            infos = {}
+            addr_type = utils.get_addr_type(addr)
+            if addr_type:
+                infos['address_type'] = addr_type
+            infos.update(self._as_infos(as_raw))
+            infos.update(self._country_infos(country_raw))
+            infos.update(self._location_infos(city_raw) or {})
+            yield infos or None
+
     def dump_as_ranges(self, fdesc):
-        for data in self.db_asn.get_ranges(
+        _write_lines(fdesc, (
+            '%d,%d,%d\n' % data
+            for data in self.db_asn.get_ranges(
                 ["autonomous_system_number"],
                 cond=lambda line: line[2] is not None,
-        ):
-            if data[0] > 0xffffffff:  # only IPv4
-                break
-            fdesc.write('%d,%d,%d\n' % data)
+                ipv4_only=True,
+            )
+        ))
 
     def dump_country_ranges(self, fdesc):
-        for data in self.db_country.get_ranges(
+        _write_lines(fdesc, (
+            '%d,%d,%s\n' % data
+            for data in self.db_country.get_ranges(
                 ["country->iso_code"],
                 cond=lambda line: line[2] is not None,
-        ):
-            if data[0] > 0xffffffff:  # only IPv4
-                break
-            fdesc.write('%d,%d,%s\n' % data)
+                ipv4_only=True,
+            )
+        ))
 
     def dump_city_ranges(self, fdesc):
-        for data in self.db_city.get_ranges(
+        _write_lines(fdesc, (
+            '%d,%d,%s,%s,%s,%s\n' % (
+                data[:4] +
+                (utils.encode_b64((data[4] or
+                                   "").encode('utf-8')).decode('utf-8'),) +
+                data[5:]
+            )
+            for data in self.db_city.get_ranges(
                 ["country->iso_code", "subdivisions->0->iso_code",
                  "city->names->%s" % config.GEOIP_LANG, "city->geoname_id"],
                 cond=lambda line: (line[2] is not None and
                                    (line[3] is not None or
                                     line[4] is not None)),
-        ):
-            if data[0] > 0xffffffff:  # only IPv4
-                break
-            fdesc.write('%d,%d,%s,%s,%s,%s\n' % (
-                data[:4] +
-                (utils.encode_b64((data[4] or
-                                   "").encode('utf-8')).decode('utf-8'),) +
-                data[5:]
-            ))
+                ipv4_only=True,
+            )
+        ))
 
     def build_dumps(self, force=False):
         """Produces CSV dump (.dump-IPv4.csv) files from Maxmind database
@@ -477,6 +638,18 @@ calls to self._build_dump().
             pass
 
 
+def _write_lines(fdesc, lines, count=10000):
+    """Writes `lines` to `fdesc`, `count` lines at a time."""
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= count:
+            fdesc.write(''.join(buf))
+            buf = []
+    if buf:
+        fdesc.write(''.join(buf))
+
+
 def _build_dump(instance, force, attr):
     """Helper function used by MaxMindDBData.build_dumps() to create a
 dump (.dump-IPv4.csv) file from a Maxmind database (.mmdb) file.
@@ -27,6 +27,7 @@ from collections import OrderedDict
 from copy import deepcopy
 import datetime
 import hashlib
+from itertools import islice
 import json
 import os
 import re
@@ -41,8 +42,9 @@ import uuid
 
 
 import bson
+from bson.raw_bson import RawBSONDocument
 from future.builtins import bytes, range, zip
-from future.utils import viewitems, with_metaclass
+from future.utils import viewitems, viewvalues, with_metaclass
 from past.builtins import basestring
 from pymongo.errors import BulkWriteError
 import pymongo
@@ -958,6 +960,9 @@ class MongoDBActive(MongoDB, DBActive):
 
     def __init__(self, url):
         super(MongoDBActive, self).__init__(url)
+        self._bulk_hosts = None
+        self._bulk_hosts_size = 0
+        self._bulk_hosts_failed = []
         self.schema_migrations = [
             # hosts
             {
@@ -1758,6 +1763,8 @@ it is not expected)."""
                 "type": "Point",
                 "coordinates": host['infos'].pop('coordinates')[::-1],
             }
+        if self._bulk_hosts is not None:
+            return self._store_host_bulk(host)
         try:
             ident = self.db[self.columns[self.column_hosts]].insert(host)
         except Exception:
@@ -1768,6 +1775,88 @@ it is not expected)."""
                            self.columns[self.column_hosts])
         return ident
 
+    def start_store_hosts(self):
+        """Creates a buffer so that the following calls to .store_host()
+insert the hosts by batches of (at most) config.MONGODB_BATCH_SIZE
+documents or config.MONGODB_BATCH_BYTES bytes, using unordered
+insert_many() operations.
+
+The identifiers returned by .store_host() are then provisional: use
+the value returned by .flush_store_hosts() or .stop_store_hosts() to
+know which hosts could not be inserted.
+
+        """
+        self.flush_store_hosts()
+        self._bulk_hosts = []
+        self._bulk_hosts_size = 0
+
+    def stop_store_hosts(self):
+        """Inserts the remaining hosts and removes the buffer created by
+.start_store_hosts(). Returns the same value as .flush_store_hosts().
+
+        """
+        failed = self.flush_store_hosts()
+        self._bulk_hosts = None
+        return failed
+
+    def _store_host_bulk(self, host):
+        if '_id' not in host:
+            host['_id'] = bson.ObjectId()
+        # Documents are encoded only once: we need their size and
+        # insert_many() does not re-encode RawBSONDocument instances
+        try:
+            doc = RawBSONDocument(bson.BSON.encode(host))
+        except Exception:
+            utils.LOGGER.warning("Cannot insert host %r", host,
+                                 exc_info=True)
+            self._bulk_hosts_failed.append(host['_id'])
+            return None
+        self._bulk_hosts.append(doc)
+        self._bulk_hosts_size += len(doc.raw)
+        if (len(self._bulk_hosts) >= config.MONGODB_BATCH_SIZE or
+                self._bulk_hosts_size >= config.MONGODB_BATCH_BYTES):
+            self._flush_store_hosts()
+        return host['_id']
+
+    def flush_store_hosts(self):
+        """Inserts the hosts buffered by .store_host() (when
+.start_store_hosts() has been called).
+
+Returns the list of the `_id` values of the hosts that could not be
+inserted since the previous call to .flush_store_hosts() (including
+the batches inserted when the buffer was full).
+
+        """
+        self._flush_store_hosts()
+        failed = self._bulk_hosts_failed
+        self._bulk_hosts_failed = []
+        return failed
+
+    def _flush_store_hosts(self):
+        if not self._bulk_hosts:
+            return
+        hosts = self._bulk_hosts
+        self._bulk_hosts = []
+        self._bulk_hosts_size = 0
+        utils.LOGGER.debug("DB:MongoDB bulk insert: %d", len(hosts))
+        try:
+            self.db[self.columns[self.column_hosts]].insert_many(
+                hosts, ordered=False,
+            )
+        except BulkWriteError as exc:
+            for error in exc.details.get('writeErrors', []):
+                ident = hosts[error['index']]['_id']
+                utils.LOGGER.warning("Cannot insert host %r: %s", ident,
+                                     error.get('errmsg'))
+                self._bulk_hosts_failed.append(ident)
+        except Exception:
+            utils.LOGGER.warning("Cannot insert %d hosts", len(hosts),
+                                 exc_info=True)
+            self._bulk_hosts_failed.extend(host['_id'] for host in hosts)
+        else:
+            utils.LOGGER.debug("HOSTS STORED: %d in %r", len(hosts),
+                               self.columns[self.column_hosts])
+
     def merge_host_docs(self, rec1, rec2):
         """Merge two host records and return the result. Unmergeable /
         hard-to-merge fields are lost (e.g., extraports).
@@ -2350,6 +2439,12 @@ it is not expected)."""
             )
         return {'endtime': {'$gte': start}, 'starttime': {'$lte': stop}}
 
+    @staticmethod
+    def searchnewer(timestamp, neg=False):
+        if not isinstance(timestamp, datetime.datetime):
+            timestamp = datetime.datetime.fromtimestamp(timestamp)
+        return {'endtime': {'$lte' if neg else '$gt': timestamp}}
+
     @classmethod
     def searchhop(cls, hop, ttl=None, neg=False):
         try:
@@ -3409,11 +3504,71 @@ class MongoDBView(MongoDBActive, DBView):
     def __init__(self, url):
         super(MongoDBView, self).__init__(url)
         self.columns = [self.params.pop('colname_hosts', 'views')]
+        self.colname_watermarks = self.params.pop('colname_watermarks',
+                                                  'views_watermarks')
+
+    def init(self):
+        super(MongoDBView, self).init()
+        self.db[self.colname_watermarks].drop()
 
     def store_or_merge_host(self, host):
         if not self.merge_host(host):
             self.store_host(host)
 
+    def _store_or_merge_hosts(self, hosts):
+        """Fetches the existing records for `hosts` with one query,
+merges them locally, inserts the results using the bulk insert buffer
+(see .start_store_hosts()) and removes the previous records with one
+delete_many() operation.
+
+A previous record is only removed when the merged record that
+replaces it has been inserted.
+
+        """
+        existing = {}
+        for rec in self.get(self.searchhosts([host['addr']
+                                              for host in hosts])):
+            existing.setdefault(utils.ip2bin(rec['addr']), rec)
+        # (new _id, previous _id) for the merged records
+        replaced = []
+        local_bulk = self._bulk_hosts is None
+        if local_bulk:
+            self.start_store_hosts()
+        try:
+            for host in hosts:
+                rec = existing.get(utils.ip2bin(host['addr']))
+                if rec is None:
+                    self.store_host(host)
+                    continue
+                ident = self.store_host(self.merge_host_docs(rec, host))
+                if ident is not None:
+                    replaced.append((ident, rec['_id']))
+        finally:
+            if local_bulk:
+                failed = self.stop_store_hosts()
+            else:
+                # The failures are kept for the next .flush_store_hosts()
+                # call of the caller
+                self._flush_store_hosts()
+                failed = self._bulk_hosts_failed
+        failed = set(failed)
+        previous = [old for new, old in replaced if new not in failed]
+        if previous:
+            self.db[self.columns[self.column_hosts]].delete_many(
+                {'_id': {'$in': previous}}
+            )
+
+    def get_watermark(self, name):
+        rec = self.db[self.colname_watermarks].find_one({'_id': name})
+        if rec is None:
+            return None
+        return rec['value']
+
+    def set_watermark(self, name, value):
+        self.db[self.colname_watermarks].replace_one(
+            {'_id': name}, {'_id': name, 'value': value}, upsert=True,
+        )
+
 
 class MongoDBPassive(MongoDB, DBPassive):
 
@@ -3797,19 +3952,22 @@ setting values according to the keyword arguments.
         if separated_timestamps:
             def generator(specs):
                 for timestamp, spec in specs:
-                    yield timestamp, timestamp, spec
+                    yield timestamp, timestamp, 1, spec
         else:
             def generator(specs):
                 for spec in specs:
+                    if spec is None:
+                        continue
                     firstseen = spec.pop("firstseen", None)
                     lastseen = spec.pop("lastseen", None)
-                    yield firstseen or lastseen, lastseen or firstseen, spec
+                    yield (firstseen or lastseen, lastseen or firstseen,
+                           spec.pop("count", 1), spec)
         try:
-            for firstseen, lastseen, spec in generator(specs):
+            for firstseen, lastseen, count_inc, spec in generator(specs):
                 if spec is None:
                     continue
                 updatespec = {
-                    '$inc': {'count': 1},
+                    '$inc': {'count': count_inc},
                     '$min': {'firstseen': firstseen},
                     '$max': {'lastseen': lastseen},
                 }
@@ -4400,8 +4558,171 @@ scan object on success, and raises a LockError on failure.
                               fields=["_id"])))
 
 
+def _hashable(value):
+    """Returns a hashable version of `value`, used to merge $addToSet
+    values.
+
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(val))
+                            for key, val in viewitems(value)))
+    if isinstance(value, list):
+        return tuple(_hashable(val) for val in value)
+    return value
+
+
+def _flow_key(findspec):
+    """Returns a hashable version of `findspec`, a flow key (see
+    MongoDBFlow._get_flow_key()).
+
+    """
+    return tuple(sorted(viewitems(findspec)))
+
+
+class MongoDBFlowBulk(object):
+    """Pre-aggregates the flow upserts that share the same key (see
+    MongoDBFlow._get_flow_key()): the $inc counters are added, the
+    $min / $max values are computed and the $addToSet values are
+    merged. One upsert per key is sent to MongoDB when `size` keys
+    are pending (config.MONGODB_FLOW_BATCH_SIZE by default) and by
+    .execute().
+
+    The rollup collections of `flowdb` (a MongoDBFlow instance) are
+    updated after each upsert batch (see MongoDBFlow.upserts_rollups()).
+
+    """
+
+    def __init__(self, flowdb, size=None):
+        self.flowdb = flowdb
+        self.collection = flowdb.db[flowdb.columns[flowdb.column_flow]]
+        self.size = config.MONGODB_FLOW_BATCH_SIZE if size is None else size
+        # set of the (src_addr_0, src_addr_1, dst_addr_0, dst_addr_1,
+        # proto) tuples of the flows that may be switched by
+        # MongoDBFlow.cleanup_flows() (dport > 128)
+        self.touched = flowdb.touched_flows
+        # {key: (findspec, {operator: {field: value}})}; $addToSet
+        # values are stored as (set of hashable values, list of values)
+        self.updates = {}
+        self.result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                       'nModified': 0}
+
+    def __len__(self):
+        return len(self.updates)
+
+    def append(self, findspec, updatespec):
+        key = _flow_key(findspec)
+        try:
+            curspec = self.updates[key][1]
+        except KeyError:
+            if len(self.updates) >= self.size:
+                self.flush()
+            curspec = {}
+            self.updates[key] = (findspec, curspec)
+            if self.touched is not None and \
+               (findspec.get('dport') or 0) > 128:
+                self.touched.add(tuple(findspec[fld] for fld in
+                                       MongoDBFlow.cleanup_key))
+        for op, values in viewitems(updatespec):
+            cur = curspec.setdefault(op, {})
+            if op == '$inc':
+                for field, value in viewitems(values):
+                    cur[field] = cur.get(field, 0) + (value or 0)
+            elif op == '$min':
+                for field, value in viewitems(values):
+                    if field not in cur or value < cur[field]:
+                        cur[field] = value
+            elif op == '$max':
+                for field, value in viewitems(values):
+                    if field not in cur or value > cur[field]:
+                        cur[field] = value
+            elif op == '$addToSet':
+                for field, value in viewitems(values):
+                    if isinstance(value, dict) and '$each' in value:
+                        value = value['$each']
+                    else:
+                        value = [value]
+                    try:
+                        seen, lst = cur[field]
+                    except KeyError:
+                        seen, lst = cur[field] = (set(), [])
+                    for val in value:
+                        hval = _hashable(val)
+                        if hval not in seen:
+                            seen.add(hval)
+                            lst.append(val)
+            else:
+                cur.update(values)
+
+    def flush(self):
+        """Sends the pending upserts to MongoDB."""
+        if not self.updates:
+            return
+        bulk = self.collection.initialize_unordered_bulk_op()
+        updates = list(viewvalues(self.updates))
+        for findspec, curspec in updates:
+            if '$addToSet' in curspec:
+                curspec['$addToSet'] = dict(
+                    (field, {'$each': lst})
+                    for field, (_, lst) in viewitems(curspec['$addToSet'])
+                )
+            bulk.find(findspec).upsert().update(curspec)
+        utils.LOGGER.debug("DB:MongoDB flow bulk upsert: %d",
+                           len(self.updates))
+        self.updates = {}
+        try:
+            result = bulk.execute()
+        except BulkWriteError as exc:
+            utils.LOGGER.error("Bulk Write Error", exc_info=True)
+            result = exc.details
+        except Exception:
+            # We cannot know which upserts have been applied
+            self.flowdb.invalidate_rollups()
+            raise
+        for key in self.result:
+            self.result[key] += result.get(key) or 0
+        failed = set(err['index'] for err in result.get('writeErrors', []))
+        upserted = set(elt['index'] for elt in result.get('upserted', []))
+        self.flowdb.upserts_rollups(
+            (findspec, curspec, i in upserted)
+            for i, (findspec, curspec) in enumerate(updates)
+            if i not in failed
+        )
+
+    def execute(self):
+        """Sends the pending upserts to MongoDB and returns the (total)
+        result, like pymongo's bulk operations.
+
+        """
+        self.flush()
+        return self.result
+
+
 class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
     column_flow = 0
+    column_rollup_daily = 1
+    column_rollup_totals = 2
+    column_rollup_hosts = 3
+    column_rollup_timeslots = 4
+    column_rollup_state = 5
+
+    # The rollup collections hold, for each (proto, dport or type)
+    # value (the rollup fields):
+    #   - daily: the number of flows per timeslot
+    #   - totals: the number of flows and the sums of the counters
+    #   - hosts: for each host and side ("src" or "dst"), the number
+    #     of flows and the sums of the counters
+    # They are used by .flow_daily(), .topvalues() and .count() when
+    # the filter only uses the rollup fields, and when the state
+    # document says they are valid (see ._rollups_valid()).
+    #
+    # The timeslots collection has one document per (flow,
+    # timeslot), with a hash as _id (see ._timeslot_id()): a
+    # duplicate key error when a document is inserted tells that
+    # the flow already had the timeslot.
+    rollup_fields = ['proto', 'dport', 'type']
+    rollup_counters = ['count', 'cspkts', 'scpkts', 'csbytes', 'scbytes']
+    # To be incremented when the rollup collections change
+    rollup_version = 1
 
     datefields = [
         'firstseen',
@@ -4432,26 +4753,59 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
             ([('firstseen', pymongo.ASCENDING)], {}),
             ([('lastseen', pymongo.ASCENDING)], {}),
             ([('times', pymongo.ASCENDING)], {}),
+            ([('times.start', pymongo.ASCENDING)], {}),
             ([('count', pymongo.ASCENDING)], {}),
             ([('cspkts', pymongo.ASCENDING)], {}),
             ([('scpkts', pymongo.ASCENDING)], {}),
             ([('csbytes', pymongo.ASCENDING)], {}),
             ([('scbytes', pymongo.ASCENDING)], {}),
         ],
+        # flows_daily
+        [
+            ([('duration', pymongo.ASCENDING),
+              ('start', pymongo.ASCENDING)], {}),
+        ],
+        # flows_totals
+        [
+            ([('proto', pymongo.ASCENDING),
+              ('dport', pymongo.ASCENDING),
+              ('type', pymongo.ASCENDING)], {}),
+        ],
+        # flows_hosts
+        [
+            ([('side', pymongo.ASCENDING),
+              ('addr_0', pymongo.ASCENDING),
+              ('addr_1', pymongo.ASCENDING)], {}),
+        ],
+        # flows_timeslots
+        [],
+        # flows_rollups
+        [],
     ]
 
+    # The fields that identify the flows grouped by .cleanup_flows()
+    cleanup_key = ['src_addr_0', 'src_addr_1', 'dst_addr_0', 'dst_addr_1',
+                   'proto']
+
     def __init__(self, url):
         super(MongoDBFlow, self).__init__(url)
-        self.columns = ["flows"]
+        self.columns = ["flows", "flows_daily", "flows_totals",
+                        "flows_hosts", "flows_timeslots", "flows_rollups"]
+        # see .cleanup_flows()
+        self.touched_flows = set()
+
+    def init(self):
+        super(MongoDBFlow, self).init()
+        # There is no flow: the (empty) rollup collections are valid
+        self._set_rollups_state(True)
 
     def start_bulk_insert(self):
         """
         Initialize bulks for inserting data in MongoDB.
-        Returns flow_bulk
+        Returns flow_bulk, a MongoDBFlowBulk instance
         """
         utils.LOGGER.debug("start_bulk_insert called")
-        return (self.db[self.columns[self.column_flow]]
-                .initialize_unordered_bulk_op())
+        return MongoDBFlowBulk(self)
 
     @staticmethod
     def _get_flow_key(rec):
@@ -4515,7 +4869,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         if config.FLOW_STORE_METADATA:
             for kind, op in viewitems(cls.meta_kinds):
                 for key, value in viewitems(cls.meta_desc[name].get(kind, {})):
-                    if not rec[value]:
+                    if not rec.get(value):
                         continue
                     if ("%s.%s.%s" % (name, kind, key)
                             in flow.META_DESC_ARRAYS):
@@ -4525,7 +4879,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
 
         cls._update_timeslots(updatespec, rec)
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.append(findspec, updatespec)
 
     @classmethod
     def conn2flow(cls, bulk, rec):
@@ -4555,7 +4909,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         elif rec['proto'] == 'icmp':
             updatespec.setdefault("$addToSet", {})["codes"] = rec["code"]
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.append(findspec, updatespec)
 
     @classmethod
     def flow2flow(cls, bulk, rec):
@@ -4585,7 +4939,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         elif rec['proto'] == 'icmp':
             updatespec.setdefault("$addToSet", {})["codes"] = rec["code"]
 
-        bulk.find(findspec).upsert().update(updatespec)
+        bulk.append(findspec, updatespec)
 
     @staticmethod
     def bulk_commit(bulk):
@@ -4599,12 +4953,292 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                                result.get('nInserted'), insert_rate)
             utils.LOGGER.debug("%d upserts, %f/sec",
                                result.get('nUpserted'), upsert_rate)
-
-        except BulkWriteError:
+            return result
+        except BulkWriteError as exc:
             utils.LOGGER.error("Bulk Write Error", exc_info=True)
+            return exc.details
         except pymongo.errors.InvalidOperation:
             # Raised when executing an empty bulk
-            pass
+            return None
+
+    @classmethod
+    def add_rollups(cls, rollups, flw, incs, timeslots, flows=0):
+        """Adds to `rollups`, a {column: {((field, value), ...): {counter:
+        value}}} dict, the changes to the rollup documents of `flw` (a
+        flow, or a flow key): `incs` is a dict of the counters to add,
+        `timeslots` an iterable of the (start, duration) tuples of the
+        timeslots added to the flow and `flows` is 1 when the flow has
+        been inserted (-1 when it has been removed; then `incs` must be
+        negative and `timeslots` must contain the timeslots of the
+        flow).
+
+        """
+        key = tuple((fld, flw[fld]) for fld in cls.rollup_fields
+                    if fld in flw)
+        incs = dict((fld, incs[fld]) for fld in cls.rollup_counters
+                    if incs.get(fld))
+        if flows:
+            incs['flows'] = flows
+        for column, prefix in [
+                (cls.column_rollup_totals, ()),
+                (cls.column_rollup_hosts, (('side', 'src'),
+                                           ('addr_0', flw['src_addr_0']),
+                                           ('addr_1', flw['src_addr_1']))),
+                (cls.column_rollup_hosts, (('side', 'dst'),
+                                           ('addr_0', flw['dst_addr_0']),
+                                           ('addr_1', flw['dst_addr_1']))),
+        ]:
+            cur = rollups.setdefault(column, {}).setdefault(prefix + key, {})
+            for fld, value in viewitems(incs):
+                cur[fld] = cur.get(fld, 0) + value
+        for start, duration in timeslots:
+            cur = rollups.setdefault(cls.column_rollup_daily, {}).setdefault(
+                (('start', start), ('duration', duration)) + key, {},
+            )
+            cur['flows'] = cur.get('flows', 0) + (flows or 1)
+
+    def upserts_rollups(self, upserts):
+        """Updates the rollup collections after flow upserts. `upserts` is
+        an iterable of (findspec, updatespec, inserted) tuples for the
+        upserts that have been applied, `inserted` being True when the
+        upsert has created the flow.
+
+        """
+        upserts = list(upserts)
+        timeslots = self._add_timeslots(
+            (findspec,
+             updatespec.get('$addToSet', {}).get('times', {}).get('$each', []))
+            for findspec, updatespec, _ in upserts
+        )
+        rollups = {}
+        for (findspec, updatespec, inserted), new_timeslots in zip(upserts,
+                                                                   timeslots):
+            self.add_rollups(rollups, findspec, updatespec.get('$inc', {}),
+                             new_timeslots, flows=int(inserted))
+        self.update_rollups(rollups)
+
+    def update_rollups(self, rollups):
+        """Applies the changes computed by .add_rollups() to the rollup
+        collections. The documents whose number of flows drops to zero
+        are removed.
+
+        """
+        for column, updates in viewitems(rollups):
+            bulk = self.db[self.columns[column]].initialize_ordered_bulk_op()
+            count = 0
+            for key, incs in viewitems(updates):
+                incs = dict((fld, value) for fld, value in viewitems(incs)
+                            if value)
+                if not incs:
+                    continue
+                key = dict(key)
+                bulk.find(key).upsert().update({'$inc': incs})
+                if incs.get('flows', 0) < 0:
+                    bulk.find(dict(key, flows={'$lte': 0})).remove()
+                count += 1
+            if not count:
+                continue
+            try:
+                bulk.execute()
+            except BulkWriteError:
+                utils.LOGGER.error("Bulk Write Error", exc_info=True)
+                self.invalidate_rollups()
+            except Exception:
+                self.invalidate_rollups()
+                raise
+
+    @staticmethod
+    def _timeslot_id(flw, start, duration):
+        """Returns the _id of the document of the timeslots collection for
+        the flow `flw` (a flow, or a flow key) and the timeslot
+        (`start`, `duration`).
+
+        """
+        return bson.Binary(hashlib.md5((
+            '%s %s %s %s %s %s %s %s' % (
+                flw['src_addr_0'], flw['src_addr_1'],
+                flw['dst_addr_0'], flw['dst_addr_1'], flw['proto'],
+                flw.get('dport', flw.get('type')), start, duration,
+            )
+        ).encode()).digest())
+
+    def _add_timeslots(self, flows):
+        """Records the timeslots of `flows`, an iterable of (flow key,
+        [timeslot, ...]) tuples, in the timeslots collection. Returns a
+        list with, for each flow, the set of the (start, duration)
+        tuples of the timeslots the flow did not have before.
+
+        The documents are inserted with one unordered insert_many() call:
+        the documents that already exist (duplicate key errors) are the
+        timeslots that were already known.
+
+        """
+        result = []
+        docs = []
+        for flw, timeslots in flows:
+            new_timeslots = set()
+            result.append(new_timeslots)
+            for tslot in timeslots:
+                tslot = (tslot['start'], tslot['duration'])
+                docs.append((new_timeslots, tslot,
+                             {'_id': self._timeslot_id(flw, *tslot)}))
+        if not docs:
+            return result
+        failed = set()
+        try:
+            self.db[self.columns[self.column_rollup_timeslots]].insert_many(
+                [doc for _, _, doc in docs], ordered=False,
+            )
+        except BulkWriteError as exc:
+            errors = exc.details.get('writeErrors', [])
+            failed.update(err['index'] for err in errors)
+            # 11000: duplicate key error
+            if any(err.get('code') != 11000 for err in errors):
+                utils.LOGGER.error("Bulk Write Error", exc_info=True)
+                self.invalidate_rollups()
+        except Exception:
+            self.invalidate_rollups()
+            raise
+        for i, (new_timeslots, tslot, _) in enumerate(docs):
+            if i not in failed:
+                new_timeslots.add(tslot)
+        return result
+
+    def _set_rollups_state(self, valid):
+        self.db[self.columns[self.column_rollup_state]].replace_one(
+            {'_id': 'rollups'},
+            {'_id': 'rollups', 'version': self.rollup_version,
+             'valid': valid},
+            upsert=True,
+        )
+
+    def invalidate_rollups(self):
+        """Marks the rollup collections as invalid, when they may no longer
+        match the flows. They are not used until .rebuild_rollups() is
+        called.
+
+        """
+        utils.LOGGER.warning("The flow rollup collections are no longer "
+                             "used, run ivre flowcli --rebuild-rollups")
+        self.db[self.columns[self.column_rollup_state]].update_one(
+            {'_id': 'rollups'}, {'$set': {'valid': False}},
+        )
+
+    def rebuild_rollups(self):
+        """Computes again the rollup collections from the flows. This is
+        needed for flows inserted before the rollups were maintained
+        (or when they have been invalidated, see ._rollups_valid()).
+        No flow should be inserted meanwhile.
+
+        """
+        self._set_rollups_state(False)
+        for column in [self.column_rollup_daily, self.column_rollup_totals,
+                       self.column_rollup_hosts,
+                       self.column_rollup_timeslots]:
+            self.db[self.columns[column]].delete_many({})
+        group_id = dict((fld, '$%s' % fld) for fld in self.rollup_fields)
+        counters = [(fld, {'$sum': '$%s' % fld})
+                    for fld in self.rollup_counters]
+        # (column, values to add to the documents, pipeline)
+        pipelines = [
+            (self.column_rollup_daily, {}, [
+                {'$unwind': '$times'},
+                {'$group': {
+                    '_id': dict(group_id, start='$times.start',
+                                duration='$times.duration'),
+                    'flows': {'$sum': 1},
+                }},
+            ]),
+            (self.column_rollup_totals, {}, [
+                {'$group': dict([('_id', group_id),
+                                 ('flows', {'$sum': 1})] + counters)},
+            ]),
+        ]
+        for side in ['src', 'dst']:
+            pipelines.append((self.column_rollup_hosts, {'side': side}, [
+                {'$group': dict([('_id', dict(group_id,
+                                              addr_0='$%s_addr_0' % side,
+                                              addr_1='$%s_addr_1' % side)),
+                                 ('flows', {'$sum': 1})] + counters)},
+            ]))
+        for column, values, pipeline in pipelines:
+            log_pipeline(pipeline)
+            docs = self.db[self.columns[self.column_flow]].aggregate(
+                pipeline, cursor={}
+            )
+            while True:
+                batch = []
+                for rec in islice(docs, config.FLOW_ROLLUP_BATCH_SIZE):
+                    doc = rec.pop('_id')
+                    doc.update(rec)
+                    doc.update(values)
+                    batch.append(doc)
+                if not batch:
+                    break
+                self.db[self.columns[column]].insert_many(batch)
+        docs = (
+            {'_id': self._timeslot_id(flw, tslot['start'], tslot['duration'])}
+            for flw in self.db[self.columns[self.column_flow]].find(
+                {'times': {'$exists': True}},
+                dict((fld, 1) for fld in self.cleanup_key +
+                     ['dport', 'type', 'times']),
+            )
+            for tslot in flw['times']
+        )
+        while True:
+            batch = list(islice(docs, config.FLOW_ROLLUP_BATCH_SIZE))
+            if not batch:
+                break
+            self.db[self.columns[self.column_rollup_timeslots]].insert_many(
+                batch, ordered=False,
+            )
+        self._set_rollups_state(True)
+
+    def _rollups_valid(self):
+        """Returns True when the rollup collections can be used, i.e., when
+        they have been created by this version (by .init() or
+        .rebuild_rollups()) and have not been invalidated since (see
+        .invalidate_rollups()).
+
+        """
+        state = self.db[self.columns[self.column_rollup_state]].find_one(
+            {'_id': 'rollups'}
+        )
+        return (state is not None and state.get('valid', False) and
+                state.get('version') == self.rollup_version)
+
+    @classmethod
+    def _rollup_flt(cls, flt, timeslot=None):
+        """Returns a filter for the rollup collections equivalent to the flow
+        filter `flt`, or None when `flt` uses other fields than the
+        rollup fields. A "times" condition is only accepted (and
+        removed) when it is implied by the `timeslot` condition.
+
+        """
+        res = {}
+        for key, value in viewitems(flt or {}):
+            if key in ['$and', '$or', '$nor']:
+                values = []
+                for subflt in value:
+                    subflt = cls._rollup_flt(
+                        subflt, timeslot=timeslot if key == '$and' else None,
+                    )
+                    if subflt is None:
+                        return None
+                    if subflt or key != '$and':
+                        values.append(subflt)
+                if values:
+                    res[key] = values
+            elif key in cls.rollup_fields:
+                res[key] = value
+            elif (key == 'times' and timeslot is not None and
+                  list(value) == ['$elemMatch'] and
+                  all(timeslot.get(subkey) == subvalue for subkey, subvalue
+                      in viewitems(value['$elemMatch']))):
+                continue
+            else:
+                return None
+        return res
 
     def get(self, flt, skip=None, limit=None, orderby=None, fields=None):
         """
@@ -4640,7 +5274,11 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         """
         Returns a dict {'client': nb_clients, 'servers': nb_servers',
         'flows': nb_flows} according to the given filter.
+        The rollup collections are used when possible.
         """
+        rollup_flt = self._rollup_flt(flt)
+        if rollup_flt is not None and self._rollups_valid():
+            return self._count_rollup(rollup_flt)
         sources = 0
         destinations = 0
         flows = self.db[self.columns[self.column_flow]].count(flt)
@@ -4689,6 +5327,36 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
             )['count']
         return {'clients': sources, 'servers': destinations, 'flows': flows}
 
+    def _count_rollup(self, flt):
+        """
+        Like .count(), using the rollup collections: `flt` must be a
+        filter returned by ._rollup_flt().
+        """
+        result = {}
+        for key, column, side in [
+                ('flows', self.column_rollup_totals, None),
+                ('clients', self.column_rollup_hosts, 'src'),
+                ('servers', self.column_rollup_hosts, 'dst'),
+        ]:
+            pipeline = []
+            if flt:
+                pipeline.append({'$match': flt})
+            if side is None:
+                pipeline.append({'$group': {'_id': None,
+                                            'count': {'$sum': '$flows'}}})
+            else:
+                pipeline += [
+                    {'$match': {'side': side}},
+                    {'$group': {'_id': {'addr_0': '$addr_0',
+                                        'addr_1': '$addr_1'}}},
+                    {'$group': {'_id': None, 'count': {'$sum': 1}}},
+                ]
+            log_pipeline(pipeline)
+            res = list(self.db[self.columns[column]].aggregate(pipeline,
+                                                               cursor={}))
+            result[key] = res[0]['count'] if res else 0
+        return result
+
     def topvalues(self, flt, fields, collect_fields=None, sum_fields=None,
                   limit=None, skip=None, least=False, topnbr=10):
         """
@@ -4727,6 +5395,22 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                 if f not in special_fields:
                     flow.validate_field(f)
 
+        # The rollup collections can be used for the rollup fields and
+        # one of the addresses
+        if (fields and not collect_fields and not limit and
+                set(fields).issubset(self.rollup_fields +
+                                     ['src.addr', 'dst.addr']) and
+                not {'src.addr', 'dst.addr'}.issubset(fields) and
+                set(sum_fields).issubset(self.rollup_counters)):
+            rollup_flt = self._rollup_flt(flt)
+            if rollup_flt is not None and self._rollups_valid():
+                for rec in self._topvalues_rollup(rollup_flt, fields,
+                                                  sum_fields, skip=skip,
+                                                  least=least,
+                                                  topnbr=topnbr):
+                    yield rec
+                return
+
         # special fields that are not addresses will be translated again at
         # the end
         reverse_special_fields = {'sports': 'sport'}
@@ -4892,6 +5576,58 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                 'count': res_count
             }
 
+    def _topvalues_rollup(self, flt, fields, sum_fields, skip=None,
+                          least=False, topnbr=10):
+        """
+        Like .topvalues(), using the rollup collections: `flt` must be a
+        filter returned by ._rollup_flt(), `fields` must only contain
+        rollup fields and at most one of "src.addr" and "dst.addr", and
+        `sum_fields` must only contain rollup counters.
+        """
+        column = self.column_rollup_totals
+        match = {}
+        group_id = {}
+        for field in fields:
+            if field in ['src.addr', 'dst.addr']:
+                # Use the per-host documents of this side
+                column = self.column_rollup_hosts
+                match['side'] = field[:3]
+                group_id['addr_0'] = '$addr_0'
+                group_id['addr_1'] = '$addr_1'
+            else:
+                match[field] = {'$exists': True}
+                group_id[field] = '$%s' % field
+        pipeline = []
+        if flt:
+            pipeline.append({'$match': flt})
+        pipeline.append({'$match': match})
+        # The counters whose sum is zero may be missing from the
+        # rollup documents
+        pipeline.append({'$group': {
+            '_id': group_id,
+            '_count': {'$sum': ({'$add': [{'$ifNull': ['$%s' % field, 0]}
+                                          for field in sum_fields]}
+                                if sum_fields else '$flows')},
+        }})
+        pipeline.append({"$sort": {"_count": 1 if least else -1}})
+        if skip is not None:
+            pipeline.append({"$skip": skip})
+        if topnbr is not None:
+            pipeline.append({"$limit": topnbr})
+        log_pipeline(pipeline)
+        res = self.db[self.columns[column]].aggregate(pipeline, cursor={})
+        for entry in res:
+            values = entry['_id']
+            if 'addr_0' in values:
+                values[match['side'] + '.addr'] = self.internal2ip(
+                    (values.pop('addr_0'), values.pop('addr_1'))
+                )
+            yield {
+                'fields': tuple(values.get(field) for field in fields),
+                'collected': set(),
+                'count': entry['_count'],
+            }
+
     @classmethod
     def search_flow_net(cls, net, neg=False, fieldname=''):
         """
@@ -5247,36 +5983,47 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
             flows: [("proto/dport", count), ...]
             time_in_day: time
         }.
+        The daily rollup collection is used when possible.
         """
-        pipeline = []
-
-        if flt:
-            pipeline.append({'$match': flt})
-
-        # Unwind timeslots
-        pipeline.append({'$unwind': '$times'})
-
-        match = {}
-        # Keep only timeslots with the given precision
-        match['times.duration'] = precision
+        timeslot = {'duration': precision}
         # We need to ensure after and before filters after $unwind
         if after:
-            match.setdefault('times.start', {})['$gte'] = after
+            timeslot.setdefault('start', {})['$gte'] = after
         if before:
-            match.setdefault('times.start', {})['$lt'] = before
-
-        pipeline.append({'$match': match})
+            timeslot.setdefault('start', {})['$lt'] = before
+
+        rollup_flt = self._rollup_flt(flt, timeslot=timeslot)
+        if rollup_flt is not None and self._rollups_valid():
+            pipeline = []
+            if rollup_flt:
+                pipeline.append({'$match': rollup_flt})
+            pipeline.append({'$match': timeslot})
+            tfield = '$start'
+            column = self.columns[self.column_rollup_daily]
+        else:
+            pipeline = []
+            if flt:
+                pipeline.append({'$match': flt})
+            # Unwind timeslots
+            pipeline.append({'$unwind': '$times'})
+            # Keep only timeslots with the given precision
+            pipeline.append({'$match': dict(
+                ('times.%s' % key, value) for key, value in viewitems(timeslot)
+            )})
+            tfield = '$times.start'
+            column = self.columns[self.column_flow]
 
         # Project time in hours, minutes, seconds
         pipeline.append({
             '$project': {
-                'hour': {'$hour': '$times.start'},
-                'minute': {'$minute': '$times.start'},
-                'second': {'$second': '$times.start'},
+                'hour': {'$hour': tfield},
+                'minute': {'$minute': tfield},
+                'second': {'$second': tfield},
                 'proto': 1,
                 'dport': 1,
                 'count': 1,
                 'type': 1,
+                'flows': 1,
             }
         })
 
@@ -5292,6 +6039,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                     'proto': '$proto',
                     'dport': '$dport',
                     'type': '$type',
+                    'flows': '$flows',
                 }},
             }
         })
@@ -5304,8 +6052,7 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
         }})
 
         log_pipeline(pipeline)
-        res = self.db[self.columns[self.column_flow]].aggregate(pipeline,
-                                                                cursor={})
+        res = self.db[column].aggregate(pipeline, cursor={})
 
         for entry in res:
             flows = {}
@@ -5317,7 +6064,8 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                 else:
                     entry_name = fields['proto']
                 flows.setdefault(entry_name, 0)
-                flows[entry_name] += 1
+                # "flows" only exists in the rollup documents
+                flows[entry_name] += fields.get('flows', 1)
             res = {
                 'flows': list(viewitems(flows)),
                 'time_in_day': datetime.time(
@@ -5389,6 +6137,9 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                                result.get('nModified'), update_rate)
         except pymongo.errors.InvalidOperation:
             utils.LOGGER.debug("No operation to execute.")
+        else:
+            # The timeslots have changed
+            self.rebuild_rollups()
 
     def list_precisions(self):
         pipeline = [
@@ -5429,17 +6180,40 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
 
         return True
 
-    def cleanup_flows(self):
+    def cleanup_flows(self, full=False):
         """
         Cleanup flows which source and destination seem to have been switched.
+        Unless `full` is True, only the flows between the hosts (with the
+        same protocol) of the flows inserted or updated since the last
+        call are considered; a full scan may take a long time on large
+        collections.
+        """
+        if full:
+            self.touched_flows.clear()
+            counter = self._cleanup_flows({})
+        else:
+            touched = list(self.touched_flows)
+            self.touched_flows.clear()
+            counter = 0
+            for i in range(0, len(touched), config.FLOW_CLEANUP_BATCH_SIZE):
+                counter += self._cleanup_flows({'$or': [
+                    dict(zip(self.cleanup_key, key)) for key in
+                    touched[i:i + config.FLOW_CLEANUP_BATCH_SIZE]
+                ]})
+        utils.LOGGER.debug("%d flows switched.", counter)
+
+    def _cleanup_flows(self, flt):
+        """
+        Cleanup the flows matching `flt` which source and destination
+        seem to have been switched. Returns the number of flows removed.
         """
         # Get flows which have a unique source port
         pipeline = [
             {
-                '$match': {
+                '$match': dict(flt, **{
                     'sports': {'$size': 1},
                     'dport': {'$gt': 128},
-                }
+                })
             },
             {
                 '$unwind': '$sports'
@@ -5466,13 +6240,26 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                     'firstseen': {'$min': '$firstseen'},
                     'lastseen': {'$max': '$lastseen'},
                     'count': {'$sum': '$count'},
-                    'times': {'$addToSet': '$times'}
+                    'times': {'$addToSet': '$times'},
+                    # To maintain the rollup collections: the flows
+                    # with their timeslots
+                    'flows': {'$push': dict(
+                        [('_id', '$_id'), ('dport', '$dport'),
+                         ('time', '$times')] +
+                        [(fld, '$%s' % fld) for fld in self.rollup_counters]
+                    )},
                 }
             },
         ]
         res = self.db[self.columns[self.column_flow]].aggregate(pipeline)
-        bulk = self.start_bulk_insert()
+        bulk = (self.db[self.columns[self.column_flow]]
+                .initialize_unordered_bulk_op())
         counter = 0
+        # To maintain the rollup collections: [(bulk index, findspec,
+        # updatespec), ...] for the upserts, [(bulk index, rec), ...]
+        # for the removals
+        upserts = []
+        removes = []
         for rec in res:
             rec['_id']['src_addr'] = self.internal2ip(
                 [rec['_id']['src_addr_0'], rec['_id']['src_addr_1']]
@@ -5524,8 +6311,49 @@ class MongoDBFlow(with_metaclass(DBFlowMeta, MongoDB, DBFlow)):
                     utils.LOGGER.debug("Switch flow hosts: %s", f_str)
 
                 bulk.find(findspec).upsert().update(updatespec)
+                upserts.append((2 * len(upserts), findspec, updatespec))
                 bulk.find(removespec).remove()
+                removes.append((2 * len(removes) + 1, rec))
                 counter += len(rec['_ids'])
 
-        self.bulk_commit(bulk)
-        utils.LOGGER.debug("%d flows switched.", counter)
+        if not upserts:
+            return counter
+        try:
+            result = self.bulk_commit(bulk) or {}
+        except Exception:
+            self.invalidate_rollups()
+            raise
+        failed = set(err['index'] for err in result.get('writeErrors', []))
+        upserted = set(elt['index'] for elt in result.get('upserted', []))
+        self.upserts_rollups(
+            (findspec, updatespec, index in upserted)
+            for index, findspec, updatespec in upserts if index not in failed
+        )
+        rollups = {}
+        timeslot_ids = []
+        for index, rec in removes:
+            if index in failed:
+                continue
+            # {_id: (flow, set of (start, duration) tuples)}
+            flows = {}
+            for flw in rec['flows']:
+                flows.setdefault(flw['_id'], (flw, set()))[1].add(
+                    (flw['time']['start'], flw['time']['duration'])
+                )
+            for flw, timeslots in viewvalues(flows):
+                key = dict(rec['_id'], dport=flw['dport'])
+                self.add_rollups(
+                    rollups, key,
+                    dict((fld, -flw[fld]) for fld in self.rollup_counters
+                         if flw.get(fld)),
+                    timeslots, flows=-1,
+                )
+                timeslot_ids.extend(self._timeslot_id(key, *tslot)
+                                    for tslot in timeslots)
+        self.update_rollups(rollups)
+        for i in range(0, len(timeslot_ids), config.FLOW_ROLLUP_BATCH_SIZE):
+            self.db[self.columns[self.column_rollup_timeslots]].delete_many(
+                {'_id': {'$in':
+                         timeslot_ids[i:i + config.FLOW_ROLLUP_BATCH_SIZE]}}
+            )
+        return counter
@@ -531,7 +531,7 @@ class SQLDBFlow(SQLDB, DBFlow):
         """
         raise NotImplementedError()
 
-    def cleanup_flows(self):
+    def cleanup_flows(self, full=False):
         raise NotImplementedError()
 
 
@@ -1748,6 +1748,13 @@ instance.
                  (self.tables.scan.time_stop <= stop)
         )
 
+    def searchnewer(self, timestamp, neg=False):
+        timestamp = utils.all2datetime(timestamp)
+        return self.base_filter(
+            main=(self.tables.scan.time_stop <= timestamp) if neg else
+            (self.tables.scan.time_stop > timestamp)
+        )
+
     @classmethod
     def searchfile(cls, fname=None, scripts=None):
         """Search shared files from a file name (either a string or a
@@ -2015,9 +2022,28 @@ class SQLDBView(SQLDBActive, DBView):
 
     def store_or_merge_host(self, host):
         # FIXME: may cause performance issues
-        self.start_store_hosts()
+        # Use the caller's bulk insert structure, if any (see
+        # .start_store_hosts())
+        local_bulk = self.bulk is None
+        if local_bulk:
+            self.start_store_hosts()
         self.store_host(host)
-        self.stop_store_hosts()
+        if local_bulk:
+            self.stop_store_hosts()
+
+    def _store_or_merge_hosts(self, hosts):
+        # The records are merged by the database (see
+        # PostgresDBView._store_host()); use one bulk insert structure
+        # for the whole batch, unless the caller has created one.
+        local_bulk = self.bulk is None
+        if local_bulk:
+            self.start_store_hosts()
+        try:
+            for host in hosts:
+                self.store_host(host)
+        finally:
+            if local_bulk:
+                self.stop_store_hosts()
 
     @classmethod
     def searchsource(cls, src, neg=False):
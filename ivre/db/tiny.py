@@ -65,6 +65,7 @@ class TinyDB(DB):
 
     flt_empty = EMPTY_QUERY
     no_limit = None
+    concurrent_writes = False
 
     def __init__(self, url):
         super(TinyDB, self).__init__()
@@ -947,6 +948,15 @@ This will be used by TinyDBNmap & TinyDBView
             return (q.endtime < start) | (q.starttime > stop)
         return (q.endtime >= start) & (q.starttime <= stop)
 
+    @staticmethod
+    def searchnewer(timestamp, neg=False):
+        if isinstance(timestamp, datetime):
+            timestamp = utils.datetime2timestamp(timestamp)
+        q = Query().endtime
+        if neg:
+            return q <= timestamp
+        return q > timestamp
+
     @classmethod
     def searchhop(cls, hop, ttl=None, neg=False):
         try:
@@ -1933,11 +1943,43 @@ class TinyDBView(TinyDBActive, DBView):
     """A View-specific DB using TinyDB backend"""
 
     dbname = "view"
+    dbname_watermarks = "view_watermarks"
+
+    @property
+    def db_watermarks(self):
+        """The DB for the watermarks"""
+        try:
+            return self._db_watermarks
+        except AttributeError:
+            self._db_watermarks = TDB(os.path.join(
+                self.basepath, "%s.json" % self.dbname_watermarks
+            ))
+            return self._db_watermarks
+
+    def init(self):
+        super(TinyDBView, self).init()
+        try:
+            self.db_watermarks.drop_tables()
+        except AttributeError:
+            # TinyDB < 4
+            self.db_watermarks.purge_tables()
 
     def store_or_merge_host(self, host):
         if not self.merge_host(host):
             self.store_host(host)
 
+    def get_watermark(self, name):
+        rec = self.db_watermarks.get(Query().name == name)
+        if rec is None:
+            return None
+        return utils.all2datetime(rec['value'])
+
+    def set_watermark(self, name, value):
+        self.db_watermarks.upsert(
+            {'name': name, 'value': utils.datetime2timestamp(value)},
+            Query().name == name,
+        )
+
 
 def op_update(count, firstseen, lastseen):
     """A TinyDB operation to update a document with count, firstseen and
@@ -2779,6 +2821,11 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
         'times.start',
     ]
 
+    def __init__(self, url):
+        super(TinyDBFlow, self).__init__(url)
+        # see .cleanup_flows()
+        self.touched_flows = set()
+
     # This represents the kinds of metadata that are defined in flow.META_DESC
     # Each kind is associated with an aggregation operator used for
     # insertion in db.
@@ -2799,6 +2846,16 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
         "=~": "regex",
     }
 
+    def _touch_flow(self, insertspec):
+        """Records the hosts and protocol of a flow that may be switched by
+        .cleanup_flows()
+
+        """
+        if (insertspec.get('dport') or 0) > 128:
+            self.touched_flows.add((insertspec['src_addr'],
+                                    insertspec['dst_addr'],
+                                    insertspec['proto']))
+
     @staticmethod
     def _get_flow_key(rec):
         """Returns a query that matches the flow"""
@@ -2860,6 +2917,7 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
         rec['dst_addr'] = self.ip2internal(rec['dst'])
         # Insert in flows
         findspec, insertspec = self._get_flow_key(rec)
+        self._touch_flow(insertspec)
         updatespec = [
             min_op('firstseen', utils.datetime2timestamp(rec['start_time'])),
             max_op('lastseen', utils.datetime2timestamp(rec['end_time'])),
@@ -2876,7 +2934,7 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
             for kind, op in viewitems(self.meta_kinds):
                 for key, value in viewitems(self.meta_desc[name].get(kind,
                                                                      {})):
-                    if not rec[value]:
+                    if not rec.get(value):
                         continue
                     if ("%s.%s.%s" % (name, kind, key)
                             in flow.META_DESC_ARRAYS):
@@ -2942,6 +3000,7 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
         rec['src_addr'] = self.ip2internal(rec['src'])
         rec['dst_addr'] = self.ip2internal(rec['dst'])
         findspec, insertspec = self._get_flow_key(rec)
+        self._touch_flow(insertspec)
 
         updatespec = [
             min_op('firstseen', utils.datetime2timestamp(rec['start_time'])),
@@ -2984,6 +3043,7 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
         rec['src_addr'] = self.ip2internal(rec['src'])
         rec['dst_addr'] = self.ip2internal(rec['dst'])
         findspec, insertspec = self._get_flow_key(rec)
+        self._touch_flow(insertspec)
 
         updatespec = [
             min_op('firstseen', utils.datetime2timestamp(rec['start_time'])),
@@ -3093,11 +3153,24 @@ class TinyDBFlow(with_metaclass(DBFlowMeta, TinyDB, DBFlow)):
 
         return True
 
-    def cleanup_flows(self):
+    def cleanup_flows(self, full=False):
+        """Cleanup flows which source and destination seem to have been
+        switched. Unless `full` is True, only the flows between the
+        hosts (with the same protocol) of the flows inserted or updated
+        since the last call are considered.
+
+        """
         q = Query()
         res = {}
         flt = q.sports.test(lambda val: len(val) == 1) & (q.dport > 128)
+        touched = self.touched_flows
+        self.touched_flows = set()
+        if not (full or touched):
+            return
         for flw in self.db.search(flt):
+            if not full and (flw['src_addr'], flw['dst_addr'],
+                             flw['proto']) not in touched:
+                continue
             rec = res.setdefault(
                 (flw['src_addr'], flw['dst_addr'], flw['proto'],
                  flw['sports'][0]),
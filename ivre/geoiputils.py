@@ -28,6 +28,8 @@ information about IP addresses (mostly from Maxmind GeoIP files).
 
 
 from __future__ import print_function
+from array import array
+from bisect import bisect_right
 import codecs
 import csv
 import os.path
@@ -40,8 +42,8 @@ except ImportError:
 import zipfile
 
 
-from builtins import range
-from future.utils import viewitems, viewvalues
+from builtins import range, zip
+from future.utils import viewitems
 
 
 from ivre import VERSION, utils, config
@@ -220,23 +222,53 @@ def locids_by_region(country_code, reg_code):
             yield int(line['geoname_id'])
 
 
+try:
+    array('Q')
+except ValueError:
+    # Python 2
+    _RANGES_TYPECODE = 'L'
+else:
+    _RANGES_TYPECODE = 'Q'
+_RANGES_MAXVALUE = (1 << (8 * array(_RANGES_TYPECODE).itemsize)) - 1
+
+
 class IPRanges(object):
 
+    """Ranges of IP addresses, that can be indexed like a list of
+    addresses (e.g., `ranges[index]`).
+
+    The ranges are stored in sorted parallel arrays: the first and last
+    addresses of each range, and the index of the first address of
+    each range, so that .__getitem__() only needs a bisection.
+
+    """
+
     def __init__(self, ranges=None):
         """ranges must be given in the "correct" order *and* not
         overlap.
 
         """
-        self.ranges = {}
+        self.starts = array(_RANGES_TYPECODE)
+        self.stops = array(_RANGES_TYPECODE)
+        self.indexes = array(_RANGES_TYPECODE)
         self.length = 0
         if ranges is not None:
             for rnge in ranges:
                 self.append(*rnge)
 
     def append(self, start, stop):
-        length = stop - start + 1
-        self.ranges[self.length] = (start, length)
-        self.length += int(length)  # in case it's a long
+        if (
+                isinstance(self.starts, array) and
+                max(stop, self.length) > _RANGES_MAXVALUE
+        ):
+            # IPv6 addresses do not fit in the arrays
+            self.starts = list(self.starts)
+            self.stops = list(self.stops)
+            self.indexes = list(self.indexes)
+        self.starts.append(start)
+        self.stops.append(stop)
+        self.indexes.append(self.length)
+        self.length += int(stop - start + 1)  # in case it's a long
 
     def union(self, *others):
         res = IPRanges()
@@ -291,34 +323,31 @@ class IPRanges(object):
         return res
 
     def iter_int_ranges(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            yield start, start + length - 1
+        return zip(self.starts, self.stops)
 
     def iter_ranges(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            yield utils.int2ip(start), utils.int2ip(start + length - 1)
+        for start, stop in self.iter_int_ranges():
+            yield utils.int2ip(start), utils.int2ip(stop)
 
     def iter_nets(self):
-        for start, length in sorted(viewvalues(self.ranges)):
+        for start, stop in self.iter_int_ranges():
             for net in utils.range2nets((utils.int2ip(start),
-                                         utils.int2ip(start + length - 1))):
+                                         utils.int2ip(stop))):
                 yield net
 
     def iter_addrs(self):
-        for start, length in sorted(viewvalues(self.ranges)):
-            for val in range(start, start + length):
+        for start, stop in self.iter_int_ranges():
+            for val in range(start, stop + 1):
                 yield utils.int2ip(val)
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, item):
-        rangeindex = max(k for k in self.ranges if k <= item)
-        item -= rangeindex
-        rnge = self.ranges[rangeindex]
-        if item < rnge[1]:
-            return rnge[0] + item
-        raise IndexError("index out of range")
+        if not 0 <= item < self.length:
+            raise IndexError("index out of range")
+        rangeindex = bisect_right(self.indexes, item) - 1
+        return self.starts[rangeindex] + item - self.indexes[rangeindex]
 
 
 def _get_by_data(datafile, condition):
@@ -18,11 +18,27 @@
 
 """Support for Zeek log files"""
 
+import calendar
 import datetime
+from itertools import islice
+import os
 import re
 
 
 from builtins import zip
+from future.utils import viewitems
+from past.builtins import basestring
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as _json_loads
+
+        def json_loads(line):
+            # json.loads() only accepts bytes with Python >= 3.6
+            return _json_loads(line.decode())
 
 
 from ivre.parser import Parser
@@ -31,9 +47,29 @@ from ivre.utils import LOGGER, decode_hex
 
 CONTAINER_TYPE = re.compile(b"^(table|set|vector)\\[([a-z]+)\\]$")
 
+# Fields of type "time" (other than "ts", which all the logs have), for
+# the standard Zeek logs; used with JSON logs, which do not include the
+# field types. Dots in field names are replaced by underscores.
+TIME_FIELDS = {
+    "kerberos": set(["from", "till"]),
+    "ntp": set(["ref_time", "org_time", "rec_time", "xmt_time"]),
+    "ocsp": set(["thisUpdate", "nextUpdate", "revoketime"]),
+    "pe": set(["compile_ts"]),
+    "smb_files": set(["times_modified", "times_accessed", "times_created",
+                      "times_changed"]),
+    "snmp": set(["up_since"]),
+    "x509": set(["certificate_not_valid_before",
+                 "certificate_not_valid_after"]),
+}
+
 
 class ZeekFile(Parser):
-    """Zeek log generator"""
+    """Zeek log generator
+
+    JSON logs (LogAscii::use_json=T) are detected automatically: the
+    object is then a ZeekJSONFile instance.
+
+    """
 
     int_types = set([b"port", b"count"])
     float_types = set([b"interval"])
@@ -48,6 +84,9 @@ class ZeekFile(Parser):
         self.types = []
         self.path = None
         self.nextlines = []
+        # [(name, converter), ...], computed from the header (see
+        # .converters)
+        self._converters = None
         super(ZeekFile, self).__init__(fname)
         for line in self.fdesc:
             line = line.strip()
@@ -55,6 +94,12 @@ class ZeekFile(Parser):
                 self.nextlines.append(line)
                 break
             self.parse_header_line(line)
+        if isinstance(self, ZeekJSONFile) or (
+                not self.fields and self.nextlines and
+                self.nextlines[0][:1] == b'{'
+        ):
+            self.__class__ = ZeekJSONFile
+            self.init_json(fname)
 
     def __next__(self):
         return self.parse_line(self.nextlines.pop(0)
@@ -78,6 +123,8 @@ class ZeekFile(Parser):
 
         directive = keyval[0]
         arg = keyval[1]
+        # The converters depend on the header values
+        self._converters = None
 
         if directive == b"separator":
             self.sep = decode_hex(arg[2:]) if arg.startswith(b'\\x') else arg
@@ -100,14 +147,84 @@ class ZeekFile(Parser):
         if line.startswith(b'#'):
             self.parse_header_line(line)
             return next(self)
+        converters = self._converters
+        if converters is None:
+            converters = self.converters
         res = {}
-        fields = line.split(self.sep)
-
-        for field, name, typ in zip(fields, self.fields, self.types):
-            name = name.replace(b".", b"_").decode()
-            res[name] = self.fix_value(field, typ)
+        for (name, converter), field in zip(converters,
+                                            line.split(self.sep)):
+            res[name] = converter(field)
         return res
 
+    def parse_lines(self, count):
+        """Returns a list of (at most) `count` parsed lines. The list is
+        empty when the end of the file has been reached.
+
+        """
+        return list(islice(self, count))
+
+    @property
+    def converters(self):
+        """The list of (name, converter) tuples, one for each field, where
+        `name` is the key used in the parsed records and `converter` a
+        function that takes a raw value and returns the same value as
+        .fix_value().
+
+        """
+        if self._converters is None:
+            self._converters = [
+                (name.replace(b".", b"_").decode(), self.get_converter(typ))
+                for name, typ in zip(self.fields, self.types)
+            ]
+        return self._converters
+
+    def get_converter(self, typ):
+        """Returns a function that converts a raw value of type `typ`; the
+        type-dependent checks of .fix_value() are only done once.
+
+        """
+        unset_field = self.unset_field
+        empty_field = self.empty_field
+        if typ == b"bool":
+            def converter(val):
+                if val == unset_field:
+                    return None
+                return val == b"T"
+            return converter
+        container_type = CONTAINER_TYPE.search(typ)
+        if container_type is not None:
+            set_sep = self.set_sep
+            elt_converter = self.get_converter(container_type.groups()[1])
+
+            def converter(val):
+                if val == unset_field:
+                    return None
+                if val == empty_field:
+                    return []
+                return [elt_converter(x) for x in val.split(set_sep)]
+            return converter
+        if typ in self.int_types:
+            func = int
+        elif typ in self.float_types:
+            func = float
+        elif typ in self.time_types:
+            def func(val):
+                return datetime.datetime.fromtimestamp(float(val))
+        else:
+            def converter(val):
+                if val == unset_field:
+                    return None
+                if val == empty_field:
+                    return ""
+                return val.decode()
+            return converter
+
+        def converter(val):
+            if val == unset_field:
+                return None
+            return func(val)
+        return converter
+
     def fix_value(self, val, typ):
         if val == self.unset_field:
             return None
@@ -138,3 +255,80 @@ class ZeekFile(Parser):
         return "\n".join(["%s = %r" % (k, getattr(self, k))
                           for k in ["sep", "set_sep", "empty_field",
                                     "unset_field", "fields", "types"]])
+
+
+class ZeekJSONFile(ZeekFile):
+    """Zeek JSON log generator (LogAscii::use_json=T), one JSON object
+    per line.
+
+    The records are similar to those produced by ZeekFile: dots in
+    field names are replaced by underscores and time values
+    (epoch or ISO 8601) are converted to datetime instances. Since the
+    field types are not part of JSON logs, the time fields are "ts"
+    and, for the standard logs, the fields listed in TIME_FIELDS for
+    the log path (see .time_fields). Since unset fields are omitted in
+    JSON logs, the fields found in the previous records are set to
+    None when they are missing.
+
+    """
+
+    time_fields = set(["ts"])
+
+    def init_json(self, fname):
+        # {JSON key: field name}
+        self._names = {}
+        if self.nextlines and self.nextlines[0][:1] == b'{':
+            self.path = json_loads(self.nextlines[0]).get('_path')
+        if self.path is None:
+            fname = getattr(fname, 'name', fname)
+            if isinstance(fname, basestring) and not fname.startswith('<'):
+                # e.g., conn.log, conn.log.gz or
+                # conn.00:00:00-01:00:00.log.gz
+                self.path = os.path.basename(fname).split('.', 1)[0]
+        self.time_fields = self.time_fields.union(
+            TIME_FIELDS.get(self.path, ())
+        )
+
+    def parse_line(self, line):
+        if not line or line.startswith(b'#'):
+            return next(self)
+        names = self._names
+        res = {}
+        for key, value in viewitems(json_loads(line)):
+            try:
+                name = names[key]
+            except KeyError:
+                name = names[key] = key.replace('.', '_')
+                if name != '_path':
+                    self.fields.append(name)
+            res[name] = value
+        res.pop('_path', None)
+        if len(res) < len(self.fields):
+            for name in self.fields:
+                res.setdefault(name, None)
+        for name in self.time_fields:
+            value = res.get(name)
+            if value is not None:
+                res[name] = self.fix_time(value)
+        return res
+
+    @staticmethod
+    def fix_time(value):
+        """Converts a time value (an epoch timestamp, or an ISO 8601 string
+        when JSON::TS_ISO8601 is used) to a datetime instance, like
+        ZeekFile does.
+
+        """
+        if isinstance(value, basestring):
+            value = datetime.datetime.strptime(
+                value.rstrip('Z'),
+                '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else
+                '%Y-%m-%dT%H:%M:%S',
+            )
+            value = (calendar.timegm(value.timetuple()) +
+                     value.microsecond / 1000000.)
+        return datetime.datetime.fromtimestamp(value)
+
+    @property
+    def field_types(self):
+        return [(field, None) for field in self.fields]
@@ -22,6 +22,7 @@
 """
 
 
+import functools
 import hashlib
 import re
 import struct
@@ -364,10 +365,53 @@ records.
     return {}
 
 
+# Log the cache statistics every _CACHE_LOG_INTERVAL lookups
+_CACHE_LOG_INTERVAL = 100000
+_CACHE_MISS = object()
+
+
+def _cached(keyfunc):
+    """Decorator that memoizes the results of a _getinfos_*() function,
+    which are often computed for identical payloads (e.g., the same
+    banner sent by many hosts).
+
+    `keyfunc` gets the same arguments as the decorated function, and
+    returns a tuple whose last element is the payload. The entry size
+    is the estimated memory used by the key and the result (see
+    config.PASSIVE_CACHE_SIZE).
+
+    The results are shared between the calls and must not be modified
+    (getinfos() copies the "infos" dict it returns).
+
+    """
+    def decorator(func):
+        cache = utils.LRUCache(config.PASSIVE_CACHE_SIZE,
+                               sizefunc=lambda key, value: (
+                                   utils.estimate_size(key) +
+                                   utils.estimate_size(value)
+                               ),
+                               name="passive.%s() cache" % func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kargs):
+            key = keyfunc(*args, **kargs)
+            result = cache.get(key, _CACHE_MISS)
+            if result is _CACHE_MISS:
+                result = cache[key] = func(*args, **kargs)
+            if not (cache.hits + cache.misses) % _CACHE_LOG_INTERVAL:
+                cache.log_stats()
+            return result
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
 def _getinfos_cert(spec):
     """Extract info from a certificate (hash values, issuer, subject,
     algorithm) in an handy-to-index-and-query form.
 
+    The results are cached by utils.get_cert_info().
+
     """
     # TODO: move to mongodb specific functions.
     try:
@@ -405,6 +449,7 @@ def _getinfos_ja3_hassh(spec):
     return {'infos': info}
 
 
+@_cached(lambda banner, proto="tcp", probe="NULL": (proto, probe, banner))
 def _getinfos_from_banner(banner, proto="tcp", probe="NULL"):
     infos = utils.match_nmap_svc_fp(banner, proto=proto, probe=probe)
     if not infos:
@@ -432,6 +477,7 @@ def _getinfos_ssh(spec):
     ) + b'\r\n')
 
 
+@_cached(lambda spec: (spec['value'],))
 def _getinfos_ssh_hostkey(spec):
     """Parse SSH host keys."""
     infos = {}
@@ -474,4 +520,9 @@ def getinfos(spec):
         function = function.get(spec.get('source'))
     if function is None:
         return {}
-    return function(spec)
+    res = function(spec)
+    # The results of the _cached() functions are shared, and the
+    # backends may modify the "infos" values of the records
+    if 'infos' in res:
+        res = dict(res, infos=dict(res['infos']))
+    return res
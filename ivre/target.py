@@ -39,7 +39,6 @@ import tempfile
 
 
 from builtins import object
-from future.utils import viewvalues
 from past.builtins import basestring
 
 
@@ -376,8 +375,8 @@ class TargetZMapPreScan(TargetFile):
         self.infos['zmap_pre_scan'] = zmap_opts[:]
         zmap_opts = [zmap] + zmap_opts + ['-o', '-']
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
-        for start, count in viewvalues(target.targets.ranges):
-            for net in utils.range2nets((start, start + count - 1)):
+        for start, stop in target.targets.iter_int_ranges():
+            for net in utils.range2nets((start, stop)):
                 self.tmpfile.write("%s\n" % net)
         self.tmpfile.close()
         zmap_opts += ['-w', self.tmpfile.name]
@@ -424,8 +423,8 @@ class TargetNmapPreScan(TargetZMapPreScan):
         # using a temporary file
         self.tmpfile = tempfile.NamedTemporaryFile(delete=False, mode='w')
         nmap_opts = [nmap, '-iL', self.tmpfile.name, '-oG', '-'] + nmap_opts
-        for start, count in viewvalues(target.targets.ranges):
-            for net in utils.range2nets((start, start + count - 1)):
+        for start, stop in target.targets.iter_int_ranges():
+            for net in utils.range2nets((start, stop)):
                 self.tmpfile.write("%s\n" % net)
         self.tmpfile.close()
         self.proc = subprocess.Popen(nmap_opts, stdout=subprocess.PIPE)
@@ -21,27 +21,173 @@
 
 
 from __future__ import print_function
+import argparse
+import multiprocessing
+import time
+
+
+from future.utils import viewitems
 
 
 from ivre.db import db, DB
 from ivre.view import from_passive, from_nmap, to_view
+from ivre import utils
 
 
-import argparse
+# Number of address ranges per worker process (--processes): the hosts
+# are not evenly distributed over the address space, so we need more
+# ranges than processes to keep every process busy.
+PARTITIONS_PER_PROCESS = 16
+
+
+def get_partitions(count):
+    """Splits the address space in `count` IPv4 ranges and two IPv6
+    ranges. IPv4 addresses may be stored as IPv4-mapped IPv6 addresses
+    (::ffff:0:0/96), so the IPv6 ranges exclude this network. Returns a
+    list of (start, stop) tuples, with addresses as strings.
+
+    """
+    bounds = [(1 << 32) * i // count for i in range(count + 1)]
+    return [
+        (utils.int2ip(start), utils.int2ip(stop - 1))
+        for start, stop in zip(bounds, bounds[1:])
+    ] + [
+        ('::', '::fffe:ffff:ffff'),
+        ('::1:0:0:0', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'),
+    ]
+
+
+def get_filter(args, dbase):
+    """Returns the filter to use with `dbase` (db.nmap or db.passive),
+    according to the parsed command line arguments `args`.
+
+    """
+    if args.view_source == 'all':
+        return DB().parse_args(args, flt=dbase.flt_empty)
+    return dbase.parse_args(args, dbase.flt_empty)
+
+
+def get_time_ranges(args):
+    """Used with --incremental: returns a dict associating each source
+    ("nmap", "passive") to a (start, stop) tuple, where `start` is the
+    watermark stored in the view (or None for the first run) and `stop`
+    the most recent time (endtime for Nmap, lastseen for passive) of the
+    source's records (or None when there are no records).
+
+    """
+    result = {}
+    for name, dbase, field in [('nmap', db.nmap, 'endtime'),
+                               ('passive', db.passive, 'lastseen')]:
+        if dbase is None or args.view_source not in ['all', name]:
+            continue
+        stop = None
+        for rec in dbase.get(get_filter(args, dbase), sort=[(field, -1)],
+                             limit=1):
+            stop = utils.all2datetime(rec[field])
+        result[name] = (db.view.get_watermark(name), stop)
+    return result
+
+
+def get_sources(args, addr_range=None):
+    """Returns the list of iterators over view-formatted records to
+    merge, according to the parsed command line arguments `args`. When
+    `addr_range` is set, only the records whose address is within
+    `addr_range` (a (start, stop) tuple) are considered.
+
+    With --incremental, only the records between the time bounds in
+    `args.time_ranges` (see get_time_ranges()) are considered.
+
+    """
+    result = []
+    for name, dbase, from_func in [('nmap', db.nmap, from_nmap),
+                                   ('passive', db.passive, from_passive)]:
+        if dbase is None or args.view_source not in ['all', name]:
+            continue
+        flt = get_filter(args, dbase)
+        if args.time_ranges is not None:
+            start, stop = args.time_ranges[name]
+            if stop is None or (start is not None and stop <= start):
+                # Nothing new
+                continue
+            # nmap records are dated by their endtime, passive records
+            # by their lastseen value; the records at the previous
+            # watermark have already been merged.
+            kwargs = {} if name == 'nmap' else {'new': False}
+            flt = dbase.flt_and(flt, dbase.searchnewer(stop, neg=True,
+                                                       **kwargs))
+            if start is not None:
+                flt = dbase.flt_and(flt, dbase.searchnewer(start, **kwargs))
+        if addr_range is not None:
+            flt = dbase.flt_and(flt, dbase.searchrange(*addr_range))
+        result.append(from_func(flt, category=args.view_category))
+    return result
+
+
+# Parallel mode: each worker process builds the view for the address
+# ranges it is given, using its own database connections (see
+# _init_worker()).
+WORKER_ARGS = None
+
+
+def _init_worker(args):
+    """Initializes a worker process: drops the database objects
+inherited from the parent process, so that new connections get
+created, and stores the command line arguments.
+
+    """
+    global WORKER_ARGS
+    db.reset()
+    WORKER_ARGS = args
+
+
+def _build_partition(partition):
+    """Builds the view for one address range; `partition` is a (number,
+(start, stop)) tuple. Returns a (number, (start, stop), count) tuple.
+
+    """
+    number, addr_range = partition
+    start_time = time.time()
+    itr = to_view(get_sources(WORKER_ARGS, addr_range=addr_range))
+    count = 0
+    db.view.start_store_hosts()
+    try:
+        if WORKER_ARGS.no_merge:
+            for rec in itr:
+                db.view.store_host(rec)
+                count += 1
+        else:
+            count = db.view.store_or_merge_hosts(itr)
+    finally:
+        db.view.stop_store_hosts()
+    utils.LOGGER.debug('Range %s - %s: %d hosts in %.1fs', addr_range[0],
+                       addr_range[1], count, time.time() - start_time)
+    return number, addr_range, count
+
+
+def build(args):
+    """Builds the view (without --processes)."""
+    if args.test:
+
+        def output(x):
+            print(x)
+    elif args.no_merge:
+        output = db.view.store_host
+    else:
+        output = None
+    # Output results
+    itr = to_view(get_sources(args))
+    if not itr:
+        return
+    if output is None:
+        db.view.store_or_merge_hosts(itr)
+        return
+    for elt in itr:
+        output(elt)
 
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__,
                                      parents=[DB().argparser])
-    if db.nmap is None:
-        fltnmap = None
-    else:
-        fltnmap = db.nmap.flt_empty
-    if db.passive is None:
-        fltpass = None
-    else:
-        fltpass = db.passive.flt_empty
-    _from = []
 
     parser.add_argument('--view-category', metavar='CATEGORY',
                         help='Choose a different category than the default')
@@ -53,6 +199,16 @@ def main():
     parser.add_argument('--no-merge', action='store_true', help='Do **not** '
                         'merge with existing results for same host and '
                         'source.')
+    parser.add_argument('--processes', metavar='COUNT', type=int, default=1,
+                        help='Split the address space in ranges and build '
+                        'the view for these ranges in parallel, using COUNT '
+                        'worker processes (0 means one per CPU); not '
+                        'available with file-based backends (TinyDB).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only merge the records added or updated '
+                        'since the previous --incremental run (this is '
+                        'tracked with per-source watermarks stored in the '
+                        'view database).')
 
     subparsers = parser.add_subparsers(
         dest='view_source',
@@ -67,38 +223,68 @@ def main():
 
     args = parser.parse_args()
 
-    view_category = args.view_category
     if not args.view_source:
         args.view_source = 'all'
-    if args.view_source == 'all':
-        _from = []
-        if db.nmap is not None:
-            fltnmap = DB().parse_args(args, flt=fltnmap)
-            _from.append(from_nmap(fltnmap, category=view_category))
-        if db.passive is not None:
-            fltpass = DB().parse_args(args, flt=fltpass)
-            _from.append(from_passive(fltpass, category=view_category))
-    elif args.view_source == 'nmap':
+    if args.view_source == 'nmap':
         if db.nmap is None:
             parser.error('Cannot use "nmap" (no Nmap database exists)')
-        fltnmap = db.nmap.parse_args(args, fltnmap)
-        _from = [from_nmap(fltnmap, category=view_category)]
     elif args.view_source == 'passive':
         if db.passive is None:
             parser.error('Cannot use "passive" (no Passive database exists)')
-        fltpass = db.passive.parse_args(args, fltpass)
-        _from = [from_passive(fltpass, category=view_category)]
-    if args.test:
-
-        def output(x):
-            print(x)
-    elif args.no_merge:
-        output = db.view.store_host
+    if args.processes != 1 and args.test:
+        parser.error('argument --processes: not allowed with --test')
+    if args.processes != 1 and not db.view.concurrent_writes:
+        parser.error('argument --processes: not supported with this '
+                     'backend')
+    args.time_ranges = None
+    if args.incremental:
+        if args.test:
+            parser.error('argument --incremental: not allowed with --test')
+        if args.no_merge:
+            parser.error('argument --incremental: not allowed with '
+                         '--no-merge')
+        try:
+            args.time_ranges = get_time_ranges(args)
+        except NotImplementedError:
+            # The view backend cannot store watermarks
+            parser.error('argument --incremental: not supported with this '
+                         'backend')
+        for name, (start, stop) in viewitems(args.time_ranges):
+            utils.LOGGER.info('Incremental mode: %s records from %s to %s',
+                              name, start, stop)
+    if args.processes != 1:
+        processes = args.processes or multiprocessing.cpu_count()
+        partitions = list(enumerate(get_partitions(
+            processes * PARTITIONS_PER_PROCESS
+        )))
+        pool = multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_worker,
+            initargs=(args,),
+        )
+        total = 0
+        try:
+            for i, (number, addr_range, count) in enumerate(
+                    pool.imap_unordered(_build_partition, partitions,
+                                        chunksize=1),
+                    start=1,
+            ):
+                total += count
+                utils.LOGGER.info(
+                    'Range %d (%s - %s) done: %d hosts [%d/%d ranges done, '
+                    '%d hosts]', number, addr_range[0], addr_range[1], count,
+                    i, len(partitions), total,
+                )
+        except BaseException:
+            # Do not leave the workers behind (e.g., on Ctrl-C)
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
     else:
-        output = db.view.store_or_merge_host
-    # Output results
-    itr = to_view(_from)
-    if not itr:
-        return
-    for elt in itr:
-        output(elt)
+        build(args)
+    if args.incremental:
+        for name, (_, stop) in viewitems(args.time_ranges):
+            if stop is not None:
+                db.view.set_watermark(name, stop)
@@ -78,13 +78,9 @@ def main():
                         fname,
                     )
                     continue
-        bulk = db.flow.start_bulk_insert()
         with fileparser(fname, args.pcap_filter) as fdesc:
-            for rec in fdesc:
-                if not rec:
-                    continue
-                db.flow.flow2flow(bulk, rec)
-        db.flow.bulk_commit(bulk)
+            db.flow.bulk_insert(db.flow.flow2flow,
+                                (rec for rec in fdesc if rec))
 
     if not args.no_cleanup:
         db.flow.cleanup_flows()
@@ -88,6 +88,14 @@ def main():
     parser.add_argument('--ensure-indexes', action='store_true',
                         help='Create missing indexes (will lock the '
                         'database).')
+    parser.add_argument('--cleanup', action='store_true',
+                        help='Run the port cleanup heuristics (switched '
+                        'source and destination) on all the flows.')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='Only with MongoDB backend. Compute again the '
+                        'rollup collections used by --flow-daily, --top '
+                        'and --count (needed for flows inserted with older '
+                        'versions or after an import error).')
     parser.add_argument('--node-filters', '-n', nargs="+", metavar="FILTER",
                         help='Filter the results with a list of ivre specific '
                         'node textual filters (see WebUI doc in FLOW.md).')
@@ -203,6 +211,14 @@ def main():
         db.flow.ensure_indexes()
         sys.exit(0)
 
+    if args.cleanup:
+        db.flow.cleanup_flows(full=True)
+        sys.exit(0)
+
+    if args.rebuild_rollups:
+        db.flow.rebuild_rollups()
+        sys.exit(0)
+
     if args.fields is not None and not args.fields:
         # Print fields list
         print_fields()
@@ -21,7 +21,9 @@
 
 
 from argparse import ArgumentParser
+from collections import deque
 import functools
+import multiprocessing
 import signal
 import sys
 
@@ -60,6 +62,73 @@ def rec_iter(zeek_parser, sensor, ignore_rules):
         )
 
 
+# Parallel mode (--workers): the main process parses the Zeek log and
+# writes the records to the database, while the worker processes run
+# handle_rec() and getinfos() (which can be CPU intensive, e.g., to
+# parse certificates) on batches of lines.
+LINES_PER_BATCH = 1000
+WORKER_ARGS = None
+
+
+def _init_worker(sensor, ignore_rules):
+    global WORKER_ARGS
+    WORKER_ARGS = (sensor, ignore_rules)
+
+
+def _handle_lines(lines):
+    """Returns the list of (timestamp, spec) tuples for the (parsed)
+Zeek `lines`, with their "infos" value computed.
+
+    """
+    result = []
+    for timestamp, spec in rec_iter(lines, *WORKER_ARGS):
+        if spec is not None:
+            spec.update(ivre.passive.getinfos(spec))
+        result.append((timestamp, spec))
+    return result
+
+
+def _getinfos_computed(spec):
+    """Replaces ivre.passive.getinfos() in the main process, since the
+"infos" values have already been computed by the workers.
+
+    """
+    if 'infos' in spec:
+        return {'infos': spec['infos']}
+    return {}
+
+
+def rec_iter_parallel(zeek_parser, sensor, ignore_rules, workers):
+    """Like rec_iter(), but the records are handled by `workers`
+worker processes (0 means one per CPU). The records are not yielded in
+order.
+
+    """
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(
+        processes=workers,
+        initializer=_init_worker,
+        initargs=(sensor, dict(
+            (key, ignore_rules[key]) for key in ['IGNORENETS', 'NEVERIGNORE']
+            if key in ignore_rules
+        )),
+    )
+    # Limit the number of pending batches, so that the log is not
+    # read faster than the records can be processed
+    pending = deque()
+    for lines in iter(lambda: zeek_parser.parse_lines(LINES_PER_BATCH), []):
+        pending.append(pool.apply_async(_handle_lines, (lines,)))
+        if len(pending) >= 2 * workers:
+            for rec in pending.popleft().get():
+                yield rec
+    while pending:
+        for rec in pending.popleft().get():
+            yield rec
+    pool.close()
+    pool.join()
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument('--sensor', '-s', help='Sensor name')
@@ -71,6 +140,11 @@ def main():
                         help='Use local (memory) bulk inserts')
     parser.add_argument('--no-bulk', action='store_true',
                         help='Do not use bulk inserts')
+    parser.add_argument('--workers', metavar='COUNT', type=int, default=1,
+                        help='Handle the records (including the parsing of '
+                        'certificates, banners, etc.) using COUNT worker '
+                        'processes (0 means one per CPU); records are not '
+                        'inserted in order.')
     args = parser.parse_args()
     ignore_rules = _get_ignore_rules(args.ignore_spec)
     if (not (args.no_bulk or args.local_bulk)) or args.bulk:
@@ -88,7 +162,14 @@ def main():
     except AttributeError:
         stdin = sys.stdin
     zeek_parser = ivre.parser.zeek.ZeekFile(stdin)
-    function(
-        rec_iter(zeek_parser, args.sensor, ignore_rules),
-        getinfos=ivre.passive.getinfos
-    )
+    if args.workers == 1:
+        function(
+            rec_iter(zeek_parser, args.sensor, ignore_rules),
+            getinfos=ivre.passive.getinfos
+        )
+    else:
+        function(
+            rec_iter_parallel(zeek_parser, args.sensor, ignore_rules,
+                              args.workers),
+            getinfos=_getinfos_computed
+        )
@@ -26,10 +26,24 @@ import re
 import shutil
 import signal
 import subprocess
+import threading
 import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+try:
+    import pyinotify
+except ImportError:
+    USE_INOTIFY = False
+else:
+    USE_INOTIFY = True
 
 
-from ivre import config, utils
+from future.utils import viewitems, viewvalues
+
+
+from ivre import utils
 
 
 SENSORS = {}  # shortname: fullname
@@ -37,6 +51,13 @@ FILEFORMAT = "^(?P<sensor>%s)\\.(?P<datetime>[0-9-]+)\\.log(?:\\.gz)?$"
 SLEEPTIME = 2
 CMDLINE = "%(progname)s -s %(sensor)s"
 WANTDOWN = False
+# Maximum number of files taken (moved to the "current" directory) but
+# not yet processed, per sensor
+QUEUE_SIZE = 2
+# Size of the chunks (made of whole lines) sent to the processes
+CHUNK_SIZE = 1024 * 1024
+# Interval (in seconds) between two reports of the queues
+METRICS_INTERVAL = 60
 
 
 def shutdown(signum, _):
@@ -45,28 +66,118 @@ def shutdown(signum, _):
 
     """
     global WANTDOWN
-    utils.LOGGER.info('SHUTDOWN: got signal %d, will halt after current file.',
-                      signum)
+    utils.LOGGER.info('SHUTDOWN: got signal %d, will halt after current '
+                      'files.', signum)
     WANTDOWN = True
 
 
+def _file_key(match):
+    """Returns the sort key (the date) for the `match` (FILEFORMAT
+    match) of a filename.
+
+    """
+    return [int(val) for val in match.groupdict()['datetime'].split('-')]
+
+
+def _get_format(sensor=None):
+    if sensor is None:
+        return re.compile(FILEFORMAT % "[^\\.]*")
+    return re.compile(FILEFORMAT % re.escape(sensor))
+
+
 def getnextfiles(directory, sensor=None, count=1):
     """Returns a list of maximum `count` filenames (as FILEFORMAT matches)
     to process, given the `directory` and the `sensor` (or, if it is
     `None`, from any sensor).
 
     """
-    if sensor is None:
-        fmt = re.compile(FILEFORMAT % "[^\\.]*")
-    else:
-        fmt = re.compile(FILEFORMAT % re.escape(sensor))
+    fmt = _get_format(sensor=sensor)
     files = (fmt.match(f) for f in os.listdir(directory))
     files = [f for f in files if f is not None]
-    files.sort(key=lambda x: [int(val) for val in
-                              x.groupdict()['datetime'].split('-')])
+    files.sort(key=_file_key)
     return files[:count]
 
 
+class FileWatcher(object):
+    """Keeps track of the files to process in `directory`, for `sensor`
+    (or, if it is `None`, for any sensor).
+
+    When pyinotify is available, new files are reported by inotify;
+    otherwise, the directory is listed (at most every SLEEPTIME
+    seconds) when .wait() is called.
+
+    """
+
+    def __init__(self, directory, sensor=None):
+        self.directory = directory
+        self.fmt = _get_format(sensor=sensor)
+        self.files = {}  # filename: FILEFORMAT match
+        self.last_scan = None
+        if USE_INOTIFY:
+            wmanager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(
+                wmanager, default_proc_fun=self._event,
+            )
+            # Files are only reported once they have been written
+            wmanager.add_watch(directory,
+                               pyinotify.IN_CLOSE_WRITE |
+                               pyinotify.IN_MOVED_TO)
+        else:
+            self.notifier = None
+        # Files created before the watch
+        self.scan()
+
+    def _add(self, fname):
+        match = self.fmt.match(fname)
+        if match is not None:
+            self.files[fname] = match
+
+    def _event(self, event):
+        self._add(event.name)
+
+    def scan(self):
+        for fname in os.listdir(self.directory):
+            self._add(fname)
+        self.last_scan = time.time()
+
+    def wait(self, timeout=SLEEPTIME):
+        """Waits for new files, at most `timeout` seconds."""
+        if self.notifier is None:
+            time.sleep(timeout)
+            if time.time() - self.last_scan >= SLEEPTIME:
+                self.scan()
+        elif self.notifier.check_events(timeout=int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def pop(self, exclude=None):
+        """Returns the oldest file (as a FILEFORMAT match) whose sensor is
+        not in `exclude` and removes it from the known files, or returns
+        None.
+
+        """
+        candidates = [match for match in viewvalues(self.files)
+                      if not exclude or
+                      match.groupdict()['sensor'] not in exclude]
+        if not candidates:
+            return None
+        match = min(candidates, key=_file_key)
+        del self.files[match.group()]
+        return match
+
+    def backlog(self):
+        """Returns a dict sensor: number of known files to process."""
+        result = {}
+        for match in viewvalues(self.files):
+            sensor = match.groupdict()['sensor']
+            result[sensor] = result.get(sensor, 0) + 1
+        return result
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+
+
 def create_process(progname, sensor):
     """Creates the insertion process for the given `sensor` using
     `progname`.
@@ -81,65 +192,171 @@ def create_process(progname, sensor):
     )
 
 
+def iter_chunks(fdesc, size=CHUNK_SIZE):
+    """Yields the content of `fdesc` by chunks of (about) `size` bytes,
+    made of whole lines.
+
+    """
+    rest = b""
+    while True:
+        data = fdesc.read(size)
+        if not data:
+            if rest:
+                yield rest
+            return
+        data = rest + data
+        pos = data.rfind(b"\n") + 1
+        if pos:
+            yield data[:pos]
+            rest = data[pos:]
+        else:
+            rest = data
+
+
+class SensorFeeder(threading.Thread):
+    """Thread that feeds the files of a sensor, taken from its queue,
+    to a long-lived insertion process.
+
+    """
+
+    def __init__(self, progname, directory, sensor):
+        super(SensorFeeder, self).__init__(name="feeder-%s" % sensor)
+        self.daemon = True
+        self.progname = progname
+        self.directory = directory
+        self.sensor = sensor
+        self.queue = Queue()
+        self.proc = None
+        # Each counter is only updated by one thread
+        self.queued = 0  # main thread
+        self.handled = 0  # this thread
+        self.handled_bytes = 0  # this thread
+
+    @property
+    def depth(self):
+        """Number of files queued and not yet processed."""
+        return self.queued - self.handled
+
+    def put(self, fname):
+        self.queued += 1
+        self.queue.put(fname)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def _write(self, data):
+        """Writes `data` to the insertion process, creating a new one if
+        needed. Returns False on failure.
+
+        """
+        for _ in range(2):
+            if self.proc is None or self.proc.poll() is not None:
+                self.proc = create_process(self.progname, self.sensor)
+            try:
+                self.proc.stdin.write(data)
+                return True
+            except (IOError, OSError, ValueError):
+                # Second (and last) try with a new process
+                utils.LOGGER.warning("Error while sending data for sensor "
+                                     "%s. Trying again", self.sensor)
+                self.proc = None
+        utils.LOGGER.warning("  ... KO")
+        return False
+
+    def handle(self, fname):
+        utils.LOGGER.debug("Handling %s", fname)
+        handled_ok = True
+        with utils.open_file(fname) as fdesc:
+            for data in iter_chunks(fdesc):
+                if not self._write(data):
+                    handled_ok = False
+                self.handled_bytes += len(data)
+        if handled_ok:
+            os.unlink(fname)
+            utils.LOGGER.debug('  ... OK')
+        else:
+            utils.LOGGER.debug('  ... KO')
+
+    def run(self):
+        while True:
+            fname = self.queue.get()
+            if fname is None:
+                break
+            try:
+                if WANTDOWN:
+                    # Give the file back
+                    shutil.move(fname, self.directory)
+                else:
+                    self.handle(fname)
+            except Exception:
+                # The file is left in the "current" directory, like
+                # the files that could not be sent to the process
+                utils.LOGGER.error("Cannot handle %s", fname, exc_info=True)
+            # The file must not count in the sensor's queue anymore
+            self.handled += 1
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
 def worker(progname, directory, sensor=None):
-    """This function is the main loop, creating the processes when
-    needed and feeding them with the data from the files.
+    """This function is the main loop: it takes the files to process
+    (the oldest first) and dispatches them to one thread (and one
+    insertion process) per sensor.
+
+    At most QUEUE_SIZE files per sensor are taken at once, so that other
+    workers using the same directory can handle the other ones.
 
     """
     utils.makedirs(os.path.join(directory, "current"))
-    procs = {}
+    watcher = FileWatcher(directory, sensor=sensor)
+    feeders = {}
+    last_metrics = time.time()
     while not WANTDOWN:
+        if time.time() - last_metrics >= METRICS_INTERVAL:
+            last_metrics = time.time()
+            backlog = watcher.backlog()
+            for fname_sensor in sorted(set(feeders).union(backlog)):
+                feeder = feeders.get(fname_sensor)
+                utils.LOGGER.info(
+                    "Sensor %s: %d file(s) waiting, %d file(s) queued, %d "
+                    "file(s) (%d bytes) processed", fname_sensor,
+                    backlog.get(fname_sensor, 0),
+                    0 if feeder is None else feeder.depth,
+                    0 if feeder is None else feeder.handled,
+                    0 if feeder is None else feeder.handled_bytes,
+                )
         # We get the next file to handle
-        fname = getnextfiles(directory, sensor=sensor, count=1)
-        # ... if we don't, we sleep for a while
-        if not fname:
-            utils.LOGGER.debug("Sleeping for %d s", SLEEPTIME)
-            time.sleep(SLEEPTIME)
+        fname = watcher.pop(exclude=set(
+            fname_sensor for fname_sensor, feeder in viewitems(feeders)
+            if feeder.depth >= QUEUE_SIZE
+        ))
+        # ... if we don't, we wait for a while
+        if fname is None:
+            utils.LOGGER.debug("Waiting for at most %d s", SLEEPTIME)
+            # When some files are waiting for their sensor's queue,
+            # check again soon
+            watcher.wait(timeout=0.1 if watcher.files else SLEEPTIME)
             continue
-        fname = fname[0]
         fname_sensor = fname.groupdict()['sensor']
-        if fname_sensor in procs:
-            proc = procs[fname_sensor]
-        else:
-            proc = create_process(progname, fname_sensor)
-            procs[fname_sensor] = proc
         fname = fname.group()
         # Our "lock system": if we can move the file, it's ours
         try:
             shutil.move(os.path.join(directory, fname),
                         os.path.join(directory, "current"))
-        except shutil.Error:
+        except (shutil.Error, IOError, OSError):
             continue
-        if config.DEBUG:
-            utils.LOGGER.debug("Handling %s", fname)
-        fname = os.path.join(directory, "current", fname)
-        fdesc = utils.open_file(fname)
-        handled_ok = True
-        for line in fdesc:
-            try:
-                proc.stdin.write(line)
-            except ValueError:
-                utils.LOGGER.warning("Error while handling line %r. "
-                                     "Trying again", line)
-                proc = create_process(progname, fname_sensor)
-                procs[fname_sensor] = proc
-                # Second (and last) try
-                try:
-                    proc.stdin.write(line)
-                    utils.LOGGER.warning("  ... OK")
-                except ValueError:
-                    handled_ok = False
-                    utils.LOGGER.warning("  ... KO")
-        fdesc.close()
-        if handled_ok:
-            os.unlink(fname)
-            utils.LOGGER.debug('  ... OK')
-        else:
-            utils.LOGGER.debug('  ... KO')
+        if fname_sensor not in feeders:
+            feeders[fname_sensor] = SensorFeeder(progname, directory,
+                                                 fname_sensor)
+            feeders[fname_sensor].start()
+        feeders[fname_sensor].put(os.path.join(directory, "current", fname))
     # SHUTDOWN
-    for sensorjob in procs:
-        procs[sensorjob].stdin.close()
-        procs[sensorjob].wait()
+    for feeder in viewvalues(feeders):
+        feeder.stop()
+    for feeder in viewvalues(feeders):
+        feeder.join()
+    watcher.close()
 
 
 def main():
@@ -22,6 +22,7 @@
 
 from __future__ import print_function
 from argparse import ArgumentParser
+import multiprocessing
 import os
 import sys
 
@@ -54,6 +55,51 @@ base_directories does not exist.
                 yield os.path.join(root, leaffile)
 
 
+def update_view_callback(host):
+    """Callback used with --update-view to merge each imported host
+in the current view.
+
+    """
+    return ivre.db.db.view.store_or_merge_host(nmap_record_to_view(host))
+
+
+def store_scan(database, scan, kargs):
+    """Stores the scan result file `scan` using `database`. Returns
+a tuple (imported, error), where `imported` is True when the file has
+been imported and `error` is True when an error has occurred.
+
+    """
+    if not os.path.exists(scan):
+        ivre.utils.LOGGER.warning('file %r does not exist', scan)
+        return False, True
+    try:
+        return bool(database.store_scan(scan, **kargs)), False
+    except Exception:
+        ivre.utils.LOGGER.warning("Exception (file %r)", scan, exc_info=True)
+        return False, True
+
+
+# Parallel import mode: each worker process gets its own database
+# connections (see _init_worker()) and parses the files it is given
+# with its own content handler.
+WORKER_KARGS = None
+
+
+def _init_worker(kargs):
+    """Initializes a worker process: drops the database objects
+inherited from the parent process, so that new connections get
+created, and stores the arguments to use with .store_scan().
+
+    """
+    global WORKER_KARGS
+    ivre.db.db.reset()
+    WORKER_KARGS = kargs
+
+
+def _store_scan_worker(scan):
+    return store_scan(ivre.db.db.nmap, scan, WORKER_KARGS)
+
+
 def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument('scan', nargs='*', metavar='SCAN', help='Scan results')
@@ -82,8 +128,17 @@ def main():
                         help='Merge hosts in current view')
     parser.add_argument('--no-update-view', action='store_true',
                         help='Do not merge hosts in current view (default)')
+    parser.add_argument('-j', '--jobs', metavar='COUNT', type=int, default=1,
+                        help='Import COUNT files in parallel, using as many '
+                        'worker processes (0 means one per CPU); not '
+                        'available with file-based backends (TinyDB).')
     args = parser.parse_args()
+    if args.jobs != 1 and (args.test or args.test_normal):
+        parser.error('argument --jobs: not allowed with --test or '
+                     '--test-normal')
     database = ivre.db.db.nmap
+    if args.jobs != 1 and not database.concurrent_writes:
+        parser.error('argument --jobs: not supported with this backend')
     categories = args.categories.split(',') if args.categories else []
     if args.test:
         args.update_view = False
@@ -103,28 +158,44 @@ def main():
     if not args.update_view or args.no_update_view:
         callback = None
     else:
-        def callback(x):
-            return ivre.db.db.view.store_or_merge_host(
-                nmap_record_to_view(x)
-            )
+        callback = update_view_callback
+        if args.jobs != 1 and not ivre.db.db.view.concurrent_writes:
+            parser.error('argument --jobs: not supported with this view '
+                         'backend')
+    kargs = {
+        'categories': categories,
+        'source': args.source,
+        'needports': args.ports,
+        'needopenports': args.open_ports,
+        'force_info': args.force_info,
+        'masscan_probes': args.masscan_probes,
+        'callback': callback,
+    }
     count = 0
-    for scan in scans:
-        if not os.path.exists(scan):
-            ivre.utils.LOGGER.warning('file %r does not exist', scan)
-            error[0] = True
-            continue
-        try:
-            if database.store_scan(
-                    scan,
-                    categories=categories, source=args.source,
-                    needports=args.ports, needopenports=args.open_ports,
-                    force_info=args.force_info,
-                    masscan_probes=args.masscan_probes, callback=callback,
-            ):
+    if args.jobs == 1:
+        pool = None
+        results = (store_scan(database, scan, kargs) for scan in scans)
+    else:
+        pool = multiprocessing.Pool(
+            processes=args.jobs or None,
+            initializer=_init_worker,
+            initargs=(kargs,),
+        )
+        results = pool.imap_unordered(_store_scan_worker, scans, chunksize=1)
+    try:
+        for imported, failed in results:
+            if imported:
                 count += 1
-        except Exception:
-            ivre.utils.LOGGER.warning("Exception (file %r)", scan,
-                                      exc_info=True)
-            error[0] = True
+            if failed:
+                error[0] = True
+    except BaseException:
+        # Do not leave the workers behind (e.g., on Ctrl-C)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
     ivre.utils.LOGGER.info("%d results imported.", count)
     sys.exit(error[0])
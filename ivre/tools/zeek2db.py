@@ -20,6 +20,7 @@
 
 
 from argparse import ArgumentParser
+import multiprocessing
 import os
 
 
@@ -77,8 +78,8 @@ def _sip_paths_search_tcp(paths):
 
 
 def sip2flow(bulk, rec):
-    found_tcp = (_sip_paths_search_tcp(rec['response_path']) or
-                 _sip_paths_search_tcp(rec['request_path']))
+    found_tcp = (_sip_paths_search_tcp(rec.get('response_path') or []) or
+                 _sip_paths_search_tcp(rec.get('request_path') or []))
     rec["proto"] = "tcp" if found_tcp else "udp"
     db.flow.any2flow(bulk, 'sip', rec)
 
@@ -99,9 +100,8 @@ def rdp2flow(bulk, rec):
 
 
 def dns2flow(bulk, rec):
-    rec['answers'] = [elt.lower() for elt in
-                      (rec['answers'] if rec['answers'] else [])]
-    rec['query'] = rec['query'].lower() if rec['query'] else None
+    rec['answers'] = [elt.lower() for elt in (rec.get('answers') or [])]
+    rec['query'] = rec['query'].lower() if rec.get('query') else None
     db.flow.any2flow(bulk, 'dns', rec)
 
 
@@ -124,6 +124,98 @@ def any2flow(name):
     return inserter
 
 
+def _get_function(path):
+    """Returns the function used to insert the records from a log file
+of type `path`, or None when this log type is not supported.
+
+    """
+    if path in FUNCTIONS:
+        return FUNCTIONS[path]
+    if path in flow.META_DESC:
+        return any2flow(path)
+    return None
+
+
+def _open_file(fname):
+    zeekf = ZeekFile(fname)
+    utils.LOGGER.debug("Parsing %s\n\t%s", fname,
+                       "Fields:\n%s\n" % "\n".join(
+                           "%s: %s" % (f, t)
+                           for f, t in zeekf.field_types
+                       ))
+    if _get_function(zeekf.path) is None:
+        utils.LOGGER.debug("Log format not (yet) supported for %r", fname)
+    return zeekf
+
+
+# Parallel mode (--jobs): the worker processes parse the log files
+# and send batches of records, through a queue, to the main process
+# that writes them to the database (using a single bulk). None is
+# sent when a file has been handled.
+LINES_PER_BATCH = 1000
+WORKER_QUEUE = None
+
+
+def _init_worker(queue):
+    global WORKER_QUEUE
+    WORKER_QUEUE = queue
+
+
+def _parse_file(fname):
+    try:
+        with _open_file(fname) as zeekf:
+            if _get_function(zeekf.path) is None:
+                return
+            for lines in iter(lambda: zeekf.parse_lines(LINES_PER_BATCH),
+                              []):
+                WORKER_QUEUE.put(
+                    (zeekf.path, [_zeek2flow(line) for line in lines if line])
+                )
+    finally:
+        WORKER_QUEUE.put(None)
+
+
+def _rec_iter_parallel(fnames, jobs, paths):
+    """Yields (function, record) tuples for the records from the log
+files `fnames`, parsed by `jobs` worker processes. The log types found
+are added to the set `paths`.
+
+    """
+    queue = multiprocessing.Queue(maxsize=2 * (jobs or
+                                               multiprocessing.cpu_count()))
+    pool = multiprocessing.Pool(
+        processes=jobs or None,
+        initializer=_init_worker,
+        initargs=(queue,),
+    )
+    results = [pool.apply_async(_parse_file, (fname,)) for fname in fnames]
+    pool.close()
+    functions = {}
+    remaining = len(results)
+    while remaining:
+        batch = queue.get()
+        if batch is None:
+            remaining -= 1
+            continue
+        path, recs = batch
+        try:
+            func = functions[path]
+        except KeyError:
+            func = functions[path] = _get_function(path)
+            paths.add(path)
+        for rec in recs:
+            yield func, rec
+    pool.join()
+    for result in results:
+        # re-raises the exceptions from the worker processes
+        result.get()
+
+
+def _insert(bulk, func_rec):
+    func, rec = func_rec
+    func(bulk, rec)
+
+
 def main():
     """Update the flow database from Zeek logs"""
     parser = ArgumentParser(description=__doc__)
@@ -134,34 +226,34 @@ def main():
     parser.add_argument("-C", "--no-cleanup",
                         help="avoid port cleanup heuristics",
                         action="store_true")
+    parser.add_argument('-j', '--jobs', metavar='COUNT', type=int, default=1,
+                        help='Parse COUNT files in parallel, using as many '
+                        'worker processes (0 means one per CPU); the records '
+                        'are written to the database by the main process.')
     args = parser.parse_args()
 
     if args.verbose:
         config.DEBUG = True
 
+    fnames = []
     for fname in args.logfiles:
         if not os.path.exists(fname):
             utils.LOGGER.error("File %r does not exist", fname)
             continue
-        with ZeekFile(fname) as zeekf:
-            bulk = db.flow.start_bulk_insert()
-            utils.LOGGER.debug("Parsing %s\n\t%s", fname,
-                               "Fields:\n%s\n" % "\n".join(
-                                   "%s: %s" % (f, t)
-                                   for f, t in zeekf.field_types
-                               ))
-            if zeekf.path in FUNCTIONS:
-                func = FUNCTIONS[zeekf.path]
-            elif zeekf.path in flow.META_DESC:
-                func = any2flow(zeekf.path)
-            else:
-                utils.LOGGER.debug("Log format not (yet) supported for %r",
-                                   fname)
-                continue
-            for line in zeekf:
-                if not line:
+        fnames.append(fname)
+    paths = set()
+    if args.jobs == 1:
+        for fname in fnames:
+            with _open_file(fname) as zeekf:
+                func = _get_function(zeekf.path)
+                if func is None:
                     continue
-                func(bulk, _zeek2flow(line))
-            db.flow.bulk_commit(bulk)
-            if zeekf.path == "conn" and not args.no_cleanup:
-                db.flow.cleanup_flows()
+                db.flow.bulk_insert(
+                    func, (_zeek2flow(line) for line in zeekf if line)
+                )
+                paths.add(zeekf.path)
+    else:
+        db.flow.bulk_insert(_insert,
+                            _rec_iter_parallel(fnames, args.jobs, paths))
+    if "conn" in paths and not args.no_cleanup:
+        db.flow.cleanup_flows()
@@ -29,6 +29,8 @@ import argparse
 from bisect import bisect_left
 import bz2
 import codecs
+from collections import OrderedDict
+import copy
 import datetime
 import errno
 import functools
@@ -39,6 +41,7 @@ from io import BytesIO
 import logging
 import math
 import os
+import pickle
 import re
 import shutil
 import socket
@@ -46,15 +49,28 @@ import struct
 import subprocess
 import sys
 import time
+import warnings
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 
 from builtins import bytes, int as int_types, object, range, str
 from future.utils import PY3, viewitems, viewvalues
 from past.builtins import basestring
 try:
-    from OpenSSL import crypto as osslc
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import dh, dsa, ec, rsa
     from cryptography.hazmat.primitives.serialization import \
         Encoding, PublicFormat
+except ImportError:
+    USE_CRYPTOGRAPHY = False
+else:
+    USE_CRYPTOGRAPHY = True
+try:
+    from OpenSSL import crypto as osslc
 except ImportError:
     USE_PYOPENSSL = False
 else:
@@ -840,6 +856,88 @@ LOGGER.addFilter(LogFilter())
 LOGGER.setLevel(1 if config.DEBUG or config.DEBUG_DB else 20)
 
 
+def estimate_size(value):
+    """Returns an estimate of the memory used by `value`, in bytes,
+    including the keys and items of the containers (dict, list, tuple,
+    set) it holds. Objects referenced several times are counted once.
+
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            for item in viewitems(value):
+                stack.extend(item)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+    return size
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts its least recently used entries
+    when the total size of its entries exceeds `maxsize`.
+
+    `sizefunc(key, value)` returns the size of an entry; by default,
+    each entry has a size of 1, so `maxsize` is a number of entries.
+    Use estimate_size() to bound the memory used by the cache. The
+    `hits` and `misses` counters are updated by .get().
+
+    """
+
+    def __init__(self, maxsize, sizefunc=None, name="cache"):
+        self.maxsize = maxsize
+        self.sizefunc = sizefunc
+        self.name = name
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            entry = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        size = 1 if self.sizefunc is None else self.sizefunc(key, value)
+        try:
+            self.size -= self._data.pop(key)[1]
+        except KeyError:
+            pass
+        if not self.maxsize or size > self.maxsize:
+            return
+        self._data[key] = (value, size)
+        self.size += size
+        while self.size > self.maxsize:
+            self.size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def log_stats(self, level=logging.DEBUG):
+        LOGGER.log(level, "%s: %d hits, %d misses, %d entries (size %d/%d)",
+                   self.name, self.hits, self.misses, len(self._data),
+                   self.size, self.maxsize)
+
+
 CLI_ARGPARSER = argparse.ArgumentParser(add_help=False)
 # DB
 CLI_ARGPARSER.add_argument('--init', '--purgedb', action='store_true',
@@ -1068,15 +1166,118 @@ _NMAP_PROBES = {}
 _NMAP_PROBES_POPULATED = False
 _NMAP_CUR_PROBE = None
 _NAMP_CUR_FALLBACK = None
+_NMAP_CUR_PREFILTER = None
+# Bump when the output of _nmap_svc_fp_literals() changes
+_NMAP_SVC_FP_LITERALS_VERSION = 1
+
+
+def _nmap_svc_fp_literals(regexp):
+    """Returns a (prefix, substring, nocase) tuple for the compiled
+    regular expression `regexp`, such that any data matched by
+    `regexp` must start with `prefix` and contain `substring`. When
+    `nocase` is True, `prefix` and `substring` are lowered and must be
+    checked against lowered data.
+
+    This is conservative: when a literal value cannot be determined,
+    `prefix` and/or `substring` are empty.
+
+    """
+    flags = regexp.flags
+    nocase = bool(flags & re.IGNORECASE)
+    if flags & re.LOCALE:
+        return b'', b'', nocase
+    try:
+        parsed = sre_parse.parse(regexp.pattern, flags)
+    except Exception:
+        return b'', b'', nocase
+
+    def flatten(items):
+        # Groups that are not repeated and do not change flags are
+        # inlined; anything else is kept as is (and will break the
+        # literal runs).
+        for op, av in items:
+            if op == sre_parse.SUBPATTERN and not any(av[1:-1]):
+                for item in flatten(av[-1]):
+                    yield item
+            else:
+                yield op, av
+    items = list(flatten(parsed))
+    anchored = bool(items) and items[0][0] == sre_parse.AT and (
+        items[0][1] == sre_parse.AT_BEGINNING_STRING or
+        (items[0][1] == sre_parse.AT_BEGINNING and
+         not flags & re.MULTILINE)
+    )
+    runs = [[]]
+    for op, av in items[1:] if anchored else items:
+        if op == sre_parse.LITERAL:
+            runs[-1].append(av)
+        elif runs[-1]:
+            runs.append([])
+    runs = [bytes(bytearray(run)) for run in runs]
+    if nocase:
+        runs = [run.lower() for run in runs]
+    if anchored and len(items) > 1 and items[1][0] == sre_parse.LITERAL:
+        prefix = runs[0]
+    else:
+        prefix = b''
+    substring = max(runs, key=len)
+    if prefix and len(substring) <= len(prefix):
+        substring = b''
+    return prefix, substring, nocase
+
+
+def _nmap_svc_fp_literals_cache_fname():
+    if not config.CACHE_PATH:
+        return None
+    return os.path.join(config.CACHE_PATH, 'nmap-service-probes.literals')
+
+
+def _load_nmap_svc_fp_literals():
+    """Returns the (pattern, flags) -> _nmap_svc_fp_literals() values
+    stored on disk, or an empty dict.
+
+    """
+    fname = _nmap_svc_fp_literals_cache_fname()
+    if fname is None:
+        return {}
+    try:
+        with open(fname, 'rb') as fdesc:
+            version, literals = pickle.load(fdesc)
+    except Exception:
+        return {}
+    if version != _NMAP_SVC_FP_LITERALS_VERSION:
+        return {}
+    return literals
+
+
+def _store_nmap_svc_fp_literals(literals):
+    fname = _nmap_svc_fp_literals_cache_fname()
+    if fname is None:
+        return
+    tmpfname = '%s.%d' % (fname, os.getpid())
+    try:
+        makedirs(config.CACHE_PATH)
+        with open(tmpfname, 'wb') as fdesc:
+            pickle.dump((_NMAP_SVC_FP_LITERALS_VERSION, literals), fdesc,
+                        protocol=2)
+        os.rename(tmpfname, fname)
+    except (IOError, OSError):
+        LOGGER.debug('Cannot store Nmap service fingerprint cache %r.',
+                     fname, exc_info=True)
 
 
 def _read_nmap_probes():
-    global _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK, _NMAP_PROBES_POPULATED
+    global _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK, _NMAP_CUR_PREFILTER, \
+        _NMAP_PROBES_POPULATED
     _NMAP_CUR_PROBE = None
     _NMAP_CUR_FALLBACK = None
+    _NMAP_CUR_PREFILTER = None
+    cached_literals = _load_nmap_svc_fp_literals()
+    literals = {}
 
     def parse_line(line):
-        global _NMAP_PROBES, _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK
+        global _NMAP_PROBES, _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK, \
+            _NMAP_CUR_PREFILTER
         if line.startswith(b'match '):
             line = line[6:]
             soft = False
@@ -1089,6 +1290,7 @@ def _read_nmap_probes():
         elif line.startswith(b'Probe '):
             _NMAP_CUR_PROBE = []
             _NMAP_CUR_FALLBACK = []
+            _NMAP_CUR_PREFILTER = []
             proto, name, probe = line[6:].split(b' ', 2)
             if not (len(probe) >= 3 and probe[:2] == b'q|' and
                     probe[-1:] == b'|'):
@@ -1100,6 +1302,12 @@ def _read_nmap_probes():
                                     {})[name.decode()] = {
                 "probe": probe, "fp": _NMAP_CUR_PROBE,
                 "fallbacks": _NMAP_CUR_FALLBACK,
+                # (service, fingerprint, prefix, substring, nocase)
+                # tuples, see _nmap_svc_fp_literals()
+                "prefilter": _NMAP_CUR_PREFILTER,
+                # first byte of output -> candidate prefilter tuples,
+                # populated by _nmap_svc_fp_candidates()
+                "candidates": {},
             }
             return
         else:
@@ -1145,6 +1353,13 @@ def _read_nmap_probes():
             info[key] = (value, flag)
             data = data.lstrip(b' ')
         _NMAP_CUR_PROBE.append((service.decode(), info))
+        key = (info['m'][0].pattern, info['m'][0].flags)
+        if key not in literals:
+            try:
+                literals[key] = cached_literals[key]
+            except KeyError:
+                literals[key] = _nmap_svc_fp_literals(info['m'][0])
+        _NMAP_CUR_PREFILTER.append((service.decode(), info) + literals[key])
     try:
         with open(os.path.join(config.NMAP_SHARE_PATH, 'nmap-service-probes'),
                   'rb') as fdesc:
@@ -1153,7 +1368,9 @@ def _read_nmap_probes():
     except (AttributeError, TypeError, IOError):
         LOGGER.warning('Cannot read Nmap service fingerprint file.',
                        exc_info=True)
-    del _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK
+    if literals and literals != cached_literals:
+        _store_nmap_svc_fp_literals(literals)
+    del _NMAP_CUR_PROBE, _NMAP_CUR_FALLBACK, _NMAP_CUR_PREFILTER
     _NMAP_PROBES_POPULATED = True
 
 
@@ -1164,6 +1381,26 @@ def get_nmap_svc_fp(proto="tcp", probe="NULL"):
     return _NMAP_PROBES[proto][probe]
 
 
+def _nmap_svc_fp_candidates(probe_data, first):
+    """Returns the prefilter tuples of the fingerprints from
+    `probe_data` that may match an output starting with `first` (a
+    one-byte value, or an empty value for an empty output), in the
+    fingerprint file order.
+
+    """
+    try:
+        return probe_data['candidates'][first]
+    except KeyError:
+        pass
+    first_lower = first.lower()
+    result = probe_data['candidates'][first] = [
+        fpdata for fpdata in probe_data['prefilter']
+        if not fpdata[2] or
+        fpdata[2][:1] == (first_lower if fpdata[4] else first)
+    ]
+    return result
+
+
 def match_nmap_svc_fp(output, proto="tcp", probe="NULL", soft=False):
     """Take output from a given probe and return the closest nmap
     fingerprint."""
@@ -1174,12 +1411,24 @@ def match_nmap_svc_fp(output, proto="tcp", probe="NULL", soft=False):
             proto=proto,
             probe=probe,
         )
-        fingerprints = probe_data['fp']
     except KeyError:
         pass
     else:
         fallbacks = probe_data.get('fallbacks')
-        for service, fingerprint in fingerprints:
+        output_lower = None
+        # Only run the regular expressions of the fingerprints that
+        # may match, based on their literal prefix and required
+        # substring.
+        for service, fingerprint, prefix, substring, nocase in \
+                _nmap_svc_fp_candidates(probe_data, output[:1]):
+            if nocase:
+                if output_lower is None:
+                    output_lower = output.lower()
+                value = output_lower
+            else:
+                value = output
+            if not value.startswith(prefix) or substring not in value:
+                continue
             match = fingerprint['m'][0].search(output)
             if match is not None:
                 if probe == 'NULL' and service == 'landesk-rc':
@@ -1382,12 +1631,17 @@ _REPRS = {b'\r': '\\r', b'\n': '\\n', b'\t': '\\t', b'\\': '\\\\'}
 _RAWS = {'r': b'\r', 'n': b'\n', 't': b'\t', '\\': b'\\', '0': b'\x00'}
 
 
+# code point -> representation, for the bytes that nmap_encode_data()
+# has to escape
+_NMAP_ENCODE_TABLE = dict(
+    (i, _REPRS.get(struct.pack('B', i), '\\x%02x' % i))
+    for i in range(256)
+    if not 32 <= i <= 126 or struct.pack('B', i) in _REPRS
+)
+
+
 def nmap_encode_data(data):
-    return "".join(
-        _REPRS[d] if d in _REPRS else d.decode() if b" " <= d <= b"~" else
-        '\\x%02x' % ord(d)
-        for d in (data[i:i + 1] for i in range(len(data)))
-    )
+    return data.decode('latin-1').translate(_NMAP_ENCODE_TABLE)
 
 
 def _nmap_decode_data(data, arbitrary_escapes=False):
@@ -1829,6 +2083,8 @@ _CERTKEYS = {
     'SN': 'surname',
 }
 
+_CERTKEYS_REV = dict((val, key) for key, val in viewitems(_CERTKEYS))
+
 _CERTALGOS = {
     6: 'rsaEncryption',
     408: 'id-ecPublicKey',
@@ -2096,10 +2352,300 @@ and is a fallback when pyOpenSSL cannot be imported.
     return result
 
 
-if USE_PYOPENSSL:
-    get_cert_info = _get_cert_info_pyopenssl
+# OpenSSL short names (as reported by pyOpenSSL, before _CERTKEYS is
+# applied) of the attributes for which cryptography uses a different
+# name, or no name
+_CERTKEYS_OID = {
+    '0.9.2342.19200300.100.1.1': 'UID',
+    '1.2.840.113549.1.9.8': 'unstructuredAddress',
+    '1.3.6.1.4.1.311.60.2.1.1': 'jurisdictionL',
+    '1.3.6.1.4.1.311.60.2.1.2': 'jurisdictionST',
+    '1.3.6.1.4.1.311.60.2.1.3': 'jurisdictionC',
+    '2.5.4.9': 'street',
+    '2.5.4.13': 'description',
+    '2.5.4.18': 'postOfficeBox',
+    '2.5.4.20': 'telephoneNumber',
+    '2.5.4.41': 'name',
+    '2.5.4.42': 'GN',
+    '2.5.4.97': 'organizationIdentifier',
+}
+
+# OpenSSL names of the otherName values it can print in
+# subjectAltName extensions
+_CERTOTHERNAMES = {
+    '1.3.6.1.4.1.311.20.2.3': 'UPN',
+    '1.3.6.1.5.5.7.8.5': 'XmppAddr',
+    '1.3.6.1.5.5.7.8.7': 'SRVName',
+    '1.3.6.1.5.5.7.8.8': 'NAIRealm',
+    '1.3.6.1.5.5.7.8.9': 'SmtpUTF8Mailbox',
+}
+
+# (class, type, bits) for the public key types; when bits is None, the
+# .key_size attribute of the key is used. Types that are not in
+# _CERTKEYTYPES use the OpenSSL values, as reported by pyOpenSSL.
+_CERTKEYCLASSES = []
+if USE_CRYPTOGRAPHY:
+    with warnings.catch_warnings():
+        # Accessing dh.* may issue a deprecation warning
+        warnings.simplefilter('ignore')
+        _CERTKEYCLASSES.extend([
+            (rsa.RSAPublicKey, 'rsa', None),
+            (ec.EllipticCurvePublicKey, 'ec', None),
+            (dsa.DSAPublicKey, 'dsa', None),
+            (dh.DHPublicKey, 'dh', None),
+        ])
+    for _module, _class, _type, _bits in [
+            ('ed25519', 'Ed25519PublicKey', 1087, 256),
+            ('ed448', 'Ed448PublicKey', 1088, 456),
+            ('x25519', 'X25519PublicKey', 1034, 253),
+            ('x448', 'X448PublicKey', 1035, 448),
+    ]:
+        try:
+            _module = __import__(
+                'cryptography.hazmat.primitives.asymmetric.%s' % _module,
+                fromlist=[_class],
+            )
+        except ImportError:
+            continue
+        _CERTKEYCLASSES.append((getattr(_module, _class), _type, _bits))
+
+
+def _name_key_cryptography(attr, unknown='UNDEF'):
+    """Returns the OpenSSL short name of a NameAttribute object (from
+cryptography module).
+
+    """
+    k = _CERTKEYS_OID.get(attr.oid.dotted_string,
+                          getattr(attr.oid, '_name', 'Unknown OID'))
+    if k == 'Unknown OID':
+        return attr.oid.dotted_string if unknown is None else unknown
+    return _CERTKEYS_REV.get(k, k)
+
+
+def _name_components_cryptography(name):
+    """Yields the (OpenSSL short name, printable value) tuples of a Name
+object (from cryptography module).
+
+    """
+    for attr in name:
+        k = _name_key_cryptography(attr)
+        v = attr.value
+        if not isinstance(v, bytes):
+            v = v.encode('utf-8')
+        yield k, printable(v).decode()
+
+
+def _parse_subject_cryptography(subject):
+    """Parses a Name object (from cryptography module) and returns a
+text and a dict suitable for use by get_cert_info().
+
+    """
+    components = [(_CERTKEYS.get(k, k), v)
+                  for k, v in _name_components_cryptography(subject)]
+    return ('/'.join('%s=%s' % kv for kv in components),
+            dict(components))
+
+
+def _escape_name_value(value):
+    """Escapes a Name attribute value as OpenSSL does in its "oneline"
+format.
+
+    """
+    value = ''.join('\\%s' % char if char in ',+"\\<>;' else
+                    '\\%02X' % ord(char) if ord(char) < 32 else
+                    char for char in value)
+    if value[:1] in ['#', ' ']:
+        value = '\\' + value
+    if value[-1:] == ' ':
+        value = value[:-1] + '\\ '
+    return value
+
+
+def _decode_der_string(value):
+    """Decodes a DER-encoded string value, as found in otherName
+values.
+
+    """
+    length = ord(value[1:2])
+    value = value[2:]
+    if length & 0x80:
+        nbytes = length & 0x7f
+        length = int(encode_hex(value[:nbytes]), 16)
+        value = value[nbytes:]
+    if len(value) != length:
+        raise ValueError('Invalid DER string')
+    return value.decode('utf-8')
+
+
+def _format_general_name(name):
+    """Formats a GeneralName object (from cryptography module) as
+OpenSSL does when it prints a subjectAltName extension.
+
+    """
+    if isinstance(name, x509.DNSName):
+        return 'DNS:%s' % name.value
+    if isinstance(name, x509.RFC822Name):
+        return 'email:%s' % name.value
+    if isinstance(name, x509.UniformResourceIdentifier):
+        return 'URI:%s' % name.value
+    if isinstance(name, x509.IPAddress):
+        if name.value.version == 4:
+            return 'IP Address:%s' % name.value
+        return 'IP Address:%s' % ':'.join(
+            '%X' % val
+            for val in struct.unpack('>8H', name.value.packed)
+        )
+    if isinstance(name, x509.DirectoryName):
+        return 'DirName:%s' % ', '.join(
+            '%s = %s' % (
+                _name_key_cryptography(attr, unknown=None),
+                _escape_name_value(attr.value.decode('latin-1')
+                                   if isinstance(attr.value, bytes) else
+                                   attr.value),
+            )
+            for attr in name.value
+        )
+    if isinstance(name, x509.RegisteredID):
+        oidname = getattr(name.value, '_name', 'Unknown OID')
+        if oidname == 'Unknown OID':
+            oidname = name.value.dotted_string
+        return 'Registered ID:%s' % oidname
+    if isinstance(name, x509.OtherName):
+        oidname = _CERTOTHERNAMES.get(name.type_id.dotted_string)
+        if oidname is not None:
+            try:
+                return 'othername:%s:%s' % (oidname,
+                                            _decode_der_string(name.value))
+            except Exception:
+                pass
+    return 'othername:<unsupported>'
+
+
+def _cert_datetime(value):
+    """Returns a UTC datetime value as _parse_datetime() does."""
+    if STRPTIME_SUPPORTS_TZ:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _get_cert_info_cryptography(cert):
+    """Extract info from a certificate (hash values, issuer, subject,
+    algorithm) in an handy-to-index-and-query form.
+
+This version relies on the cryptography module, and falls back to
+_get_cert_info_openssl() for the certificates cryptography cannot
+load.
+
+    """
+    try:
+        parsed = x509.load_der_x509_certificate(cert, default_backend())
+    except ValueError:
+        LOGGER.debug('Cannot load certificate %r with cryptography', cert,
+                     exc_info=True)
+        return _get_cert_info_openssl(cert)
+    result = {}
+    for hashtype in ['md5', 'sha1', 'sha256']:
+        result[hashtype] = hashlib.new(hashtype, cert).hexdigest()
+    result['subject_text'], result['subject'] = _parse_subject_cryptography(
+        parsed.subject
+    )
+    result['issuer_text'], result['issuer'] = _parse_subject_cryptography(
+        parsed.issuer
+    )
+    try:
+        san = parsed.extensions.get_extension_for_class(
+            x509.SubjectAlternativeName
+        )
+    except x509.ExtensionNotFound:
+        pass
+    except Exception:
+        LOGGER.warning('Cannot decode subjectAltName for %r',
+                       result['subject_text'], exc_info=True)
+    else:
+        # Mimic pyOpenSSL's behavior, see _get_cert_info_pyopenssl()
+        result['san'] = [x.strip() for x in ', '.join(
+            _format_general_name(name) for name in san.value
+        ).split(', ')]
+    result['self_signed'] = result['issuer_text'] == result['subject_text']
+    try:
+        not_before = parsed.not_valid_before_utc.replace(tzinfo=None)
+        not_after = parsed.not_valid_after_utc.replace(tzinfo=None)
+    except AttributeError:
+        # cryptography < 42
+        not_before = parsed.not_valid_before
+        not_after = parsed.not_valid_after
+    result['not_before'] = _cert_datetime(not_before)
+    result['not_after'] = _cert_datetime(not_after)
+    lifetime = not_after - not_before
+    try:
+        result['lifetime'] = int(lifetime.total_seconds())
+    except AttributeError:
+        # .total_seconds() does not exist in Python 2.6
+        result['lifetime'] = lifetime.days * 86400 + lifetime.seconds
+    result['pubkey'] = {}
+    pubkey = parsed.public_key()
+    for keyclass, keytype, bits in _CERTKEYCLASSES:
+        if isinstance(pubkey, keyclass):
+            result['pubkey']['type'] = keytype
+            result['pubkey']['bits'] = (pubkey.key_size if bits is None
+                                        else bits)
+            break
+    if isinstance(pubkey, rsa.RSAPublicKey):
+        numbers = pubkey.public_numbers()
+        result['pubkey']['exponent'] = numbers.e
+        result['pubkey']['modulus'] = str(numbers.n)
+    pubkey = pubkey.public_bytes(
+        Encoding.DER,
+        PublicFormat.SubjectPublicKeyInfo,
+    )
+    for hashtype in ['md5', 'sha1', 'sha256']:
+        result['pubkey'][hashtype] = hashlib.new(hashtype, pubkey).hexdigest()
+    result['pubkey']['raw'] = encode_b64(pubkey).decode()
+    return result
+
+
+if USE_CRYPTOGRAPHY:
+    _get_cert_info = _get_cert_info_cryptography
+elif USE_PYOPENSSL:
+    _get_cert_info = _get_cert_info_pyopenssl
 else:
-    get_cert_info = _get_cert_info_openssl
+    _get_cert_info = _get_cert_info_openssl
+
+
+# Number of certificates for which get_cert_info() keeps the results
+_CERT_INFO_CACHE_SIZE = 4096
+_CERT_INFO_CACHE = LRUCache(_CERT_INFO_CACHE_SIZE,
+                            name="utils.get_cert_info() cache")
+
+
+def _get_cert_info_cached(cert):
+    key = hashlib.sha256(cert).digest()
+    result = _CERT_INFO_CACHE.get(key)
+    if result is None:
+        result = _CERT_INFO_CACHE[key] = _get_cert_info(cert)
+    return result
+
+
+def get_cert_info(cert):
+    """Extract info from a certificate (hash values, issuer, subject,
+    algorithm) in an handy-to-index-and-query form.
+
+The results are cached, using the SHA-256 hash value of the
+certificate as key.
+
+    """
+    return copy.deepcopy(_get_cert_info_cached(cert))
+
+
+def get_cert_infos(certs):
+    """Like get_cert_info(), for an iterable of certificates. Returns a
+    list of results, in the same order.
+
+Identical certificates are only parsed once (as long as they fit in
+the cache).
+
+    """
+    return [copy.deepcopy(_get_cert_info_cached(cert)) for cert in certs]
 
 
 def display_top(db, arg, flt, lmt):
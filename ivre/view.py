@@ -21,13 +21,14 @@
 
 
 from datetime import datetime
+import heapq
 from textwrap import wrap
 
 
 from ivre.active.data import create_ssl_output, set_openports_attribute
 from ivre.db import db
 from ivre.passive import SCHEMA_VERSION as PASSIVE_SCHEMA_VERSION
-from ivre import utils
+from ivre import config, utils
 from ivre.xmlnmap import SCHEMA_VERSION as ACTIVE_SCHEMA_VERSION
 
 
@@ -418,29 +419,43 @@ def passive_to_view(flt, category=None):
             yield outrec
 
 
+def _add_addr_infos(records):
+    """Sets the "infos" value of each record in `records` (a list),
+    using one batch lookup in the data database.
+
+    """
+    for rec, infos in zip(records, db.data.infos_byip_many(
+            (rec['addr'] for rec in records), addr_type=False,
+    )):
+        rec['infos'] = infos or {}
+    return records
+
+
 def from_passive(flt, category=None):
     """Iterator over passive results, by address."""
     records = passive_to_view(flt, category=category)
     cur_addr = None
     cur_rec = {}
+    # TODO: add_addr_info should be optional
+    buffer_ = []
     for rec in records:
         if cur_addr is None:
             cur_addr = rec['addr']
             cur_rec = rec
         elif cur_addr != rec['addr']:
-            # TODO: add_addr_info should be optional
-            cur_rec['infos'] = {}
-            for func in [db.data.country_byip,
-                         db.data.as_byip,
-                         db.data.location_byip]:
-                cur_rec['infos'].update(func(cur_addr) or {})
-            yield cur_rec
+            buffer_.append(cur_rec)
+            if len(buffer_) >= config.DATA_BATCH_SIZE:
+                for outrec in _add_addr_infos(buffer_):
+                    yield outrec
+                buffer_ = []
             cur_rec = rec
             cur_addr = rec['addr']
         else:
             cur_rec = db.view.merge_host_docs(cur_rec, rec)
     if cur_rec:
-        yield cur_rec
+        buffer_.append(cur_rec)
+    for outrec in _add_addr_infos(buffer_):
+        yield outrec
 
 
 def nmap_record_to_view(rec, category=None):
@@ -504,17 +519,24 @@ def from_nmap(flt, category=None):
         yield cur_rec
 
 
+def _addr_key(addr):
+    """Sort key for IP addresses: the 16-bytes binary representation
+    (IPv4 addresses are mapped in ::ffff:0:0/96), which sorts like the
+    128-bit integer value, as the addresses are sorted by the MongoDB
+    and TinyDB backends.
+
+    """
+    return utils.ip2bin(addr)
+
+
 def to_view(itrs):
     """Takes a list of iterators over view-formated results, and returns an
     iterator over merged results, sorted by ip.
 
-    """
+    The iterators must be sorted by ip. They are merged using a heap,
+    so that only the next record of each iterator is kept in memory.
 
-    def next_record(rec, updt):
-        if rec is None:
-            return updt
-        return db.view.merge_host_docs(rec, updt)
-    next_recs = []
+    """
 
     def prepare_record(rec):
         for port in rec.get('ports', []):
@@ -529,45 +551,32 @@ def to_view(itrs):
                     )
         return rec
 
-    # We cannot use a `for itr in itrs` loop here because itrs is
-    # modified in the loop.
-    i = 0
-    while i < len(itrs):
+    # The heap contains (address key, iterator number, record,
+    # iterator) tuples; the iterator number makes sure the records
+    # (and the iterators) are never compared.
+    heap = []
+    for i, itr in enumerate(itrs):
+        itr = iter(itr)
+        for rec in itr:
+            heap.append((_addr_key(rec['addr']), i, rec, itr))
+            break
+    heapq.heapify(heap)
+    cur_key = cur_rec = None
+    while heap:
+        key, i, rec, itr = heap[0]
+        if cur_rec is None:
+            cur_rec = rec
+        elif key == cur_key:
+            cur_rec = db.view.merge_host_docs(cur_rec, rec)
+        else:
+            yield prepare_record(cur_rec)
+            cur_rec = rec
+        cur_key = key
         try:
-            next_recs.append(next(itrs[i]))
+            rec = next(itr)
         except StopIteration:
-            # We need to remove the corresponding iterator from itrs,
-            # which happens to be the n-th where n is the current
-            # length of next_recs.
-            del itrs[len(next_recs)]  # Do not increment i here
+            heapq.heappop(heap)
         else:
-            i += 1
-    next_addrs = [rec['addr'] for rec in next_recs]
-    cur_rec = None
-    try:
-        cur_addr = min(next_addrs, key=utils.ip2int)
-    except ValueError:
-        # next_addrs is empty
-        cur_addr = None
-    while next_recs:
-        # We cannot use a `for i in range(len(itrs))` loop because
-        # itrs is modified in the loop.
-        i = 0
-        while i < len(itrs):
-            if next_addrs[i] == cur_addr:
-                cur_rec = next_record(cur_rec, next_recs[i])
-                try:
-                    next_recs[i] = next(itrs[i])
-                except StopIteration:
-                    del next_addrs[i]
-                    del next_recs[i]
-                    del itrs[i]
-                    continue  # Do not increment i here
-                next_addrs[i] = next_recs[i]['addr']
-            i += 1
-        if next_addrs and cur_addr not in next_addrs:
-            yield prepare_record(cur_rec)
-            cur_rec = None
-            cur_addr = min(next_addrs)
+            heapq.heapreplace(heap, (_addr_key(rec['addr']), i, rec, itr))
     if cur_rec is not None:
         yield prepare_record(cur_rec)
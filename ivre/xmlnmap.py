@@ -33,6 +33,7 @@ try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
+from xml.parsers import expat
 from xml.sax.handler import ContentHandler, EntityResolver
 
 
@@ -44,7 +45,7 @@ from past.builtins import basestring
 from ivre.active.data import ALIASES_TABLE_ELEMS, \
     cleanup_synack_honeypot_host, create_ssl_output
 from ivre.analyzer import dicom, ike
-from ivre import utils
+from ivre import config, utils
 
 
 SCHEMA_VERSION = 18
@@ -1083,14 +1084,23 @@ _HTTP_HEADER = re.compile(
 )
 
 
+# hex value (as matched by MASSCAN_ENCODING) -> decoded byte
+_MASSCAN_DECODED_RAW = dict(
+    (('%02x' % i).encode(), struct.pack('B', i)) for i in range(256)
+)
+_MASSCAN_DECODED_PRINT = dict(
+    (key, char if (32 <= ord(char) <= 126 or char in b"\t\r\n")
+     else b"\\x" + key)
+    for key, char in viewitems(_MASSCAN_DECODED_RAW)
+)
+
+
 def _masscan_decode_print(match):
-    char = utils.decode_hex(match.groups()[0])
-    return (char if (32 <= ord(char) <= 126 or char in b"\t\r\n")
-            else match.group())
+    return _MASSCAN_DECODED_PRINT[match.group(1)]
 
 
 def _masscan_decode_raw(match):
-    return utils.decode_hex(match.groups()[0])
+    return _MASSCAN_DECODED_RAW[match.group(1)]
 
 
 def masscan_parse_s7info(data):
@@ -1422,6 +1432,29 @@ class NoExtResolver(EntityResolver):
         return 'file://%s' % os.devnull
 
 
+def parse_xml(content_handler, fdesc, buffer_size=65536):
+    """Parses the XML document read from `fdesc` (a file-like object)
+    and drives `content_handler` (an NmapHandler instance) directly
+    from an expat parser.
+
+    This is equivalent to (but noticeably faster than) using
+    xml.sax.make_parser() with `content_handler`: the xml.sax layer
+    creates an AttributesImpl object and adds a function call for each
+    element, and delivers character data in small chunks. External
+    entities are never resolved (see NoExtResolver).
+
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = buffer_size
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+    parser.ExternalEntityRefHandler = lambda *_: 1
+    parser.StartElementHandler = content_handler.startElement
+    parser.EndElementHandler = content_handler.endElement
+    parser.CharacterDataHandler = content_handler.characters
+    parser.ParseFile(fdesc)
+
+
 class NmapHandler(ContentHandler):
 
     """The handler for Nmap's XML documents. An abstract class for
@@ -1475,6 +1508,12 @@ class NmapHandler(ContentHandler):
     def _addhost(self):
         """Subclasses may store self._curhost here."""
 
+    def _flushhosts(self):
+        """Subclasses may store here the hosts they have buffered in
+        ._addhost().
+
+        """
+
     def _storescan(self):
         """Subclasses may store self._curscan here."""
 
@@ -1985,6 +2024,7 @@ argument (a dict object).
 
     def endElement(self, name):
         if name == 'nmaprun':
+            self._flushhosts()
             self._curscan = None
         elif name == 'host':
             # masscan -oX output has no "state" tag
@@ -2507,6 +2547,8 @@ class Nmap2DB(NmapHandler):
         self._add_addr_infos = add_addr_infos
         self.source = source
         self.callback = callback
+        # Hosts waiting for their "infos" (see ._flushhosts())
+        self._hosts = []
         NmapHandler.__init__(self, fname, categories=categories,
                              source=source, add_addr_infos=add_addr_infos,
                              **kargs)
@@ -2520,29 +2562,44 @@ class Nmap2DB(NmapHandler):
     def _addhost(self):
         if self.categories:
             self._curhost['categories'] = self.categories[:]
-        if self._add_addr_infos:
-            self._curhost['infos'] = {}
-            for func in [self._db.data.country_byip,
-                         self._db.data.as_byip,
-                         self._db.data.location_byip]:
-                self._curhost['infos'].update(func(self._curhost['addr']) or
-                                              {})
         if self.source:
             self._curhost['source'] = self.source
+        if not self._add_addr_infos:
+            self._storehost(self._curhost)
+            return
+        # Hosts are buffered so that the IP data lookups are done in
+        # batches
+        self._hosts.append(self._curhost)
+        if len(self._hosts) >= config.DATA_BATCH_SIZE:
+            self._flushhosts()
+
+    def _flushhosts(self):
+        hosts, self._hosts = self._hosts, []
+        if not hosts:
+            return
+        for host, infos in zip(hosts, self._db.data.infos_byip_many(
+                (host['addr'] for host in hosts), addr_type=False,
+        )):
+            host['infos'] = infos or {}
+            self._storehost(host)
+
+    def _storehost(self, host):
         # We are about to insert data based on this file, so we want
         # to save the scan document
         if not self.scan_doc_saved:
             self.scan_doc_saved = True
             self._storescan()
-        self._db.nmap.store_or_merge_host(self._curhost)
+        self._db.nmap.store_or_merge_host(host)
         if self.callback is not None:
-            self.callback(self._curhost)
+            self.callback(host)
 
     def _storescan(self):
         ident = self._db.nmap.store_scan_doc(self._curscan)
         return ident
 
     def _updatescan(self, curscan_more):
+        # The scan document is only saved with the first host
+        self._flushhosts()
         self._db.nmap.update_scan_doc(self._filehash, curscan_more)
 
     def _addscaninfo(self, i):
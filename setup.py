@@ -168,6 +168,8 @@ setup(
         'MediaWiki integration': ["MySQL-python"],
         '3D traceroute graphs': ["dbus-python"],
         'Plots': ["matplotlib"],
+        'Passive worker file notifications': ["pyinotify"],
+        'Faster Zeek JSON logs parsing': ["orjson"],
     },
     packages=['ivre', 'ivre/active', 'ivre/analyzer', 'ivre/db', 'ivre/db/sql',
               'ivre/parser', 'ivre/tools', 'ivre/web'],
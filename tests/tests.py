@@ -21,6 +21,7 @@ from __future__ import print_function
 
 
 from ast import literal_eval
+from bisect import bisect_right
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 from distutils.spawn import find_executable as which
@@ -59,15 +60,19 @@ else:
 
 
 import ivre
+import ivre.active.data
 import ivre.config
 import ivre.db
 import ivre.flow
+import ivre.geoiputils
 import ivre.mathutils
 import ivre.parser.zeek
 import ivre.parser.iptables
 import ivre.passive
 import ivre.target
+import ivre.tools.passivereconworker
 import ivre.utils
+import ivre.view
 import ivre.web.utils
 import ivre.xmlnmap
 
@@ -87,6 +92,22 @@ def capture(function, *args, **kwargs):
     sys.stdout, sys.stderr = out, err
 
 
+@contextmanager
+def config_values(**values):
+    """Sets the ivre.config `values` and restores the previous ones on
+exit (even when an exception occurs).
+
+    """
+    previous = dict((key, getattr(ivre.config, key)) for key in values)
+    for key, value in values.items():
+        setattr(ivre.config, key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            setattr(ivre.config, key, value)
+
+
 def run_iter(cmd, interp=None, stdin=None, stdout=subprocess.PIPE,
              stderr=subprocess.PIPE, env=None):
     if interp is not None:
@@ -123,8 +144,9 @@ def coverage_run_iter(cmd, stdin=None, stdout=subprocess.PIPE,
                     stdin=stdin, stdout=stdout, stderr=stderr)
 
 
-def run_passiverecon_worker(bulk_mode=None):
+def run_passiverecon_worker(bulk_mode=None, workers=1, env=None):
     time.sleep(1)  # Hack for Travis CI
+    options = [bulk_mode, "--workers", str(workers)]
     pid = os.fork()
     if pid < 0:
         raise Exception("Cannot fork")
@@ -135,7 +157,11 @@ def run_passiverecon_worker(bulk_mode=None):
             time.sleep(2)
         os.kill(pid, signal.SIGINT)
         os.waitpid(pid, 0)
-    elif USE_COVERAGE:
+        return
+    if env is not None:
+        os.environ.clear()
+        os.environ.update(env)
+    if USE_COVERAGE:
         os.execvp(
             sys.executable,
             COVERAGE + [
@@ -144,14 +170,14 @@ def run_passiverecon_worker(bulk_mode=None):
                 "--progname", " ".join(
                     pipes.quote(elt) for elt in
                     COVERAGE + ["run", "--parallel-mode", which("ivre"),
-                                "passiverecon2db", bulk_mode]
+                                "passiverecon2db"] + options
                 ),
             ],
         )
     else:
         os.execlp("ivre", "ivre", "passivereconworker", "--directory",
                   "logs", "--progname",
-                  "ivre passiverecon2db %s" % bulk_mode)
+                  "ivre passiverecon2db %s" % " ".join(options))
 
 
 class AgentScanner(object):
@@ -320,6 +346,36 @@ class IvreTests(unittest.TestCase):
         self.assertEqual(res, 0)
         self.check_value(name, int(out))
 
+    def check_nmap_svc_fp_prefilter(self, banners):
+        """Checks that ivre.utils.match_nmap_svc_fp() gives the same
+results, with and without `soft`, as a brute-force loop over all the
+fingerprints of the probes, for each (output, proto, probe) tuple of
+`banners`.
+
+        """
+        banners = set(banners)
+        results = [
+            ivre.utils.match_nmap_svc_fp(output, proto=proto, probe=probe,
+                                         soft=soft)
+            for output, proto, probe in banners
+            for soft in [False, True]
+        ]
+        candidates = ivre.utils._nmap_svc_fp_candidates
+        ivre.utils._nmap_svc_fp_candidates = lambda probe_data, _: [
+            (service, fingerprint, b'', b'', False)
+            for service, fingerprint in probe_data['fp']
+        ]
+        try:
+            self.assertEqual(results, [
+                ivre.utils.match_nmap_svc_fp(output, proto=proto,
+                                             probe=probe, soft=soft)
+                for output, proto, probe in banners
+                for soft in [False, True]
+            ])
+        finally:
+            ivre.utils._nmap_svc_fp_candidates = candidates
+        return len(banners)
+
     @classmethod
     def start_web_server(cls):
         pid = os.fork()
@@ -694,10 +750,19 @@ purposes to feed Elasticsearch view.
             return 0
         scan_duplicate = re.compile(b"^DEBUG:ivre:Scan already present in "
                                     b"Database", re.M)
+        # --jobs is not available with file-based backends
+        if DATABASE == "tinydb":
+            self.assertEqual(
+                RUN(["ivre", "scan2db", "--jobs", "2", os.devnull])[0], 2
+            )
+            jobs = 1
+        else:
+            jobs = random.choice([1, 2])
+        print('Running scan2db with %d job(s)' % jobs)
         for fname in self.nmap_files:
             # Insertion in DB
             options = ["ivre", "scan2db", "--port", "-c", "TEST", "-s",
-                       "SOURCE"]
+                       "SOURCE", "--jobs", str(jobs)]
             if "-probe-" in fname:
                 options.extend(["--masscan-probes", fname.split('-probe-')[1]])
             options.extend(["--", fname])
@@ -1610,7 +1675,10 @@ purposes to feed Elasticsearch view.
             bulk_mode = random.choice(['--bulk', '--local-bulk'])
         else:
             bulk_mode = random.choice(['--bulk', '--no-bulk', '--local-bulk'])
-        print('Running passive tests with %s' % bulk_mode)
+        workers = random.choice([1, 2])
+        print('Running passive tests with %s, %d worker(s)' % (
+            bulk_mode, workers,
+        ))
 
         # Init DB
         self.assertEqual(RUN(["ivre", "ipinfo", "--count"])[1], b"0\n")
@@ -1637,7 +1705,21 @@ purposes to feed Elasticsearch view.
                 env=zeekenv)
             zeekprocess.wait()
 
-        run_passiverecon_worker(bulk_mode=bulk_mode)
+        if bulk_mode == '--local-bulk':
+            # Use a small cache, so that records are written before
+            # the end
+            with tempfile.NamedTemporaryFile(delete=False) as fdesc:
+                newenv = os.environ.copy()
+                if "IVRE_CONF" in newenv:
+                    fdesc.writelines(open(newenv['IVRE_CONF'], 'rb'))
+                fdesc.write(b'\nLOCAL_BATCH_SIZE = 100\n'
+                            b'LOCAL_BATCH_BYTES = 65536\n')
+                newenv["IVRE_CONF"] = fdesc.name
+            run_passiverecon_worker(bulk_mode=bulk_mode, workers=workers,
+                                    env=newenv)
+            os.unlink(fdesc.name)
+        else:
+            run_passiverecon_worker(bulk_mode=bulk_mode, workers=workers)
 
         # Counting
         total_count = ivre.db.db.passive.count(
@@ -1813,6 +1895,62 @@ purposes to feed Elasticsearch view.
             )
         )
         self.check_value("passive_cert_microsoft", count)
+
+        # Compare certificate parsing (cryptography vs openssl)
+        if ivre.utils.USE_CRYPTOGRAPHY:
+
+            def normalize_cert_info(info):
+                info = dict(info)
+                for fld in ['not_before', 'not_after']:
+                    if fld in info:
+                        info[fld] = info[fld].replace(tzinfo=None)
+                pubkey = info['pubkey'] = dict(info['pubkey'])
+                if isinstance(pubkey['raw'], bytes):
+                    pubkey['raw'] = pubkey['raw'].decode()
+                # The openssl version only reports the type of the
+                # keys it knows, and the size of the RSA keys
+                if pubkey.get('type') not in ivre.utils.PUBKEY_REV_TYPES:
+                    pubkey.pop('type', None)
+                if pubkey.get('type') != 'rsa':
+                    pubkey.pop('bits', None)
+                return info
+
+            certs = set(
+                rec['value'] for rec in ivre.db.db.passive.get(
+                    ivre.db.db.passive.searchcert()
+                )
+            )
+            self.assertGreater(len(certs), 0)
+            for cert in certs:
+                cert = ivre.utils.decode_b64(cert.encode())
+                self.assertEqual(
+                    normalize_cert_info(
+                        ivre.utils._get_cert_info_cryptography(cert)
+                    ),
+                    normalize_cert_info(
+                        ivre.utils._get_cert_info_openssl(cert)
+                    ),
+                )
+
+        # Nmap fingerprints: the prefilter gives the same results as a
+        # brute-force loop over the fingerprints for the banners
+        # (see ivre.passive.getinfos())
+        banners = set()
+        for rectype in ['TCP_SERVER_BANNER', 'SSH_SERVER', 'SSH_CLIENT',
+                        'HTTP_SERVER_HEADER']:
+            for rec in ivre.db.db.passive.get(
+                    ivre.db.db.passive.searchrecontype(rectype)
+            ):
+                value = ivre.utils.nmap_decode_data(rec['value'])
+                if rectype == 'TCP_SERVER_BANNER':
+                    banners.add((value, 'tcp', 'NULL'))
+                elif rectype.startswith('SSH_'):
+                    banners.add((value + b'\r\n', 'tcp', 'NULL'))
+                elif rec['source'] == 'SERVER':
+                    banners.add((b"HTTP/1.1 200 OK\r\nServer: " + value +
+                                 b"\r\n\r\n", 'tcp', 'GetRequest'))
+        self.assertGreater(self.check_nmap_svc_fp_prefilter(banners), 0)
+
         count = ivre.db.db.passive.count(
             ivre.db.db.passive.searchjavaua()
         )
@@ -2672,6 +2810,11 @@ purposes to feed Elasticsearch view.
         self.assertEqual(res, 0)
         self.assertEqual(out, b"0 clients\n0 servers\n0 flows\n")
         self.assertFalse(err)
+        jobs = random.choice([1, 2])
+        print('Running zeek2db with %d job(s)' % jobs)
+        # [(directory, [log file, ...]), ...]: the logs are imported
+        # again below
+        zeek_logs = []
         for pcapfname in self.pcap_files:
             # Only Python 3.2+
             # with tempfile.TemporaryDirectory() as tmpdir:
@@ -2684,17 +2827,77 @@ purposes to feed Elasticsearch view.
                  'redef tcp_content_deliver_all_orig = T;'],
                 cwd=tmpdir)
             zeekprocess.wait()
-            res, out, _ = RUN(['ivre', 'zeek2db'] + [
+            logfiles = [
                 os.path.join(dirname, fname)
                 for dirname, _, fnames in os.walk(tmpdir)
                 for fname in fnames
                 if fname.endswith('.log')
-            ])
+            ]
+            zeek_logs.append((tmpdir, logfiles))
+            res, out, _ = RUN(['ivre', 'zeek2db', '--jobs', str(jobs)] +
+                              logfiles)
             self.assertEqual(res, 0)
             self.assertFalse(out)
-            ivre.utils.cleandir(tmpdir)
         total = self.check_flow_count_value("flow_count", {}, [], None)
 
+        # zeek2db has applied the port cleanup heuristics to the flows
+        # of each import: applying them to all the flows must not
+        # change anything
+        res, flows, err = RUN(["ivre", "flowcli"])
+        self.assertEqual(res, 0)
+        self.assertFalse(err)
+        res, _, err = RUN(["ivre", "flowcli", "--cleanup"])
+        self.assertEqual(res, 0)
+        self.assertFalse(err)
+        res, out, err = RUN(["ivre", "flowcli"])
+        self.assertEqual(res, 0)
+        self.assertFalse(err)
+        self.assertEqual(sorted(out.splitlines()), sorted(flows.splitlines()))
+
+        # The results must not depend on the size of the bulks: import
+        # the logs again using several upsert batches (MongoDB) and
+        # commits per file
+        def get_flows_results():
+            result = []
+            for options in [["--count"], [], ["--top", "proto", "dport"],
+                            ["--top", "proto", "--sum", "cspkts", "scbytes"]]:
+                res, out, err = RUN(["ivre", "flowcli"] + options)
+                self.assertEqual(res, 0)
+                self.assertFalse(err)
+                result.append(sorted(out.splitlines()))
+            res, out, err = RUN(["ivre", "flowcli", "--flow-daily"])
+            self.assertEqual(res, 0)
+            self.assertFalse(err)
+            # The order of the flows within a timeslot may change
+            result.append(sorted(
+                (line.split(b' | ', 1)[0],
+                 sorted(line.split(b' | ', 1)[1].split(b' ; ')))
+                for line in out.splitlines()
+            ))
+            return result
+        flows_results = get_flows_results()
+        with tempfile.NamedTemporaryFile(delete=False) as fdesc:
+            newenv = os.environ.copy()
+            if "IVRE_CONF" in newenv:
+                fdesc.writelines(open(newenv['IVRE_CONF'], 'rb'))
+            fdesc.write(b'\nMONGODB_FLOW_BATCH_SIZE = 5\n'
+                        b'FLOW_BATCH_SIZE = 7\n')
+            newenv["IVRE_CONF"] = fdesc.name
+        res, out, err = RUN(["ivre", "flowcli", "--init"],
+                            stdin=open(os.devnull))
+        self.assertEqual(res, 0)
+        for tmpdir, logfiles in zeek_logs:
+            res, out, _ = RUN(['ivre', 'zeek2db', '--jobs', str(jobs)] +
+                              logfiles, env=newenv)
+            self.assertEqual(res, 0)
+            self.assertFalse(out)
+            ivre.utils.cleandir(tmpdir)
+        os.unlink(fdesc.name)
+        if DATABASE == "tinydb":
+            ivre.db.db.flow.invalidate_cache()
+            self.restart_web_server()
+        self.assertEqual(get_flows_results(), flows_results)
+
         # Test basic filters
         self.check_flow_count_value(
             "flow_count_192.168.122.214",
@@ -2949,6 +3152,56 @@ purposes to feed Elasticsearch view.
                 self.check_value("flow_daily_%d_flows_%s"
                                  % (i, flw[0]), flw[1])
 
+        if DATABASE == 'mongo':
+            # The rollup collections must give the same results as
+            # the flows (this filter cannot use the rollups)
+            self.assertTrue(ivre.db.db.flow._rollups_valid())
+            allflt = {'src_addr_0': {'$exists': True}}
+
+            def flow_daily(flt):
+                return [
+                    (rec['time_in_day'], sorted(rec['flows']))
+                    for rec in ivre.db.db.flow.flow_daily(
+                        ivre.config.FLOW_TIME_PRECISION, flt,
+                    )
+                ]
+
+            def topvalues(flt, fields, sum_fields):
+                return set(
+                    (rec['fields'], rec['count'])
+                    for rec in ivre.db.db.flow.topvalues(
+                        flt, fields, sum_fields=sum_fields, topnbr=None,
+                    )
+                )
+            for _ in range(2):
+                self.assertEqual(flow_daily({}), flow_daily(allflt))
+                for flt in [{}, {'proto': 'tcp'}, {'dport': 80}]:
+                    self.assertEqual(
+                        ivre.db.db.flow.count(flt),
+                        ivre.db.db.flow.count(
+                            ivre.db.db.flow.flt_and(flt, allflt)
+                        ),
+                    )
+                for fields, sum_fields in [
+                        (['proto', 'dport'], []),
+                        (['proto'], ['csbytes', 'scbytes']),
+                        (['dport'], ['count']),
+                        (['src.addr'], ['csbytes', 'scbytes']),
+                        (['dst.addr', 'proto'], []),
+                ]:
+                    self.assertEqual(topvalues({}, fields, sum_fields),
+                                     topvalues(allflt, fields, sum_fields))
+                res, _, _ = RUN(['ivre', 'flowcli', '--rebuild-rollups'])
+                self.assertEqual(res, 0)
+                self.assertTrue(ivre.db.db.flow._rollups_valid())
+            # Invalid rollup collections must not be used
+            ivre.db.db.flow.invalidate_rollups()
+            self.assertFalse(ivre.db.db.flow._rollups_valid())
+            self.assertEqual(flow_daily({}), flow_daily(allflt))
+            res, _, _ = RUN(['ivre', 'flowcli', '--rebuild-rollups'])
+            self.assertEqual(res, 0)
+            self.assertTrue(ivre.db.db.flow._rollups_valid())
+
         # Test top values
         self.check_flow_top_values(
             "flow_top_flows",
@@ -3212,6 +3465,24 @@ purposes to feed Elasticsearch view.
                            "--routable"])
         self.assertEqual(res, 0)
         self.assertEqual(out, b'Target has 2848655972 IP addresses\n')
+        # IPRanges indexing benchmark
+        ranges = ivre.geoiputils.get_routable_ranges()
+        self.assertEqual(len(ranges), 2848655972)
+        bounds = list(ranges.iter_int_ranges())
+        self.assertEqual(ranges[0], bounds[0][0])
+        self.assertEqual(ranges[len(ranges) - 1], bounds[-1][1])
+        with self.assertRaises(IndexError):
+            ranges[len(ranges)]
+        indexes = [random.randrange(len(ranges)) for _ in range(100000)]
+        start = time.time()
+        addrs = [ranges[index] for index in indexes]
+        print(u"IPRanges: %d addresses from %d ranges in %.3fs" % (
+            len(addrs), len(bounds), time.time() - start,
+        ))
+        starts = [rstart for rstart, _ in bounds]
+        for addr in addrs:
+            rstart, rstop = bounds[bisect_right(starts, addr) - 1]
+            self.assertTrue(rstart <= addr <= rstop)
         res, out, _ = RUN(["ivre", "runscans", "--output", "Count", "--asnum",
                            "15169"])
         self.assertEqual(res, 0)
@@ -3411,6 +3682,76 @@ purposes to feed Elasticsearch view.
         self.assertEqual(match['service_product'], 'Microsoft Exchange smtpd')
         self.assertEqual(match['service_version'], '5.5.2653.13')
 
+        # Nmap fingerprints: literal values used to prefilter them
+        for pattern, flags, literals in [
+                (b'^SSH-([\\d.]+)-OpenSSH[_-]([\\w._-]+)\\r?\\n', 0,
+                 (b'SSH-', b'-OpenSSH', False)),
+                (b'^220[- ].*FileZilla Server', re.I,
+                 (b'220', b'filezilla server', True)),
+                (b'(?i)^MIXED banner', 0, (b'mixed banner', b'', True)),
+                # With MULTILINE, ^ matches at the beginning of any line
+                (b'^Multi$', re.M, (b'', b'Multi', False)),
+                (b'^Multi$', 0, (b'Multi', b'', False)),
+                (b'\\AMulti', re.M, (b'Multi', b'', False)),
+                # Groups with flags or repeated break the literal runs
+                (b'^x(?i:abc)def', 0, (b'x', b'def', False)),
+                (b'^(?:ab)+cd', 0, (b'', b'cd', False)),
+                (b'^(ab){2}cd', 0, (b'', b'cd', False)),
+                (b'^(?:abc|abd)x', 0, (b'ab', b'', False)),
+                (b'^[^HRS]{100}', 0, (b'', b'', False)),
+        ]:
+            self.assertEqual(
+                ivre.utils._nmap_svc_fp_literals(re.compile(pattern, flags)),
+                literals,
+            )
+        # Nmap fingerprints: the prefilter gives the same results as a
+        # brute-force loop over the fingerprints, for the banners found
+        # in the sample files and for some crafted values (soft
+        # matches, landesk-rc)
+        banners = set([
+            (b'', 'tcp', 'NULL'),
+            (b'SSH-2.0-OpenSSH_6.0p1 Debian-4+deb7u7\r\n', 'tcp', 'NULL'),
+            (b'ssh-2.0-openssh_6.0p1\r\n', 'tcp', 'NULL'),
+            (b'SSH-2.0-Unknown\r\n', 'tcp', 'NULL'),
+            (b'220 unknown service\r\n', 'tcp', 'NULL'),
+            (b'HTTP/1.1 200 OK\r\nServer: Apache/2.4.10 (Debian)\r\n\r\n',
+             'tcp', 'GetRequest'),
+            # landesk-rc: enough different chars, and not enough
+            (bytes(bytearray(x for x in range(256)
+                             if x not in bytearray(b'HRS'))),
+             'tcp', 'NULL'),
+            (b'x' * 150, 'tcp', 'NULL'),
+        ])
+        match_nmap_svc_fp = ivre.utils.match_nmap_svc_fp
+
+        def recording_match_nmap_svc_fp(output, proto="tcp", probe="NULL",
+                                        soft=False):
+            banners.add((output, proto, probe))
+            return match_nmap_svc_fp(output, proto=proto, probe=probe,
+                                     soft=soft)
+        ivre.utils.match_nmap_svc_fp = recording_match_nmap_svc_fp
+        try:
+            for root, _, files in os.walk(SAMPLES):
+                for fname in files:
+                    if not (fname.endswith('.xml') or
+                            fname.endswith('.xml.bz2')):
+                        continue
+                    fname = os.path.join(root, fname)
+                    handler = ivre.xmlnmap.Nmap2Txt(
+                        fname, filehash=None,
+                        masscan_probes=([fname.split('-probe-')[1]]
+                                        if '-probe-' in fname else None),
+                    )
+                    try:
+                        with ivre.utils.open_file(fname) as fdesc:
+                            ivre.xmlnmap.parse_xml(handler, fdesc)
+                    except Exception:
+                        # We only collect the banners here
+                        pass
+        finally:
+            ivre.utils.match_nmap_svc_fp = match_nmap_svc_fp
+        self.check_nmap_svc_fp_prefilter(banners)
+
         # Nmap (and Zeek) encoding & decoding
         # >>> from random import randint
         # >>> bytes(randint(0, 255) for _ in range(1000))
@@ -3594,6 +3935,79 @@ purposes to feed Elasticsearch view.
                         ),
                         i + 1,
                     )
+                    zeekfd.close()
+                    with ivre.parser.zeek.ZeekFile(fname) as zeekfd:
+                        records = list(zeekfd)
+                    with ivre.parser.zeek.ZeekFile(fname) as zeekfd:
+                        self.assertEqual(
+                            [rec for batch in iter(
+                                lambda: zeekfd.parse_lines(100), []
+                            ) for rec in batch],
+                            records,
+                        )
+        # Zeek: the converters must give the same results as
+        # .fix_value()
+        zeekfd = ivre.parser.zeek.ZeekFile(BytesIO(
+            b'#separator \\x09\n'
+            b'#set_separator\t,\n'
+            b'#empty_field\t(empty)\n'
+            b'#unset_field\t-\n'
+            b'#fields\tts\tid.orig_p\tduration\tlocal\tname\tnames\tports\n'
+            b'#types\ttime\tport\tinterval\tbool\tstring\tset[string]\t'
+            b'vector[count]\n'
+        ))
+        for values in [
+                [b'1577836800.123456', b'80', b'0.5', b'T', b'a', b'a,b',
+                 b'1,2'],
+                [b'-', b'-', b'-', b'F', b'(empty)', b'(empty)', b'(empty)'],
+                [b'1577836800', b'443', b'12', b'-', b'-', b'-', b'3'],
+        ]:
+            record = zeekfd.parse_line(b'\t'.join(values))
+            self.assertEqual(len(record), len(values))
+            for (name, typ), value in zip(zeekfd.field_types, values):
+                self.assertEqual(
+                    record[name.replace(b'.', b'_').decode()],
+                    zeekfd.fix_value(value, typ),
+                )
+        # Zeek: JSON logs are detected and give the same records
+        zeekfd.nextlines = [b'\t'.join(values) for values in [
+            [b'1577836800.123456', b'80', b'0.5', b'T', b'a', b'a,b', b'1,2'],
+            [b'1577836800', b'443', b'12', b'F', b'(empty)', b'-', b'-'],
+        ]]
+        records = list(zeekfd)
+        with ivre.parser.zeek.ZeekFile(BytesIO(
+            b'{"_path": "conn", "ts": 1577836800.123456, "id.orig_p": 80, '
+            b'"duration": 0.5, "local": true, "name": "a", '
+            b'"names": ["a", "b"], "ports": [1, 2]}\n'
+            b'{"ts": "2020-01-01T00:00:00Z", "id.orig_p": 443, '
+            b'"duration": 12.0, "local": false, "name": ""}\n'
+        )) as zeekfd:
+            self.assertTrue(isinstance(zeekfd, ivre.parser.zeek.ZeekJSONFile))
+            self.assertEqual(zeekfd.path, 'conn')
+            self.assertEqual(list(zeekfd), records)
+        # Same thing with a log that has other time fields
+        with ivre.parser.zeek.ZeekFile(BytesIO(
+            b'#separator \\x09\n'
+            b'#path\tx509\n'
+            b'#fields\tts\tid\tcertificate.not_valid_before\t'
+            b'certificate.not_valid_after\tcertificate.key_length\n'
+            b'#types\ttime\tstring\ttime\ttime\tcount\n'
+            b'1577836800.5\tFabc\t1546300800.0\t1609459200.0\t2048\n'
+            b'1577836801.5\tFdef\t-\t1609459200.0\t-\n'
+        )) as zeekfd:
+            records = list(zeekfd)
+        self.assertEqual(len(records), 2)
+        self.assertTrue(isinstance(records[0]['certificate_not_valid_after'],
+                                   datetime))
+        with ivre.parser.zeek.ZeekFile(BytesIO(
+            b'{"_path": "x509", "ts": 1577836800.5, "id": "Fabc", '
+            b'"certificate.not_valid_before": 1546300800.0, '
+            b'"certificate.not_valid_after": "2021-01-01T00:00:00Z", '
+            b'"certificate.key_length": 2048}\n'
+            b'{"ts": 1577836801.5, "id": "Fdef", '
+            b'"certificate.not_valid_after": 1609459200.0}\n'
+        )) as zeekfd:
+            self.assertEqual(list(zeekfd), records)
 
         # Iptables
         with ivre.parser.iptables.Iptables(
@@ -3609,6 +4023,115 @@ purposes to feed Elasticsearch view.
 
             self.assertEqual(count, 40)
 
+        # passivereconworker: chunks made of whole lines
+        data = b''.join(('line %d\n' % i).encode() for i in range(100))
+        chunks = list(ivre.tools.passivereconworker.iter_chunks(
+            BytesIO(data), size=100,
+        ))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks))
+        self.assertEqual(
+            list(ivre.tools.passivereconworker.iter_chunks(
+                BytesIO(b'a' * 250 + b'\nb'), size=100,
+            )),
+            [b'a' * 250 + b'\n', b'b'],
+        )
+        # passivereconworker: per-sensor feeder; a file that cannot be
+        # read must not stop the feeder
+        tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(tmpdir, 'current'))
+        outfile = os.path.join(tmpdir, 'output')
+        fnames = [os.path.join(tmpdir, 'current', 'TEST.%d.log' % i)
+                  for i in range(3)]
+        for fname in fnames[::2]:
+            with open(fname, 'wb') as fdesc:
+                fdesc.write(data)
+        feeder = ivre.tools.passivereconworker.SensorFeeder(
+            'cat >> %s; true' % pipes.quote(outfile), tmpdir, 'TEST',
+        )
+        feeder.start()
+        for fname in fnames:
+            feeder.put(fname)
+        feeder.stop()
+        feeder.join()
+        self.assertEqual(feeder.handled, 3)
+        self.assertEqual(feeder.depth, 0)
+        self.assertEqual(feeder.handled_bytes, 2 * len(data))
+        self.assertFalse(any(os.path.exists(fname) for fname in fnames))
+        with open(outfile, 'rb') as fdesc:
+            self.assertEqual(fdesc.read(), 2 * data)
+        shutil.rmtree(tmpdir)
+
+        # Passive local bulk: when the cache is full, the least recently
+        # seen records are written until it is half-full
+        class LocalBulkPassive(ivre.db.DBPassive):
+            def __init__(self):
+                super(LocalBulkPassive, self).__init__()
+                self.written = []
+
+            def insert_or_update_bulk(self, specs, getinfos=None,
+                                      separated_timestamps=True):
+                self.written.append(
+                    [(spec['value'], spec['count']) for spec in specs]
+                )
+        with config_values(LOCAL_BATCH_SIZE=4):
+            passive = LocalBulkPassive()
+            passive.insert_or_update_local_bulk(
+                (timestamp, {'recontype': 'TEST', 'value': value})
+                for timestamp, value in enumerate('ABCADBEFG')
+            )
+        self.assertEqual(passive.written, [
+            [('B', 1), ('C', 1)],
+            [('A', 2), ('D', 1)],
+            [('B', 1), ('E', 1)],
+            [('F', 1), ('G', 1)],
+        ])
+        # Same thing with a cache limited in size
+        with config_values(LOCAL_BATCH_BYTES=256):
+            passive = LocalBulkPassive()
+            passive.insert_or_update_local_bulk(
+                (timestamp, {'recontype': 'TEST', 'value': value * 50})
+                for timestamp, value in enumerate('ABCADBEFG')
+            )
+        self.assertGreater(len(passive.written), 1)
+        self.assertEqual(
+            sum(count for batch in passive.written for _, count in batch), 9
+        )
+
+        # Passive caches: the results are shared, getinfos() returns
+        # copies of the "infos" values
+        spec = {'recontype': 'SSH_SERVER', 'source': 'port-22',
+                'value': 'SSH-2.0-OpenSSH_7.4'}
+        hits = ivre.passive._getinfos_from_banner.cache.hits
+        result = ivre.passive.getinfos(spec)
+        self.assertEqual(result['infos']['service_product'], 'OpenSSH')
+        result['infos']['service_product'] = 'modified'
+        self.assertEqual(
+            ivre.passive.getinfos(spec)['infos']['service_product'],
+            'OpenSSH',
+        )
+        self.assertGreater(ivre.passive._getinfos_from_banner.cache.hits,
+                           hits)
+
+        # LRU cache limited by the estimated size of the values
+        value = {'key': ['x' * 1000, 'y' * 1000]}
+        size = ivre.utils.estimate_size(value)
+        self.assertGreater(size, 2000)
+        cache = ivre.utils.LRUCache(
+            3 * size,
+            sizefunc=lambda _, value: ivre.utils.estimate_size(value),
+        )
+        for key in range(4):
+            cache[key] = value
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.size, 3 * size)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(3), value)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache[4] = {'key': ['x' * 10000]}
+        self.assertNotIn(4, cache)
+
         # Web utils
         with self.assertRaises(ValueError):
             ivre.web.utils.query_from_params({'q': '"'})
@@ -3780,6 +4303,105 @@ purposes to feed Elasticsearch view.
                     found = True
         self.assertTrue(found)
 
+        # Host merging: properties & benchmark
+        def random_host(endtime, nports):
+            ports = {}
+            for _ in range(nports):
+                port = {'protocol': random.choice(['tcp', 'udp']),
+                        'port': random.randrange(1, 1000),
+                        'state_state': random.choice(['open', 'closed']),
+                        'state_reason': 'syn-ack',
+                        'service_name': random.choice(['http', 'ssh'])}
+                port['scripts'] = [
+                    {'id': 'ssl-cert', 'output': '',
+                     'ssl-cert': [{'sha256': '%064x' % random.randrange(8)}
+                                  for _ in range(random.randrange(1, 4))]},
+                    {'id': 'http-user-agent', 'output': '',
+                     'http-user-agent': ['UA%d' % random.randrange(8)]},
+                    {'id': 'banner', 'output': 'banner'},
+                ][:random.randrange(4)]
+                if not port['scripts']:
+                    del port['scripts']
+                ports[(port['protocol'], port['port'])] = port
+            return {'addr': '10.0.0.1', 'schema_version': 1, 'state': 'up',
+                    'starttime': endtime - timedelta(hours=1),
+                    'endtime': endtime,
+                    'addresses': {'mac': [
+                        '00:00:00:00:00:%02x' % i
+                        for i in range(random.randrange(4))
+                    ]},
+                    'ports': list(ports.values())}
+
+        def script_values(host):
+            return dict(
+                ((port['protocol'], port['port'], script['id']),
+                 set(cert['sha256'] for cert in script['ssl-cert'])
+                 if 'ssl-cert' in script else
+                 set(script.get('http-user-agent', [script['output']])))
+                for port in host.get('ports', [])
+                for script in port.get('scripts', [])
+            )
+
+        for _ in range(200):
+            rec1 = random_host(datetime(2020, 1, 1), random.randrange(50))
+            rec2 = random_host(datetime(2020, 1, 2), random.randrange(50))
+            values1, values2 = script_values(rec1), script_values(rec2)
+            ports1 = set((port['protocol'], port['port'])
+                         for port in rec1['ports'])
+            ports2 = dict(((port['protocol'], port['port']),
+                           port['state_state']) for port in rec2['ports'])
+            macs = set(rec1['addresses']['mac'] + rec2['addresses']['mac'])
+            result = ivre.active.data.merge_host_docs(rec1, rec2)
+            # Ports, scripts and addresses are the union of the inputs
+            self.assertEqual(
+                set((port['protocol'], port['port'])
+                    for port in result.get('ports', [])),
+                ports1.union(ports2),
+            )
+            merged_values = script_values(result)
+            self.assertEqual(set(merged_values),
+                             set(values1).union(values2))
+            for key, value in merged_values.items():
+                if key[2] == 'banner':
+                    # Not merged: the most recent value is kept
+                    self.assertEqual(value,
+                                     values2.get(key, values1.get(key)))
+                else:
+                    self.assertEqual(value, values1.get(key, set()).union(
+                        values2.get(key, set())
+                    ))
+            self.assertEqual(
+                set(result.get('addresses', {}).get('mac', [])), macs,
+            )
+            # The most recent port state is kept, and the openports
+            # attribute is consistent
+            openports = set(
+                (port['protocol'], port['port'])
+                for port in result.get('ports', [])
+                if port['state_state'] == 'open'
+            )
+            for key in ports2:
+                self.assertEqual(key in openports, ports2[key] == 'open')
+            self.assertEqual(result['openports']['count'], len(openports))
+            self.assertEqual(
+                sum(result['openports'].get(proto, {}).get('count', 0)
+                    for proto in ['tcp', 'udp']),
+                len(openports),
+            )
+            # Merging a result with itself changes nothing
+            self.assertEqual(
+                script_values(ivre.active.data.merge_host_docs(result,
+                                                               result)),
+                merged_values,
+            )
+        hosts = [random_host(datetime(2020, 1, 1) + timedelta(hours=i), 500)
+                 for i in range(20)]
+        start = time.time()
+        result = reduce(ivre.active.data.merge_host_docs, hosts)
+        print(u"merge_host_docs: %d hosts, %d ports in %.3fs" % (
+            len(hosts), len(result['ports']), time.time() - start,
+        ))
+
     def test_scans(self):
         "Run scans, with and without agents"
 
@@ -4129,6 +4751,45 @@ purposes to feed Elasticsearch view.
         self.assertEqual(ret, 0)
         self.assertEqual(len(out.splitlines()), 1)
 
+        if DATABASE in ['mongo', 'tinydb']:
+            print('Incremental mode')
+            # The first run merges all the records
+            self.assertEqual(RUN(["ivre", "db2view", "--incremental",
+                                  "passive"])[0], 0)
+            self.check_value("view_count_passive",
+                             ivre.db.db.view.count(ivre.db.db.view.flt_empty))
+            # The second run must not merge the same records again
+            ivre.db.db.view.remove_many(ivre.db.db.view.flt_empty)
+            self.assertEqual(RUN(["ivre", "db2view", "--incremental",
+                                  "passive"])[0], 0)
+            self.assertEqual(
+                ivre.db.db.view.count(ivre.db.db.view.flt_empty), 0
+            )
+            # ... but only the new ones
+            ivre.db.db.passive.insert_or_update(datetime.now(), {
+                'schema_version': ivre.passive.SCHEMA_VERSION,
+                'addr': '198.51.100.1',
+                'recontype': 'TEST_INCREMENTAL',
+                'source': 'TEST',
+                'value': 'test',
+            })
+            self.assertEqual(RUN(["ivre", "db2view", "--incremental",
+                                  "passive"])[0], 0)
+            self.assertEqual(
+                [rec['addr'] for rec in
+                 ivre.db.db.view.get(ivre.db.db.view.flt_empty)],
+                ['198.51.100.1'],
+            )
+            ivre.db.db.passive.remove(
+                ivre.db.db.passive.searchrecontype('TEST_INCREMENTAL')
+            )
+            self.assertEqual(RUN(["ivre", "view", "--init"],
+                                 stdin=open(os.devnull))[0], 0)
+        else:
+            # No watermarks storage
+            self.assertEqual(RUN(["ivre", "db2view", "--incremental",
+                                  "passive"])[0], 2)
+
         print('Counting')
         view_count = 0
         # Count passive results
@@ -4151,9 +4812,16 @@ purposes to feed Elasticsearch view.
         view_count = int(out)
         self.assertGreater(view_count, 0)
         self.check_value("view_count_active", view_count)
-        # Count merged results
-        self.assertEqual(RUN(["ivre", "db2view", "--view-category", "PASSIVE",
-                              "passive"])[0], 0)
+        # Count merged results; --processes is not available with
+        # file-based backends
+        if DATABASE == "tinydb":
+            self.assertEqual(RUN(["ivre", "db2view", "--processes", "2",
+                                  "passive"])[0], 2)
+            options = []
+        else:
+            options = ["--processes", "2"]
+        self.assertEqual(RUN(["ivre", "db2view"] + options +
+                             ["--view-category", "PASSIVE", "passive"])[0], 0)
         if DATABASE == 'elastic':
             time.sleep(ELASTIC_INSERT_TEMPO)
         ret, out, _ = RUN(["ivre", "view", "--count"])
@@ -4769,6 +5437,49 @@ purposes to feed Elasticsearch view.
         os.unlink(fdesc.name)
         # END Using the HTTP server as a database
 
+        # Bulk merge: merging the records with themselves must not
+        # create new records
+        count = ivre.db.db.view.count(ivre.db.db.view.flt_empty)
+        self.assertEqual(
+            ivre.db.db.view.store_or_merge_hosts(
+                list(ivre.db.db.view.get(ivre.db.db.view.flt_empty))
+            ),
+            count,
+        )
+        self.assertEqual(ivre.db.db.view.count(ivre.db.db.view.flt_empty),
+                         count)
+
+        # Merge of sorted sources (benchmark)
+        sources = []
+        for i in range(12):
+            addrs = set(ivre.utils.int2ip(random.randrange(0x0a000000,
+                                                           0x0a040000))
+                        for _ in range(10000))
+            addrs.update('2001:db8::%x' % random.randrange(0x10000)
+                         for _ in range(1000))
+            sources.append([
+                {'addr': addr, 'categories': ['SOURCE%d' % i],
+                 'source': ['source%d' % i], 'schema_version': 1,
+                 'starttime': datetime(2020, 1, 1),
+                 'endtime': datetime(2020, 1, 1) + timedelta(hours=i)}
+                for addr in sorted(addrs, key=ivre.utils.ip2bin)
+            ])
+        start = time.time()
+        result = list(ivre.view.to_view([iter(src) for src in sources]))
+        print(u"to_view: %d sources, %d records, %d hosts in %.3fs" % (
+            len(sources), sum(len(src) for src in sources), len(result),
+            time.time() - start,
+        ))
+        addrs = [rec['addr'] for rec in result]
+        self.assertEqual(addrs, sorted(set(addrs), key=ivre.utils.ip2bin))
+        self.assertEqual(
+            set(addrs), set(rec['addr'] for src in sources for rec in src)
+        )
+        self.assertEqual(
+            sum(len(rec['categories']) for rec in result),
+            sum(len(src) for src in sources),
+        )
+
     def test_55_view_delete(self):
         # Remove
         addr = next(iter(ivre.db.db.view.get(